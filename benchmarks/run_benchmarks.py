@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the climaproof downscaling tool on synthetic data
+--> runtime and peak memory of the steps of the dst pipeline
+
+    python benchmarks/run_benchmarks.py --lat-cells 90 --lon-cells 120 --years 2 \
+        --output results.json --baseline baseline.json
+
+The inputs are generated with synthetic.py for the given domain size (in
+coarse 0.1° cells) and period. Every benchmark is run --repeat times, the
+fastest run and the peak of the Python/numpy heap of one more, traced run
+(tracemalloc, memory allocated inside ESMF or the netCDF library is not
+included) are written to the JSON output. With --baseline the results are compared with an earlier
+output, the script exits with 1 if a benchmark got slower or needs more
+memory than the tolerance allows.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import xarray as xr
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dst'))
+
+import downscaling_functions as df
+import synthetic
+
+METHODS = ('bilinear', 'patch', 'nearest_s2d')
+
+def measure(fn, repeat=3):
+    '''
+    Fastest runtime (seconds) of repeat calls of fn and heap peak (bytes) of
+    one more call. The peak is traced in a separate call, as tracemalloc slows
+    down the allocations it traces.
+    '''
+    times = []
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter()-t0)
+
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'time': min(times), 'peak_memory': peak}
+
+def run_benchmarks(workdir, n_lat=40, n_lon=60, years=1, methods=METHODS, variable='tasmax',
+                   sea_fraction=0.2, repeat=3):
+    '''
+    Generate the synthetic inputs in workdir and run all benchmarks.
+    Returns a dict of benchmark name -> {'time', 'peak_memory'}.
+    '''
+    inputs = synthetic.make_inputs(os.path.join(workdir, 'inputs'), n_lat, n_lon, years, (variable,),
+                                   sea_fraction=sea_fraction)
+    paths = inputs['paths']
+    lat_min, lat_max, lon_min, lon_max = inputs['domain']
+    start_year, end_year = inputs['period']
+    savedir = os.path.join(workdir, 'output')+'/'
+    os.makedirs(savedir)
+
+    ds = xr.open_dataset(paths[variable])
+    topo_fine = xr.open_dataset(paths['topo_fine'])
+    topo_coarse = xr.open_dataset(paths['topo_coarse'])
+
+    results = {}
+    def bench(name, fn):
+        print('...{}'.format(name))
+        results[name] = measure(fn, repeat)
+
+    bench('cut_domain', lambda: df.cut_domain(ds, lat_min, lat_max, lon_min, lon_max,
+                                              start_year, end_year)[variable].load())
+
+    ds_subset, topo_coarse_subset, topo_fine_subset = df.subset_inputs(ds, topo_fine, topo_coarse,
+                                                                       lat_min, lat_max, lon_min, lon_max,
+                                                                       start_year, end_year)
+    ds_subset.load()
+
+    for method in methods:
+        bench('regrid_data[{}]'.format(method),
+              lambda: df.regrid_data(ds_subset, topo_coarse_subset, topo_fine_subset, variable, method,
+                                     weight_cache=False))
+
+    # regridded data with the unresolved coastal cells, as before the coast fill
+    regridder = df.get_regridder(ds_subset, topo_fine_subset, methods[0], weight_cache=False)
+    data_raw = df.apply_regridder(regridder, ds_subset[variable].data, topo_fine_subset['height'].shape,
+                                  np.float32)
+    regridder.clean_weight_file()
+    topo_mask = ~np.isnan(topo_fine_subset['height'].data)
+
+    bench('fill', lambda: df.fill(data_raw.copy(), topo_mask))
+    def correct_coast():
+        # without the index maps in memory of the earlier runs
+        df._index_maps.clear()
+        return df.correct_coast(data_raw.copy(), topo_fine_subset, index_cache=False)
+    bench('correct_coast', correct_coast)
+
+    month_mean = df.monthly_means(ds_subset, variable)
+    height = topo_coarse_subset['height'].data
+    bench('linreg', lambda: [df.linreg(month_mean[m], height) for m in range(12)])
+    bench('monthly_gradients', lambda: df.monthly_gradients(ds_subset, topo_coarse_subset, variable))
+
+    data_regrid = df.regrid_data(ds_subset, topo_coarse_subset, topo_fine_subset, variable, methods[0],
+                                 weight_cache=False)
+    lat1d, lon1d = topo_fine_subset['lat'].data, topo_fine_subset['lon'].data
+    bench('write_netcdf', lambda: df.write_netcdf(data_regrid.copy(), variable, lat1d, lon1d, start_year, end_year,
+                                                  savedir, 'model', 'SYNTHETIC'))
+    bench('write_netcdf_obs', lambda: df.write_netcdf_obs(data_regrid.copy(), variable, lat1d, lon1d,
+                                                          start_year, end_year, savedir, 'obs'))
+
+    ds.close()
+    topo_fine.close()
+    topo_coarse.close()
+
+    return results
+
+def compare(results, baseline, tolerance=0.25, memory_tolerance=0.1, min_time=0.05):
+    '''
+    Print the results next to the baseline and return the names of the
+    benchmarks, which are slower (or need more memory) than the baseline by
+    more than the tolerance (fraction). Slowdowns of less than min_time
+    seconds are timing noise.
+    '''
+    regressions = []
+    print('{:24s} {:>10s} {:>10s} {:>8s} {:>12s} {:>12s}'.format('benchmark', 'time', 'baseline', 'ratio',
+                                                                    'memory', 'baseline'))
+    for name in sorted(results):
+        result = results[name]
+        if name not in baseline:
+            print('{:24s} {:10.3f} {:>10s}'.format(name, result['time'], '-'))
+            continue
+        base = baseline[name]
+        ratio = result['time']/base['time'] if base['time'] > 0 else 1.
+        flag = ''
+        slower = (ratio > 1+tolerance) and (result['time']-base['time'] > min_time)
+        if slower or (result['peak_memory'] > (1+memory_tolerance)*base['peak_memory']):
+            regressions.append(name)
+            flag = '  <-- regression'
+        print('{:24s} {:10.3f} {:10.3f} {:8.2f} {:12d} {:12d}{}'.format(name, result['time'], base['time'], ratio,
+                                                                          result['peak_memory'], base['peak_memory'], flag))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the downscaling pipeline on synthetic data.')
+    parser.add_argument('--lat-cells', type=int, default=40, help='domain size in coarse cells (latitude)')
+    parser.add_argument('--lon-cells', type=int, default=60, help='domain size in coarse cells (longitude)')
+    parser.add_argument('--years', type=int, default=1, help='length of the period in years')
+    parser.add_argument('--methods', nargs='+', default=list(METHODS), help='regridding methods')
+    parser.add_argument('--variable', default='tasmax', help='downscaled variable')
+    parser.add_argument('--sea-fraction', type=float, default=0.2, help='fraction of the domain covered by sea')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of every benchmark')
+    parser.add_argument('--workdir', default=None, help='directory for the inputs and outputs (default: temporary)')
+    parser.add_argument('--output', default=None, help='JSON file for the results')
+    parser.add_argument('--baseline', default=None, help='JSON file of earlier results to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed slowdown against the baseline (fraction, default 0.25)')
+    parser.add_argument('--min-time', type=float, default=0.05,
+                        help='slowdowns below this many seconds are ignored (default 0.05)')
+    parser.add_argument('--memory-tolerance', type=float, default=0.1,
+                        help='allowed memory increase against the baseline (fraction, default 0.1)')
+    args = parser.parse_args(argv)
+
+    workdir = args.workdir if args.workdir is not None else tempfile.mkdtemp(prefix='dst_benchmarks_')
+    try:
+        results = run_benchmarks(workdir, args.lat_cells, args.lon_cells, args.years, args.methods,
+                                 args.variable, args.sea_fraction, args.repeat)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = {'config': {'lat_cells': args.lat_cells, 'lon_cells': args.lon_cells, 'years': args.years,
+                         'methods': args.methods, 'variable': args.variable,
+                         'sea_fraction': args.sea_fraction, 'repeat': args.repeat},
+              'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                              'cpus': multiprocessing.cpu_count(),
+                              'numpy': np.__version__, 'xarray': xr.__version__},
+              'results': results}
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+
+    baseline = {}
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('config') != output['config']:
+            print('Warning: the baseline was run with a different configuration.')
+        baseline = baseline['results']
+
+    regressions = compare(results, baseline, args.tolerance, args.memory_tolerance, args.min_time)
+    if regressions:
+        print('Regressions: {}'.format(', '.join(regressions)))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
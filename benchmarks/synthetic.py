@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic input data for the benchmarks of the climaproof downscaling tool
+--> coarse (0.1°) model data, coarse and fine (0.01°) topography with a coastline
+
+The files look like the real inputs of dst: daily CF data with the global
+attribute modelname and a calendar, topography files with a height variable
+which is nan over the sea. The terrain is a sum of random smooth hills, the
+sea is the part of the domain where a second smooth random field is low, so
+the coastline is irregular. Everything is reproducible with the seed.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+from scipy import ndimage as nd
+
+# resolution of the coarse and the fine grid in degrees
+RES_COARSE = 0.1
+RES_FINE = 0.01
+
+def make_grid(lat_min, lon_min, n_lat, n_lon, res):
+    '''
+    1D lat/lon coordinates of a regular grid.
+    '''
+    lat = np.round(lat_min+np.arange(n_lat)*res, 6)
+    lon = np.round(lon_min+np.arange(n_lon)*res, 6)
+    return lat, lon
+
+def smooth_field(shape, scale, rng):
+    '''
+    Random field (0-1) with features of about scale cells.
+    '''
+    field = nd.gaussian_filter(rng.standard_normal(shape), scale, mode='wrap')
+    field -= field.min()
+    return field/max(field.max(), 1e-12)
+
+def make_topography(n_lat, n_lon, sea_fraction=0.2, max_height=2500., rng=None):
+    '''
+    Fine grid heights (metres) with nan over the sea, which covers about
+    sea_fraction of the domain.
+    '''
+    if rng is None:
+        rng = np.random.RandomState(0)
+    height = max_height*smooth_field((n_lat, n_lon), max(n_lat, n_lon)/8., rng)**2
+    if sea_fraction > 0:
+        land = smooth_field((n_lat, n_lon), max(n_lat, n_lon)/6., rng)
+        height[land < np.percentile(land, 100*sea_fraction)] = np.nan
+    return height
+
+def coarsen_topography(height, factor):
+    '''
+    Coarse grid heights as the mean of factor x factor fine cells; coarse
+    cells with more sea than land cells are sea.
+    '''
+    n_lat, n_lon = height.shape[0]//factor, height.shape[1]//factor
+    blocks = height[:n_lat*factor, :n_lon*factor].reshape(n_lat, factor, n_lon, factor)
+    n_land = (~np.isnan(blocks)).sum(axis=(1, 3))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        coarse = np.nansum(blocks, axis=(1, 3))/n_land
+    coarse[n_land < factor**2/2.] = np.nan
+    return coarse
+
+def make_data(variable, time, height_coarse, rng=None):
+    '''
+    Daily values of variable on the coarse grid with a seasonal cycle, a
+    height dependency and noise; nan over the sea.
+    '''
+    if rng is None:
+        rng = np.random.RandomState(1)
+    day = np.arange(len(time))[:,np.newaxis,np.newaxis]
+    season = np.sin(2*np.pi*(day-100)/365.25)
+    noise = rng.standard_normal((len(time),)+height_coarse.shape)
+    if variable == 'pr':
+        values = np.maximum(3*noise+2+0.002*height_coarse-season, 0)
+    elif variable == 'rsds':
+        values = 180+120*season+0.02*height_coarse+20*noise
+    else:
+        values = 15+10*season-0.0065*height_coarse+2*noise
+    return values.astype(np.float32)
+
+def make_inputs(directory, n_lat=40, n_lon=60, years=1, variables=('tasmax', 'pr'),
+                lat_min=40., lon_min=15., sea_fraction=0.2, seed=0):
+    '''
+    Write synthetic inputs for a domain of n_lat x n_lon coarse cells and
+    years years (starting 2001) to directory:
+    topo_fine.nc, topo_coarse.nc and <variable>.nc for every variable.
+    Returns a dict with the paths, the domain (lat_min, lat_max, lon_min,
+    lon_max) and the period (start_year, end_year).
+    '''
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    rng = np.random.RandomState(seed)
+    factor = int(round(RES_COARSE/RES_FINE))
+
+    # the fine grid has one coarse cell more on every side
+    lat_fine, lon_fine = make_grid(lat_min-RES_COARSE, lon_min-RES_COARSE,
+                                   (n_lat+2)*factor, (n_lon+2)*factor, RES_FINE)
+    height_fine = make_topography(len(lat_fine), len(lon_fine), sea_fraction, rng=rng)
+    # coarse cells are centred on their fine cells
+    lat, lon = make_grid(lat_min-RES_COARSE+(factor-1)*RES_FINE/2., lon_min-RES_COARSE+(factor-1)*RES_FINE/2.,
+                         n_lat+2, n_lon+2, RES_COARSE)
+    height_coarse = coarsen_topography(height_fine, factor)
+
+    paths = {'topo_fine': os.path.join(directory, 'topo_fine.nc'),
+             'topo_coarse': os.path.join(directory, 'topo_coarse.nc')}
+    xr.Dataset({'height': (('lat', 'lon'), height_fine.astype(np.float32))},
+               coords={'lat': lat_fine, 'lon': lon_fine}).to_netcdf(paths['topo_fine'])
+    xr.Dataset({'height': (('lat', 'lon'), height_coarse.astype(np.float32))},
+               coords={'lat': lat, 'lon': lon}).to_netcdf(paths['topo_coarse'])
+
+    start_year = 2001
+    end_year = start_year+years-1
+    time = pd.date_range(str(start_year)+'-01-01', str(end_year)+'-12-31', freq='D')
+    for variable in variables:
+        ds = xr.Dataset({variable: (('time', 'lat', 'lon'), make_data(variable, time, height_coarse, rng))},
+                        coords={'time': time, 'lat': lat, 'lon': lon},
+                        attrs={'modelname': 'SYNTHETIC'})
+        paths[variable] = os.path.join(directory, variable+'.nc')
+        ds.to_netcdf(paths[variable], encoding={'time': {'units': 'days since 1950-01-01', 'calendar': 'standard'}})
+
+    return {'paths': paths,
+            'domain': (float(lat[1]), float(lat[-2]), float(lon[1]), float(lon[-2])),
+            'period': (start_year, end_year)}
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+Batch downscaling for the climaproof downscaling tool
+--> many (variable, file) jobs on the same domain and period in a process pool
+
+The topography is loaded and cut to the domain once and handed to every
+worker process when it starts, the regridding weights of every source grid are
+built once before the jobs start and are shared through the weight cache.
+"""
+
+import multiprocessing
+import traceback
+
+import numpy as np
+import xarray as xr
+
+import cache_utils
+import catalog
+import downscaling_functions as df
+import estimate
+import instrument
+from downscaling_functions import index_range, subset_inputs, get_regridder, start_tool
+
+# topography of the worker processes, set by _init_worker
+_topo_fine = None
+_topo_coarse = None
+
+def load_topo(path_to_topo, lat_min, lat_max, lon_min, lon_max):
+    '''
+    Load the part of a topography file needed for the lat/lon box.
+    A margin of two grid cells is kept around the box, so cut_domain gives the
+    same subsets as on the whole file.
+    '''
+    topo = xr.open_dataset(path_to_topo)
+    if (topo['lat'].dims == ('lat',)) & (topo['lon'].dims == ('lon',)):
+        margin_lat = 2*np.abs(np.diff(topo['lat'].data[:2])).max()
+        margin_lon = 2*np.abs(np.diff(topo['lon'].data[:2])).max()
+        topo = topo.isel(lat=index_range(topo['lat'], lat_min-margin_lat, lat_max+margin_lat),
+                         lon=index_range(topo['lon'], lon_min-margin_lon, lon_max+margin_lon))
+    return topo.load()
+
+def plan_workers(n_fine, memory_budget=None, processes=None, n_jobs=None, min_block_size=1,
+                 n_time=None, regrid_method='patch'):
+    '''
+    Number of worker processes and block size for jobs with n_fine cells on the
+    fine grid and n_time timesteps, so that all workers together stay within
+    memory_budget bytes (see estimate.py).
+    Without a budget all cores are used and every job runs in one block.
+    '''
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if n_jobs is not None:
+        processes = min(processes, n_jobs)
+    processes = max(processes, 1)
+
+    if memory_budget is None:
+        return processes, None
+
+    if n_time is None:
+        n_time = float('inf')
+    for n in range(processes, 1, -1):
+        try:
+            return n, estimate.choose_block_size(memory_budget/n, n_fine, n_time, regrid_method=regrid_method,
+                                                 min_block_size=min_block_size)
+        except MemoryError:
+            pass
+
+    return 1, estimate.choose_block_size(memory_budget, n_fine, n_time, regrid_method=regrid_method,
+                                         min_block_size=min_block_size)
+
+def worker_pool(processes, initializer, initargs=()):
+    '''
+    Pool of processes worker processes, started with initializer(*initargs).
+    The workers are spawned fresh instead of forked from the (possibly
+    threaded) parent, e.g. the bokeh server.
+    '''
+    ctx = multiprocessing.get_context('spawn')
+    return ctx.Pool(processes, initializer=initializer, initargs=initargs)
+
+def _init_worker(topo_fine, topo_coarse, apply_threads=None):
+    global _topo_fine, _topo_coarse
+    _topo_fine = topo_fine
+    _topo_coarse = topo_coarse
+    if apply_threads is not None:
+        # the cores are shared by all workers (see apply_weights)
+        df.APPLY_THREADS = apply_threads
+
+def _run_job(args):
+    job, kwargs = args
+    tracer = None
+    if kwargs['trace'] is not None:
+        tracer = instrument.Tracer(kwargs['trace'], {'variable': job['variable'], 'path_to_data': job['path_to_data']})
+    try:
+        data_regrid_fn, ds_subset = start_tool(job['variable'], job.get('data_type', kwargs['data_type']),
+                                               job['path_to_data'], _topo_fine, _topo_coarse,
+                                               kwargs['path_save'],
+                                               kwargs['lat_min'], kwargs['lat_max'],
+                                               kwargs['lon_min'], kwargs['lon_max'],
+                                               kwargs['start_year'], kwargs['end_year'],
+                                               regrid_method = kwargs['regrid_method'],
+                                               block_size = kwargs['block_size'],
+                                               output_options = kwargs['output_options'],
+                                               lapse_rate_window = kwargs['lapse_rate_window'],
+                                               force = kwargs['force'],
+                                               append = kwargs['append'],
+                                               output_format = kwargs['output_format'],
+                                               tracer = tracer,
+                                               engine = kwargs['engine'],
+                                               engine_options = kwargs['engine_options'],
+                                               topo_identity = kwargs['topo_identity'])
+        return data_regrid_fn
+    except Exception:
+        print("------------- ERROR -------------")
+        print("{} {}".format(job['variable'], job['path_to_data']))
+        traceback.print_exc()
+        return None
+
+def prepare_weights(jobs, topo_fine, topo_coarse, lat_min, lat_max, lon_min, lon_max, start_year, end_year, regrid_method='patch'):
+    '''
+    Build the regridding weights of every distinct source grid of the jobs once,
+    so the workers only read them from the weight cache.
+    Returns the number of fine grid cells of the largest job.
+    '''
+    grids = set()
+    n_fine = 0
+    for job in jobs:
+        ds = catalog.open_data(job['path_to_data'], job['variable'], start_year, end_year)
+        ds_subset, topo_coarse_subset, topo_fine_subset = subset_inputs(ds, topo_fine, topo_coarse,
+                                                                        lat_min, lat_max, lon_min, lon_max,
+                                                                        start_year, end_year)
+        n_fine = max(n_fine, topo_fine_subset['height'].size)
+        key = cache_utils.hash_grid(ds_subset)
+        if key not in grids:
+            get_regridder(ds_subset, topo_fine_subset, regrid_method)
+            grids.add(key)
+        ds.close()
+    return n_fine
+
+def run_batch(jobs, path_to_topo_fine, path_to_topo_coarse, path_save,
+              lat_min, lat_max, lon_min, lon_max,
+              start_year, end_year,
+              regrid_method = 'patch', data_type = 'model',
+              processes = None, memory_budget = None, block_size = None,
+              output_options = None, lapse_rate_window = None, force = False,
+              output_format = 'netcdf', trace = None, engine = 'numpy', engine_options = None,
+              append = False):
+    '''
+    Downscale many (variable, file) jobs on the same domain and period.
+
+    jobs: list of (variable, path_to_data) tuples or dicts with the keys
+    variable, path_to_data and optionally data_type.
+    processes: number of worker processes (default: number of cores).
+    memory_budget: memory in bytes all workers together may use. The number of
+    workers and the block size of the jobs are chosen to stay within it.
+    block_size: fixed block size of the jobs (overrides the one chosen for the budget).
+    output_options: compression, chunking and packing of the output files
+    (see downscaling_functions.create_data_variable).
+    lapse_rate_window: window size (coarse cells) of local height gradients
+    instead of one gradient for the whole domain (see start_tool).
+    force: recompute results, which are already in the result cache.
+    output_format: 'netcdf' or 'zarr' (see start_tool).
+    trace: file the stage timings of all jobs are appended to as JSON lines
+    (see instrument.py).
+    engine, engine_options: 'dask' downscales every job on a local dask cluster
+    using the whole node (see start_tool), so the jobs run one after the other.
+    append: extend earlier outputs of the jobs by the missing years (see start_tool).
+
+    Returns the filenames of the downscaled data in the order of the jobs
+    (None for failed jobs).
+    '''
+    jobs = [job if isinstance(job, dict) else {'variable': job[0], 'path_to_data': job[1]}
+            for job in jobs]
+    if len(jobs) == 0:
+        return []
+
+    print('...loading topography')
+    topo_fine = load_topo(path_to_topo_fine, lat_min, lat_max, lon_min, lon_max)
+    topo_coarse = load_topo(path_to_topo_coarse, lat_min, lat_max, lon_min, lon_max)
+
+    print('...preparing regridding weights')
+    n_fine = prepare_weights(jobs, topo_fine, topo_coarse, lat_min, lat_max, lon_min, lon_max,
+                             start_year, end_year, regrid_method)
+
+    processes, budget_block_size = plan_workers(n_fine, memory_budget, processes, len(jobs),
+                                                n_time=estimate.n_timesteps(start_year, end_year),
+                                                regrid_method=regrid_method)
+    if block_size is None:
+        block_size = budget_block_size
+
+    kwargs = dict(path_save=path_save, data_type=data_type,
+                  lat_min=lat_min, lat_max=lat_max, lon_min=lon_min, lon_max=lon_max,
+                  start_year=start_year, end_year=end_year,
+                  regrid_method=regrid_method, block_size=block_size,
+                  output_options=output_options, lapse_rate_window=lapse_rate_window,
+                  force=force, append=append, output_format=output_format, trace=trace,
+                  engine=engine, engine_options=engine_options,
+                  topo_identity=(df.input_identity(path_to_topo_fine), df.input_identity(path_to_topo_coarse)))
+
+    if engine == 'dask':
+        print('...downscaling {} jobs with dask'.format(len(jobs)))
+        _init_worker(topo_fine, topo_coarse)
+        return [_run_job((job, kwargs)) for job in jobs]
+
+    print('...downscaling {} jobs with {} processes'.format(len(jobs), processes))
+    apply_threads = max(1, df.APPLY_THREADS//processes)
+    pool = worker_pool(processes, _init_worker, (topo_fine, topo_coarse, apply_threads))
+    try:
+        results = pool.map(_run_job, [(job, kwargs) for job in jobs], chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    return results
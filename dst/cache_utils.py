@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers for the on-disk caches of the climaproof downscaling tool
+(regridding weights, index maps, results, ...).
+
+Cached files are content-addressed: their names are derived from a hash of
+everything they depend on (e.g. source grid, target grid and method), so a
+file can be reused whenever the same key shows up again. Every cache
+directory is capped in size, the least recently used files are removed first.
+"""
+
+import contextlib
+import hashlib
+import os
+import shutil
+import uuid
+import numpy as np
+
+# root directory of all caches, can be changed with the environment variable DST_CACHE_DIR
+CACHE_DIR = os.environ.get('DST_CACHE_DIR',
+                           os.path.join(os.path.expanduser('~'), '.cache', 'climaproof', 'dst'))
+
+# default size limit of one cache directory in bytes
+CACHE_SIZE = int(os.environ.get('DST_CACHE_SIZE', 4*1024**3))
+
+# suffix of cached files while they are written
+TMP_SUFFIX = '.tmp'
+
+# suffix of output files while they are written
+PART_SUFFIX = '.part'
+
+def cache_dir(name, root=None):
+    '''
+    Return (and create) the cache directory for one kind of cached files.
+    '''
+    if root is None:
+        root = CACHE_DIR
+    directory = os.path.join(root, name)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    return directory
+
+def make_key(*parts):
+    '''
+    Hash an arbitrary number of strings, numbers and numpy arrays to a hex key.
+    '''
+    h = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            part = np.ascontiguousarray(part)
+            h.update(str((part.dtype.str, part.shape)).encode())
+            h.update(part.tobytes())
+        else:
+            h.update(repr(part).encode())
+        h.update(b'|')
+    return h.hexdigest()
+
+def hash_grid(ds):
+    '''
+    Hash the horizontal grid (lat/lon and, if present, the cell bounds) of a dataset.
+    '''
+    parts = []
+    for name in ('lat', 'lon', 'lat_b', 'lon_b'):
+        if name in ds.variables:
+            parts.append(np.asarray(ds[name].data, dtype=np.float64))
+    return make_key(*parts)
+
+def touch(path):
+    '''
+    Mark a cached file as recently used.
+    '''
+    try:
+        os.utime(path, None)
+    except(OSError):
+        pass
+
+def evict(directory, max_size=None, keep=()):
+    '''
+    Remove the least recently used files of directory until its size is
+    below max_size bytes. Files in keep and files, which are still written
+    (by other processes as well), are never removed.
+    '''
+    if max_size is None:
+        max_size = CACHE_SIZE
+
+    files = []
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        try:
+            stat = os.stat(path)
+        except(OSError):
+            continue
+        if os.path.isfile(path) and not name.endswith(TMP_SUFFIX):
+            files.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(f[1] for f in files)
+    for mtime, size, path in sorted(files):
+        if total <= max_size:
+            break
+        if path in keep:
+            continue
+        try:
+            os.remove(path)
+            total -= size
+        except(OSError):
+            pass
+
+    return total
+
+@contextlib.contextmanager
+def atomic_write(path):
+    '''
+    Context manager giving a temporary name next to path, which is moved to
+    path when the block is done, so that parallel runs never read incomplete
+    files. The temporary file is removed if the block fails.
+    '''
+    tmp = path+'.'+uuid.uuid4().hex+TMP_SUFFIX
+    try:
+        yield tmp
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def link_or_copy(src, dst):
+    '''
+    Hard link src to dst (or copy it, if linking is not possible), replacing
+    an existing dst atomically.
+    '''
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        return
+    with atomic_write(dst) as tmp:
+        try:
+            os.link(src, tmp)
+        except(OSError, AttributeError):
+            shutil.copy2(src, tmp)
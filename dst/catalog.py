@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+Catalog of multi-file inputs of the climaproof downscaling tool
+--> time series split into several files (e.g. 5-year EURO-CORDEX files)
+
+path_to_data can be a single file, a directory or a glob pattern of netCDF
+files. The catalog keeps an index of the variables, calendar, time range and
+grid of every file in the on-disk cache. A file is only read again if its
+size or modification time has changed, so only the index has to be read to
+find the files overlapping a period. Those files are opened lazily (in dask
+chunks) and concatenated in time.
+"""
+
+import glob
+import json
+import os
+
+import numpy as np
+import xarray as xr
+from netCDF4 import Dataset, num2date
+
+import cache_utils
+
+# time chunk of the lazily opened files (days)
+TIME_CHUNK = 365
+
+def expand(path_to_data):
+    '''
+    Sorted list of the netCDF files of a file, directory or glob pattern.
+    '''
+    if os.path.isfile(path_to_data):
+        return [os.path.abspath(path_to_data)]
+    if os.path.isdir(path_to_data):
+        path_to_data = os.path.join(path_to_data, '*.nc')
+    return sorted(os.path.abspath(fn) for fn in glob.glob(path_to_data) if os.path.isfile(fn))
+
+def file_entry(fn_nc):
+    '''
+    Index entry of a netCDF file: its variables with a time dimension (the 2D
+    fields of files without time, e.g. height of the topography), calendar,
+    first and last timestep, number of timesteps, model name, lat/lon box,
+    resolution (degrees) and a hash of its grid.
+    '''
+    stat = os.stat(fn_nc)
+    nc_fid = Dataset(fn_nc, 'r')
+    try:
+        coords = [np.asarray(nc_fid.variables[name][:], dtype=np.float64)
+                  for name in ('lat', 'lon') if name in nc_fid.variables]
+        entry = {'size': stat.st_size, 'mtime': stat.st_mtime,
+                 'modelname': str(nc_fid.getncattr('modelname')) if 'modelname' in nc_fid.ncattrs() else None,
+                 'grid': cache_utils.make_key(*coords),
+                 'calendar': None, 'n_time': 0, 'start': None, 'end': None, 'start_year': None, 'end_year': None,
+                 'bbox': None, 'resolution': None}
+        if len(coords) == 2:
+            lat, lon = coords
+            entry['bbox'] = [float(np.nanmin(lat)), float(np.nanmax(lat)), float(np.nanmin(lon)), float(np.nanmax(lon))]
+            if lat.shape[0] > 1:
+                entry['resolution'] = float(np.median(np.abs(np.diff(lat, axis=0))))
+
+        if ('time' in nc_fid.variables) and (len(nc_fid.variables['time']) > 0):
+            time = nc_fid.variables['time']
+            calendar = str(getattr(time, 'calendar', 'standard'))
+            n_time = len(time)
+            first, last = num2date(time[[0, n_time-1]], time.units, calendar)
+            entry.update({'calendar': calendar, 'n_time': n_time,
+                          'start': str(first), 'end': str(last),
+                          'start_year': first.year, 'end_year': last.year})
+            entry['variables'] = [name for name, var in nc_fid.variables.items()
+                                  if ('time' in var.dimensions) and (len(var.dimensions) >= 3)]
+        else:
+            entry['variables'] = [name for name, var in nc_fid.variables.items()
+                                  if (len(var.dimensions) == 2) and (name not in ('lat', 'lon'))]
+    finally:
+        nc_fid.close()
+
+    return entry
+
+def index_path(path_to_data):
+    '''
+    Cache file of the index of a directory or glob pattern.
+    '''
+    key = cache_utils.make_key(os.path.abspath(path_to_data))
+    return os.path.join(cache_utils.cache_dir('catalog'), key+'.json')
+
+def build_index(path_to_data):
+    '''
+    Index (dict of file -> file_entry) of the files of path_to_data.
+    The index is kept in the cache, only new and changed files are read.
+    '''
+    fn_index = index_path(path_to_data)
+    cached = {}
+    if os.path.exists(fn_index):
+        try:
+            with open(fn_index) as f:
+                cached = json.load(f)
+        except(ValueError, IOError, OSError):
+            cached = {}
+
+    index = {}
+    for fn in expand(path_to_data):
+        stat = os.stat(fn)
+        entry = cached.get(fn)
+        if (entry is None) or (entry['size'] != stat.st_size) or (entry['mtime'] != stat.st_mtime):
+            entry = file_entry(fn)
+        index[fn] = entry
+
+    if index != cached:
+        with cache_utils.atomic_write(fn_index) as tmp, open(tmp, 'w') as f:
+            json.dump(index, f)
+    cache_utils.touch(fn_index)
+
+    return index
+
+def select(index, variable=None, start_year=0, end_year=0):
+    '''
+    Files of the index with variable, which overlap the years start_year to
+    end_year (all years if both are 0), in the order of their start.
+    Raises ValueError if there are none, if they are of different models,
+    calendars or grids or if their time ranges overlap (e.g. a pattern
+    matching the files of several models).
+    '''
+    files = []
+    for fn, entry in index.items():
+        if entry['n_time'] == 0:
+            continue
+        if (variable is not None) and (variable not in entry['variables']):
+            continue
+        if (start_year or end_year) and ((entry['end_year'] < start_year) or (entry['start_year'] > end_year)):
+            continue
+        files.append(fn)
+    files.sort(key=lambda fn: (index[fn]['start'], fn))
+
+    if len(files) == 0:
+        raise ValueError('No file with {} between {} and {}.'.format(variable, start_year, end_year))
+    if len(set(index[fn]['grid'] for fn in files)) > 1:
+        raise ValueError('The files of {} are on different grids.'.format(variable))
+    if len(set(index[fn].get('modelname') for fn in files)) > 1:
+        raise ValueError('The files of {} are of different models.'.format(variable))
+    if len(set(index[fn]['calendar'] for fn in files)) > 1:
+        raise ValueError('The files of {} have different calendars.'.format(variable))
+    for previous, fn in zip(files[:-1], files[1:]):
+        if index[fn]['start'] <= index[previous]['end']:
+            raise ValueError('The time ranges of {} and {} overlap.'.format(previous, fn))
+    return files
+
+def data_files(path_to_data, variable=None, start_year=0, end_year=0):
+    '''
+    Files of path_to_data (file, directory or glob pattern) needed for the
+    variable and years, see select.
+    '''
+    if os.path.isfile(path_to_data):
+        return [path_to_data]
+    return select(build_index(path_to_data), variable, start_year, end_year)
+
+def open_data(path_to_data, variable=None, start_year=0, end_year=0, chunks=None):
+    '''
+    Open the data of path_to_data (file, directory or glob pattern) for the
+    variable and years as one dataset. A single file is opened like with
+    xr.open_dataset, several files are opened lazily in dask chunks of
+    TIME_CHUNK timesteps (or chunks) and concatenated in time.
+    '''
+    files = data_files(path_to_data, variable, start_year, end_year)
+    if len(files) == 1:
+        return xr.open_dataset(files[0], chunks=chunks)
+
+    if chunks is None:
+        chunks = {'time': TIME_CHUNK}
+    datasets = [xr.open_dataset(fn, chunks=chunks) for fn in files]
+    return xr.concat(datasets, dim='time', data_vars='minimal', coords='minimal')
+
+def identity(path_to_data):
+    '''
+    Path, size and modification time of all files of path_to_data.
+    '''
+    identities = []
+    for fn in expand(path_to_data):
+        stat = os.stat(fn)
+        identities.append((fn, stat.st_size, stat.st_mtime))
+    return identities
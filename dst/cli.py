@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Headless command line interface of the climaproof downscaling tool
+--> runs the downscaling jobs of a YAML or JSON manifest without the bokeh app
+
+    python dst/cli.py manifest.yml [--force] [--append] [--processes N] [--memory-budget 32GB] [--trace trace.jsonl]
+
+Manifest (all top-level settings are defaults, which every job can override):
+
+    topo_fine: /data/topo_fine.nc
+    topo_coarse: /data/topo_coarse.nc
+    output_dir: /data/outp
+    lat: [38, 47]
+    lon: [13, 25]
+    start_year: 1999
+    end_year: 2010
+    regrid_method: patch
+    data_type: model
+    block_size: 365
+    output_options: {zlib: true, complevel: 4, chunking: timeseries, pack: true}
+    lapse_rate_window: 5
+    output_format: netcdf
+    engine: dask
+    engine_options: {workers: 4, threads_per_worker: 8, memory_limit: 16GB, processes: true}
+    jobs:
+      - variable: tasmax
+        path_to_data: /data/tasmax_model_a.nc
+      - variable: pr
+        path_to_data: /data/pr_model_a.nc
+      - variable: tasmax
+        path_to_data: /data/model_b/tasmax_*.nc
+
+Jobs whose output file already exists, is complete and was written with the
+same inputs and settings are skipped, so an interrupted manifest can simply
+be started again. With --append, the outputs
+of an earlier end year are extended by the missing years (e.g. after raising
+end_year in the manifest) instead of downscaling the whole period again.
+"""
+
+import argparse
+import json
+import os
+import sys
+
+import catalog
+import static_products
+from downscaling_functions import cut_domain, output_path, is_complete, input_identity, run_key
+from batch import run_batch
+from estimate import parse_size
+
+# settings a job can inherit from the top level of the manifest
+JOB_SETTINGS = ('topo_fine', 'topo_coarse', 'output_dir', 'lat', 'lon',
+                'start_year', 'end_year', 'regrid_method', 'data_type', 'block_size',
+                'output_options', 'lapse_rate_window', 'output_format', 'engine', 'engine_options')
+
+# settings, which have to be the same for all jobs of one batch
+BATCH_SETTINGS = ('topo_fine', 'topo_coarse', 'output_dir', 'lat', 'lon',
+                  'start_year', 'end_year', 'regrid_method', 'block_size',
+                  'output_options', 'lapse_rate_window', 'output_format', 'engine', 'engine_options')
+
+DEFAULTS = {'regrid_method': 'patch', 'data_type': 'model', 'block_size': None,
+            'output_options': None, 'lapse_rate_window': None, 'output_format': 'netcdf',
+            'engine': 'numpy', 'engine_options': None}
+
+def load_manifest(fn_manifest):
+    '''
+    Read a YAML or JSON manifest and return the list of fully specified jobs.
+    '''
+    with open(fn_manifest) as f:
+        if fn_manifest.lower().endswith('.json'):
+            manifest = json.load(f)
+        else:
+            try:
+                import yaml
+            except(ImportError):
+                sys.exit('Reading YAML manifests requires PyYAML, use a JSON manifest instead.')
+            manifest = yaml.safe_load(f)
+
+    jobs = []
+    for job in manifest['jobs']:
+        settings = dict(DEFAULTS)
+        settings.update({k: manifest[k] for k in JOB_SETTINGS if k in manifest})
+        settings.update(job)
+        missing = [k for k in JOB_SETTINGS+('variable', 'path_to_data') if k not in settings]
+        if missing:
+            sys.exit('Job {} misses the settings: {}'.format(job, ', '.join(missing)))
+        jobs.append(settings)
+
+    return jobs, manifest
+
+def job_output(job):
+    '''
+    Output file of a job and whether it already exists and is complete, i.e.
+    was written by a run of the same inputs and settings (see run_key) on the
+    grid of the domain with all timesteps of the period.
+    '''
+    fn = output_path(job['variable'], job['data_type'], job['path_to_data'],
+                     job['output_dir'], job['start_year'], job['end_year'], job['output_format'])
+    if not os.path.exists(fn):
+        return fn, False
+
+    (lat_min, lat_max), (lon_min, lon_max) = job['lat'], job['lon']
+    topo_identity = (input_identity(job['topo_fine']), input_identity(job['topo_coarse']))
+    key = run_key(input_identity(job['path_to_data']), topo_identity, job['variable'], job['data_type'],
+                  lat_min, lat_max, lon_min, lon_max, job['start_year'], job['end_year'],
+                  job['regrid_method'], job['output_options'], lapse_rate_window=job['lapse_rate_window'])
+
+    ds = catalog.open_data(job['path_to_data'], job['variable'], job['start_year'], job['end_year'])
+    try:
+        ds_subset = cut_domain(ds, lat_min, lat_max, lon_min, lon_max, job['start_year'], job['end_year'])
+        if ds_subset is None:
+            return fn, False
+        # the fine grid of the domain (from the static cache, where the run takes it from as well)
+        static = static_products.domain(ds_subset, job['topo_fine'], job['topo_coarse'],
+                                        lat_min, lat_max, lon_min, lon_max, topo_identity)
+        return fn, is_complete(fn, ds_subset.dims['time'], key,
+                               static.topo_fine['lat'].data, static.topo_fine['lon'].data)
+    finally:
+        ds.close()
+
+def run_manifest(jobs, force=False, processes=None, memory_budget=None, trace=None, append=False):
+    '''
+    Run all jobs, which are not complete yet, in batches of jobs with the same
+    domain, period and topography. Returns a dict of output file -> status.
+    trace: file the stage timings of all jobs are appended to (see instrument.py).
+    append: extend the outputs of an earlier end year (see start_tool).
+    '''
+    status = {}
+    batches = {}
+    for job in jobs:
+        fn, complete = job_output(job)
+        if complete and not force:
+            print('...skipping {} (complete)'.format(fn))
+            status[fn] = 'skipped'
+            continue
+        key = json.dumps([job[k] for k in BATCH_SETTINGS])
+        batches.setdefault(key, []).append(job)
+
+    for batch_jobs in batches.values():
+        settings = batch_jobs[0]
+        if not os.path.exists(settings['output_dir']):
+            os.makedirs(settings['output_dir'])
+
+        results = run_batch(batch_jobs, settings['topo_fine'], settings['topo_coarse'], settings['output_dir'],
+                            settings['lat'][0], settings['lat'][1], settings['lon'][0], settings['lon'][1],
+                            settings['start_year'], settings['end_year'],
+                            regrid_method = settings['regrid_method'],
+                            processes = processes, memory_budget = memory_budget,
+                            block_size = settings['block_size'],
+                            output_options = settings['output_options'],
+                            lapse_rate_window = settings['lapse_rate_window'],
+                            force = force,
+                            append = append,
+                            output_format = settings['output_format'],
+                            trace = trace,
+                            engine = settings['engine'],
+                            engine_options = settings['engine_options'])
+
+        for job, fn in zip(batch_jobs, results):
+            if fn is None:
+                status[job['path_to_data']+' ('+job['variable']+')'] = 'failed'
+            else:
+                status[fn] = 'done'
+
+    return status
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the downscaling jobs of a manifest without the bokeh app.')
+    parser.add_argument('manifest', help='YAML or JSON manifest of downscaling jobs')
+    parser.add_argument('--force', action='store_true',
+                        help='recompute jobs whose output is already complete or cached')
+    parser.add_argument('--append', action='store_true',
+                        help='extend outputs of the same start year and an earlier end year by the missing years')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='number of worker processes (default: manifest or number of cores)')
+    parser.add_argument('--memory-budget', default=None,
+                        help='memory all workers together may use, e.g. 64GB (default: manifest or unlimited)')
+    parser.add_argument('--trace', default=None,
+                        help='append the timing and memory of every stage of every job to this JSON lines file')
+    args = parser.parse_args(argv)
+
+    jobs, manifest = load_manifest(args.manifest)
+    processes = args.processes if args.processes is not None else manifest.get('processes')
+    memory_budget = parse_size(args.memory_budget if args.memory_budget is not None else manifest.get('memory_budget'))
+
+    status = run_manifest(jobs, args.force, processes, memory_budget, args.trace, args.append)
+
+    for fn in sorted(status):
+        print('{:8s} {}'.format(status[fn], fn))
+
+    return 1 if 'failed' in status.values() else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Dask execution mode of the climaproof downscaling tool
+--> one job uses all cores (or processes) of a node
+
+The input is opened lazily in time chunks of block_size timesteps (see
+open_chunked). Every chunk is read, detrended, regridded and coast-filled by
+regrid_block in a task of a local dask cluster, while the calling process
+writes the finished chunks to the output file (netCDF or Zarr) as they come
+in, so the computation overlaps with the I/O. At most MAX_PENDING tasks per
+worker thread are in flight, so the memory stays bounded by the chunk size.
+
+The cluster runs threads (processes=False, the default) or worker processes
+with a memory limit each (see start_client). The results are the same as the
+ones of downscale_blocks in downscaling_functions.
+"""
+
+import itertools
+import multiprocessing
+
+import numpy as np
+import xarray as xr
+import dask
+from dask.distributed import Client, LocalCluster, as_completed
+
+import catalog
+import downscaling_functions as df
+import instrument
+import static_products
+
+# tasks in flight per worker thread
+MAX_PENDING = 2
+
+def open_chunked(path_to_data, block_size, variable=None, start_year=0, end_year=0):
+    '''
+    Open the netCDF file(s) of path_to_data lazily in time chunks of
+    block_size timesteps (see catalog.open_data).
+    '''
+    return catalog.open_data(path_to_data, variable, start_year, end_year, chunks={'time': block_size})
+
+def start_client(workers=None, threads_per_worker=None, memory_limit=None, processes=False):
+    '''
+    Start a local dask cluster and return its client.
+
+    workers: number of workers (default: one per core for processes, one otherwise).
+    threads_per_worker: threads of every worker (default: all cores for threads).
+    memory_limit: memory per worker, e.g. '8GB' (default: the memory of the node
+    divided among the workers); workers above it spill to disk and get restarted.
+    processes: run the workers in processes instead of threads.
+    '''
+    kwargs = {'processes': processes}
+    if workers is not None:
+        kwargs['n_workers'] = workers
+    elif not processes:
+        kwargs['n_workers'] = 1
+    if threads_per_worker is not None:
+        kwargs['threads_per_worker'] = threads_per_worker
+    if memory_limit is not None:
+        kwargs['memory_limit'] = memory_limit
+    return Client(LocalCluster(**kwargs))
+
+def blocks_in_memory(workers=None, threads_per_worker=None, memory_limit=None, processes=False):
+    '''
+    Number of blocks held in memory at once by a cluster of start_client
+    (the tasks in flight and the one being written).
+    '''
+    cores = multiprocessing.cpu_count()
+    if workers is None:
+        workers = cores if processes else 1
+    if threads_per_worker is None:
+        threads_per_worker = max(cores//workers, 1)
+    return MAX_PENDING*workers*threads_per_worker+1
+
+def close_client(client):
+    if client is not None:
+        cluster = client.cluster
+        client.close()
+        cluster.close()
+
+
+class WeightsRegridder(object):
+    """
+    The weight matrix of a regridder, which (unlike the xESMF regridder) can
+    be sent to worker processes. It is used like the xESMF regridders by
+    apply_regridder.
+    """
+
+    def __init__(self, regridder, dtype=np.float64):
+        self.weights = df.regridder_weights(regridder, dtype)
+
+    def apply(self, data, shape_out, dtype=np.float64):
+        # the chunks already run in parallel in the threads of the workers
+        return df.apply_weights(self.weights.astype(dtype, copy=False), data, shape_out, dtype, threads=1)
+
+
+def _downscale_chunk(values, time, variable, static, regridder, grad, dtype, grad_fine, trace):
+    data = xr.Dataset({variable: (('time', 'lat', 'lon'), values)}, coords={'time': time})
+    tracer = instrument.Tracer() if trace else None
+    data_regrid = df.regrid_block(data, static.topo_coarse, static.topo_fine, variable, regridder, grad, dtype,
+                                  grad_fine, tracer, static)
+    return data_regrid, (tracer.spans if trace else [])
+
+def downscale_blocks(data, topo_coarse, topo_fine, variable, regridder, client, block_size=None,
+                     dtype=np.float32, lapse_rate_window=None, tracer=None, grad=None, static=None):
+    '''
+    Generator over the downscaled time blocks of data (opened with
+    open_chunked) like downscaling_functions.downscale_blocks, but the blocks
+    are downscaled in parallel on the cluster of client and yielded in the
+    order they are finished.
+    The spans of the blocks are added to tracer as they come in.
+    grad/static: gradients fitted before and static_products.StaticProducts of
+    the domain (see downscaling_functions.downscale_blocks).
+    Yields (t0, data_regrid) with t0 the index of the first timestep of the block.
+    '''
+    n_time = data.dims['time']
+    if block_size is None:
+        block_size = n_time
+    if tracer is None:
+        tracer = instrument.NULL_TRACER
+
+    if static is None:
+        static = static_products.StaticProducts(topo_fine, topo_coarse)
+
+    grad_fine = None
+    if variable in df.DETREND_VARIABLES:
+        with tracer.span('gradients', data=data[variable]) as span:
+            if grad is None:
+                grad = df.monthly_gradients(data, topo_coarse, variable, block_size, lapse_rate_window)
+            if lapse_rate_window is not None:
+                grad_fine = df.apply_regridder(regridder, grad, topo_fine['height'].shape)
+            span.add(grad=grad)
+
+    # everything the blocks have in common is sent to the workers once
+    # (with the heights already converted to dtype)
+    static.heights(dtype)
+    shared = client.scatter([static, WeightsRegridder(regridder, dtype), grad, grad_fine], broadcast=True)
+    values = data[variable].data
+    time = data['time'].data
+    trace = tracer is not instrument.NULL_TRACER
+
+    def submit(t0):
+        task = dask.delayed(_downscale_chunk)(values[t0:t0+block_size], time[t0:t0+block_size], variable,
+                                              shared[0], shared[1], shared[2], dtype, shared[3], trace)
+        future = client.compute(task)
+        starts[future.key] = t0
+        return future
+
+    starts = {}
+    blocks = iter(range(0, n_time, block_size))
+    max_pending = MAX_PENDING*sum(client.nthreads().values())
+    pending = as_completed([submit(t0) for t0 in itertools.islice(blocks, max_pending)])
+    for future in pending:
+        data_regrid, spans = future.result()
+        t0 = starts.pop(future.key)
+        future.release()
+        for span in spans:
+            span['info']['t0'] = t0
+            tracer.record(span)
+        for t_next in blocks:
+            pending.add(submit(t_next))
+            break
+        yield t0, data_regrid
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""
+SQLite catalog of the data directory of the climaproof downscaling tool
+--> the browser tool only offers the files which fit the chosen inputs
+
+A background Scanner indexes every netCDF file below the data directory into
+an SQLite database in the cache, one row per file and variable with the model
+name, calendar, time coverage, lat/lon box, resolution and grid hash of the
+file (see catalog.file_entry). The directory is scanned again every
+SCAN_INTERVAL seconds, unchanged files (same size and modification time) are
+not opened again. The queries (find_data, find_topo) only read the database,
+so they can run on every change of the inputs.
+"""
+
+import fnmatch
+import glob
+import os
+import sqlite3
+import threading
+import traceback
+
+import cache_utils
+import catalog
+
+# seconds between two scans of the data directory
+SCAN_INTERVAL = 60
+
+# relative tolerance of the resolution of topography files
+RESOLUTION_TOLERANCE = 0.2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT NOT NULL,
+    variable TEXT NOT NULL,
+    size INTEGER,
+    mtime REAL,
+    modelname TEXT,
+    calendar TEXT,
+    n_time INTEGER,
+    start_time TEXT,
+    end_time TEXT,
+    start_year INTEGER,
+    end_year INTEGER,
+    lat_min REAL,
+    lat_max REAL,
+    lon_min REAL,
+    lon_max REAL,
+    resolution REAL,
+    grid TEXT,
+    PRIMARY KEY (path, variable)
+)
+"""
+
+# scanners of the server process, one per data directory
+_scanners = {}
+_scanners_lock = threading.Lock()
+
+def database_path(directory):
+    '''
+    SQLite database of the catalog of directory (in the cache).
+    '''
+    key = cache_utils.make_key(os.path.abspath(directory))
+    return os.path.join(cache_utils.cache_dir('catalog'), key+'.sqlite')
+
+def connect(directory):
+    '''
+    Open (and create) the catalog database of directory.
+    '''
+    connection = sqlite3.connect(database_path(directory), timeout=30)
+    # readers do not wait for a running scan
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute(SCHEMA)
+    return connection
+
+def netcdf_files(directory):
+    '''
+    All netCDF files below directory.
+    '''
+    for root, dirs, files in os.walk(directory):
+        for name in files:
+            if name.endswith('.nc') and not name.startswith('.'):
+                yield os.path.join(root, name)
+
+def scan(directory):
+    '''
+    Bring the catalog of directory up to date: index new and changed files,
+    remove the ones which are gone. Returns the number of indexed files.
+    '''
+    connection = connect(directory)
+    try:
+        known = {path: (size, mtime) for path, size, mtime in
+                 connection.execute('SELECT DISTINCT path, size, mtime FROM files')}
+        found = set()
+        n_indexed = 0
+        for path in netcdf_files(directory):
+            found.add(path)
+            try:
+                stat = os.stat(path)
+            except(OSError):
+                continue
+            if known.get(path) == (stat.st_size, stat.st_mtime):
+                continue
+            try:
+                entry = catalog.file_entry(path)
+            except Exception:
+                # e.g. files which are still being written
+                print('...skipping {} in the data catalog'.format(path))
+                continue
+            bbox = entry['bbox'] if entry['bbox'] is not None else [None]*4
+            # files without variables are kept with an empty one, so they are not opened again
+            with connection:
+                connection.execute('DELETE FROM files WHERE path = ?', (path,))
+                connection.executemany('INSERT INTO files VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)',
+                                       [(path, variable, entry['size'], entry['mtime'], entry['modelname'],
+                                         entry['calendar'], entry['n_time'], entry['start'], entry['end'],
+                                         entry['start_year'], entry['end_year'],
+                                         bbox[0], bbox[1], bbox[2], bbox[3], entry['resolution'], entry['grid'])
+                                        for variable in (entry['variables'] or [''])])
+            n_indexed += 1
+
+        with connection:
+            connection.executemany('DELETE FROM files WHERE path = ?', [(path,) for path in set(known)-found])
+    finally:
+        connection.close()
+
+    return n_indexed
+
+def _query(directory, columns, where, parameters):
+    connection = connect(directory)
+    try:
+        rows = connection.execute('SELECT DISTINCT '+', '.join(columns)+' FROM files WHERE '+' AND '.join(where)+
+                                  ' ORDER BY path', parameters).fetchall()
+    finally:
+        connection.close()
+    return rows
+
+def _grid_condition(where, parameters, resolution=None, lat=None, lon=None):
+    # the resolution of the file has to match and its lat/lon box has to contain the chosen one
+    if resolution is not None:
+        where.append('abs(resolution - ?) <= ?')
+        parameters += [resolution, RESOLUTION_TOLERANCE*resolution]
+    if lat is not None:
+        where += ['lat_min <= ?', 'lat_max >= ?']
+        parameters += [min(lat), max(lat)]
+    if lon is not None:
+        where += ['lon_min <= ?', 'lon_max >= ?']
+        parameters += [min(lon), max(lon)]
+
+def series_pattern(paths, others):
+    '''
+    Glob pattern matching all paths of a series of split files, but none of
+    the others (files of other series in the same directory), or None.
+    '''
+    names = [os.path.basename(path) for path in paths]
+    prefix = os.path.commonprefix(names)
+    suffix = os.path.commonprefix([name[len(prefix):][::-1] for name in names])[::-1]
+    pattern = os.path.join(os.path.dirname(paths[0]), glob.escape(prefix)+'*'+glob.escape(suffix))
+    if any(fnmatch.fnmatchcase(os.path.basename(path), prefix+'*'+suffix) for path in others):
+        return None
+    return pattern
+
+def find_data(directory, variable=None, lat=None, lon=None, start_year=None, end_year=None, resolution=None):
+    '''
+    Inputs (files or glob patterns relative to directory) with variable, whose
+    lat/lon box contains the lat/lon ranges and whose time coverage includes
+    start_year to end_year (with resolution: on a grid of about this
+    resolution in degrees).
+    The files of one directory with the same model, calendar and grid form a
+    series (e.g. 5-year files), whose time coverage is the one of all its
+    files together. Series of several files are offered as glob pattern
+    (of which catalog.select only opens the files overlapping the years).
+    '''
+    where, parameters = ['n_time > 0'], []
+    if variable is not None:
+        where.append('variable = ?')
+        parameters.append(variable)
+    _grid_condition(where, parameters, resolution, lat, lon)
+    rows = _query(directory, ('path', 'modelname', 'calendar', 'grid', 'start_year', 'end_year'), where, parameters)
+
+    series = {}
+    for path, modelname, calendar, grid, first, last in rows:
+        series.setdefault((os.path.dirname(path), modelname, calendar, grid), []).append((path, first, last))
+
+    found = []
+    for key, files in sorted(series.items(), key=lambda item: item[1][0][0]):
+        years = set()
+        for path, first, last in files:
+            years.update(range(first, last+1))
+        if not years.issuperset(range(start_year if start_year is not None else min(years),
+                                      (end_year if end_year is not None else max(years))+1)):
+            continue
+        paths = [path for path, first, last in files]
+        if len(paths) == 1:
+            found.append(paths[0])
+            continue
+        # files of the variable in the directory, which are not part of the series
+        where_others, parameters_others = ['n_time > 0', 'path LIKE ?'], [os.path.join(key[0], '%')]
+        if variable is not None:
+            where_others.append('variable = ?')
+            parameters_others.append(variable)
+        others = [row[0] for row in _query(directory, ('path',), where_others, parameters_others)
+                  if (os.path.dirname(row[0]) == key[0]) and (row[0] not in paths)]
+        pattern = series_pattern(paths, others)
+        if pattern is not None:
+            found.append(pattern)
+    return [os.path.relpath(path, directory) for path in found]
+
+def find_topo(directory, resolution, lat=None, lon=None):
+    '''
+    Topography files (relative to directory) with a height field of about
+    the resolution (degrees), whose lat/lon box contains the lat/lon ranges.
+    '''
+    where, parameters = ['n_time = 0', "variable = 'height'"], []
+    _grid_condition(where, parameters, resolution, lat, lon)
+    return [os.path.relpath(row[0], directory) for row in _query(directory, ('path',), where, parameters)]
+
+
+class Scanner(threading.Thread):
+    """
+    Background thread scanning directory every interval seconds.
+    """
+
+    def __init__(self, directory, interval=SCAN_INTERVAL):
+        threading.Thread.__init__(self, name='dst-catalog-scanner')
+        self.daemon = True
+        self.directory = directory
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                scan(self.directory)
+            except Exception:
+                print("------------- ERROR -------------")
+                traceback.print_exc()
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+
+def start_scanner(directory, interval=SCAN_INTERVAL):
+    '''
+    Start the scanner of directory, if it is not running yet in this process,
+    and return it.
+    '''
+    with _scanners_lock:
+        if directory not in _scanners:
+            _scanners[directory] = Scanner(directory, interval)
+            _scanners[directory].start()
+        return _scanners[directory]
@@ -9,17 +9,111 @@ Functions for the climaproof downscaling tool
 This script uses python 3 (python3 environment of miniconda)!
 """
 
-import matplotlib.pyplot as plt
 import numpy as np
 import xarray as xr
 import xesmf as xe
 from scipy import ndimage as nd
+import scipy.sparse as sps
 import warnings; warnings.simplefilter('ignore')
 
 from netCDF4 import Dataset
 from netCDF4 import date2num, num2date
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+import glob
+import multiprocessing
 import os
+import shutil
+import weakref
+
+import cache_utils
+import catalog
+import estimate
+import instrument
+import regression
+import pyramid
+from cache_utils import PART_SUFFIX
+
+# global attribute of the outputs with the key of their run (see run_key)
+RUN_KEY_ATTR = 'run_key'
+
+# global attributes of all output files
+PROJECT = "Climaproof, funded by the Austrian Development Agency (ADA) and co-funded by the United Nations Environmental Programme (UNEP)"
+SOURCE = "Climaproof Downscaling Tool (Institute of Meteorology, University of Natural Resources and Life Sciences, Vienna, Austria)"
+COMMENT = "Data downscaled from 0.1° to 0.01° resolution with xESMF Python package (based on the regridding method by Earth System Modelling Framework (ESMF))"
+
+# bytes of the regridded timesteps of one batch of apply_weights and threads
+# applying the batches, can be changed with the environment variable DST_APPLY_THREADS
+APPLY_BATCH_BYTES = 16*1024**2
+APPLY_THREADS = int(os.environ.get('DST_APPLY_THREADS', multiprocessing.cpu_count()))
+
+# largest difference (in the units of the variable) of the results computed
+# in float32 to the ones in float64 accepted by the validation of downscale_blocks
+VALIDATE_TOLERANCE = 0.01
+
+# attributes of the downscaled parameters and their defaults for the output:
+# pack is the (scale_factor, add_offset) of the optional int16 packing
+PARAMETERS = {
+    'pr': {'units': 'mm',
+           'long_name': 'total daily precipitation',
+           'standard_name': 'precipitation_amount',
+           'title': 'daily precipitation amount',
+           'message': '...writing pr',
+           'pack': (0.01, 320.)},
+    'tasmax': {'units': 'degree_Celsius',
+               'long_name': 'daily maximum near-surface air temperature',
+               'standard_name': 'air_temperature',
+               'title': 'daily maximum temperature',
+               'message': '...writing tmax',
+               'pack': (0.01, 0.)},
+    'tasmin': {'units': 'degres_Celsius',
+               'long_name': 'daily minimum near-surface air temperature',
+               'standard_name': 'air_temperature',
+               'title': 'daily minimum temperature',
+               'message': '...writing tmin',
+               'pack': (0.01, 0.)},
+    'rsds': {'units': 'W m-2',
+             'long_name': 'surface downwelling shortwave flux',
+             'standard_name': 'surface_downwelling_shortwave_flux_in_air',
+             'title': 'daily mean global radiation',
+             'message': '...writing rsds',
+             'pack': (0.02, 650.)},
+    'sfcWind': {'units': 'm s-1',
+                'long_name': 'daily mean 10-m wind speed',
+                'standard_name': 'wind_speed',
+                'title': 'daily mean 10-m wind speed',
+                'message': None,
+                'pack': (0.001, 32.)},
+    'hurs': {'units': 'percent',
+             'long_name': 'daily mean relative humidity',
+             'standard_name': 'relative_humidity',
+             'title': 'daily mean relative humidity',
+             'message': None,
+             'pack': (0.002, 64.)},
+}
+
+# names of the parameters in observational datasets
+OBS_PARAMETERS = {'rr': 'pr', 'tmax': 'tasmax', 'tmin': 'tasmin'}
+
+# chunk shapes (time, lat, lon) of the output, None is the whole dimension:
+# 'map' for reading single days, 'timeseries' for reading the time series of points
+CHUNK_SHAPES = {'map': (1, None, None),
+                'timeseries': (365, 32, 32)}
+
+# time units of the output
+TIME_UNITS = 'days since 1950-01-01T00:00:00Z'
+
+# fill value of packed (int16) output
+PACKED_FILL_VALUE = -32767
+
+# months of the seasons of the climatology files
+SEASONS = (('DJF', (12, 1, 2)), ('MAM', (3, 4, 5)), ('JJA', (6, 7, 8)), ('SON', (9, 10, 11)))
+
+# suffix of the climatology file written next to every output file
+CLIMATOLOGY_SUFFIX = '_clim.nc'
+
+# variables with a height dependency, which is removed before regridding
+DETREND_VARIABLES = ('tasmax', 'tasmin', 'rsds', 'sfcWind', 'hurs')
 
 def check_domain(data, lat_min, lat_max, lon_min, lon_max):
     '''
@@ -30,11 +124,37 @@ def check_domain(data, lat_min, lat_max, lon_min, lon_max):
         err = 1   
     return err
 
+def index_range(coord, vmin, vmax):
+    '''
+    Slice of the indices of the sorted (ascending or descending) 1D coordinate
+    coord with vmin <= coord <= vmax.
+    '''
+    values = np.asarray(coord)
+    n = len(values)
+    if (n < 2) | (values[0] <= values[-1]):
+        return slice(np.searchsorted(values, vmin, side='left'),
+                     np.searchsorted(values, vmax, side='right'))
+    else:
+        values = values[::-1]
+        return slice(n-np.searchsorted(values, vmax, side='right'),
+                     n-np.searchsorted(values, vmin, side='left'))
+
 def cut_domain(ds, lat_min, lat_max, lon_min, lon_max, start_y=0, end_y=0):
+    '''
+    Cut the lat/lon box (and the years start_y to end_y) out of ds.
+    
+    For 1D lat/lon dimension coordinates only the index ranges of the box are
+    selected, so nothing is read from disk until the subset is used and then
+    only the hyperslab of the box.
+    '''
     err = check_domain(ds, lat_min, lat_max, lon_min, lon_max)
     
     if err == 0:
-        ds_cut = ds.where(((ds['lon'] >= lon_min) & (ds['lon'] <= lon_max) & (ds['lat'] >= lat_min) & (ds['lat'] <= lat_max)), drop=True)
+        if (ds['lat'].dims == ('lat',)) & (ds['lon'].dims == ('lon',)):
+            ds_cut = ds.isel(lat=index_range(ds['lat'], lat_min, lat_max),
+                             lon=index_range(ds['lon'], lon_min, lon_max))
+        else:
+            ds_cut = ds.where(((ds['lon'] >= lon_min) & (ds['lon'] <= lon_max) & (ds['lat'] >= lat_min) & (ds['lat'] <= lat_max)), drop=True)
         
         if (start_y == 0) | (end_y == 0):
             return ds_cut        
@@ -50,17 +170,12 @@ def cut_domain(ds, lat_min, lat_max, lon_min, lon_max, start_y=0, end_y=0):
     return ds_cut
 
 def linreg(data, topo, plot_opt=False):
-    # remove nans
-    nans = np.isnan(data)
-    data_reg = data[~nans]
-    topo_reg = topo[~nans]   
-    # linear regression
-    A = np.vstack([topo_reg, np.ones(len(data_reg))]).T
-    linreg = np.linalg.lstsq(A, data_reg, rcond=None)
-    gradient ,constant = linreg[0]
+    # linear regression without the nan cells
+    gradient, constant = regression.fit(np.ravel(topo), np.ravel(data))
     
     if plot_opt == True:
         #testplot of regression
+        import matplotlib.pyplot as plt
         plt.figure()
         plt.scatter(topo, data)
         plt.plot(gradient*np.arange(0,2200,1)+constant, color='red')
@@ -96,88 +211,798 @@ def fill(data, topo_mask, invalid=None):
     
     return data_masked
 
-def regrid_data(data, topo_coarse, topo_fine, variable, regrid_method = 'patch'):
+def _months(data):
+    '''
+    Month (1-12) of every timestep of data as a numpy array.
+    '''
+    try:
+        return data['time.month'].data
+    except(AttributeError):
+        return data['time'].dt.month.data
+
+def accumulate_months(sums, counts, values, months, missing_value=None):
+    '''
+    Add the values (time, ...) of the months (1-12) of their timesteps to the
+    monthly sums and counts (12, ...) in place. nan values (and missing_value)
+    are left out.
+    '''
+    values = values.reshape((len(months),)+sums.shape[1:])
     
-    if (variable == 'tasmax') | (variable == 'tasmin') | (variable == 'rsds') | (variable == 'sfcWind') | (variable == 'hurs'):
-        # remove height dependency before regridding and add afterwards
-        try:
-            data.coords['month'] = data['time.month']
-        except(AttributeError):
-            data.coords['month'] = data['time.dt.month']
-        
-        grad = np.zeros((12,1))*np.nan
-        c = np.zeros((12,1))*np.nan
-        
-        topo_1d = topo_coarse['height'].data.reshape(np.size(topo_coarse['height']),1)
-        
-        data_det = data.copy(deep=True)
+    # one month at a time, so only a month of the block is copied (and
+    # summed up in float64) at once
+    for month in np.unique(months):
+        month_values = values[months == month]
+        valid = ~np.isnan(month_values)
+        if missing_value is not None:
+            valid &= month_values != missing_value
+        sums[month-1] += np.where(valid, month_values, 0).sum(axis=0, dtype=np.float64)
+        counts[month-1] += np.count_nonzero(valid, axis=0)
+
+def monthly_sums(data, variable, block_size=None):
+    '''
+    Sums and counts of the valid values of data[variable] per month of the year
+    (both of shape (12, lat, lon)).
+    The sums are accumulated over time blocks of block_size timesteps, so only
+    one block has to be held in memory at a time.
+    '''
+    n_time = data.dims['time']
+    if block_size is None:
+        block_size = n_time
+    
+    sums = np.zeros((12,)+data[variable].shape[1:])
+    counts = np.zeros((12,)+data[variable].shape[1:])
+    
+    for t0 in range(0, n_time, block_size):
+        block = data.isel(time=slice(t0, t0+block_size))
+        accumulate_months(sums, counts, block[variable].values, _months(block))
+    
+    return sums, counts
+
+def monthly_means(data, variable, block_size=None):
+    '''
+    Multi-year monthly means of data[variable] (shape (12, lat, lon)).
+    For a list of variables the means of all of them are returned at once
+    (shape (variables, 12, lat, lon)).
+    '''
+    if isinstance(variable, (list, tuple)):
+        return np.stack([monthly_means(data, v, block_size) for v in variable])
+    
+    sums, counts = monthly_sums(data, variable, block_size)
+    
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return sums/counts
+
+def climatology(sums, counts):
+    '''
+    Monthly (12, ...) and seasonal (4, ..., in the order of SEASONS) means
+    from the monthly sums and counts of accumulate_months.
+    '''
+    with np.errstate(invalid='ignore', divide='ignore'):
+        monthly = sums/counts
+        seasonal = np.stack([sums[[m-1 for m in months]].sum(axis=0)/counts[[m-1 for m in months]].sum(axis=0)
+                             for season, months in SEASONS])
+    return monthly, seasonal
+
+def monthly_gradients(data, topo_coarse, variable, block_size=None, window=None):
+    '''
+    Fit the monthly height dependency (gradient per metre) of data[variable]
+    against the coarse topography.
+    
+    The least-squares fits of all 12 months (and of all variables, if variable
+    is a list) are solved together in closed form, cells with nan values are
+    left out per month. Returns an array of shape (12,) or (variables, 12).
+    With window, the local gradient of every coarse cell is fitted in a moving
+    window of window x window cells instead (shape (12, lat, lon) or
+    (variables, 12, lat, lon)).
+    '''
+    month_mean = monthly_means(data, variable, block_size)
+    return fit_gradients(month_mean, topo_coarse['height'].data, window)
+
+def fit_gradients(month_mean, height, window=None):
+    '''
+    Fit the gradients of the monthly means month_mean (12, lat, lon) against
+    the coarse height (lat, lon), see monthly_gradients.
+    '''
+    if window is not None:
+        return regression.local_fit(height, month_mean, window)
+    
+    return regression.fit(height.reshape(-1), month_mean.reshape(month_mean.shape[:-2]+(-1,)))[0]
+
+# CSR weight matrices of the regridders of the current process by dtype,
+# kept as long as their regridder exists
+_csr_weights = weakref.WeakKeyDictionary()
+
+def regridder_weights(regridder, dtype=np.float64):
+    '''
+    Weight matrix (N_out, N_in) of an xESMF regridder as scipy CSR matrix of
+    dtype. The converted matrices are kept in memory as long as the regridder.
+    Explicit zero weights are kept like in regridder.A of xESMF 0.1.1, so
+    missing values spread to the fine grid exactly as with regridder(...).
+    '''
+    converted = _csr_weights.setdefault(regridder, {})
+    key = np.dtype(dtype).str
+    if key not in converted:
+        weights = regridder.weights if hasattr(regridder, 'weights') else regridder.A
+        if isinstance(weights, xr.DataArray):
+            weights = weights.data.to_scipy_sparse()
+        weights = sps.csr_matrix(weights).astype(dtype)
+        converted[key] = weights
+    return converted[key]
+
+def apply_weights(weights, data, shape_out, dtype=np.float64, threads=None):
+    '''
+    Regrid the numpy array data (..., lat, lon) to shape_out (lat, lon) with
+    the CSR weight matrix of regridder_weights, computing in dtype.
+    
+    The timesteps are regridded in batches of about APPLY_BATCH_BYTES of
+    output in threads threads (default APPLY_THREADS, the sparse products
+    release the GIL). The product of every batch is copied into its slice of
+    the preallocated result, so besides the result only one batch per thread
+    is held in memory. Every value is summed over its weights in the same
+    order as in one product of the whole array, so the results do not depend
+    on the batches or threads.
+    '''
+    if threads is None:
+        threads = APPLY_THREADS
+    data_flat = np.asarray(data, dtype=dtype).reshape(-1, weights.shape[1])
+    n = data_flat.shape[0]
+    data_regrid = np.empty((n, weights.shape[0]), dtype=dtype)
+    batch = max(1, APPLY_BATCH_BYTES//(weights.shape[0]*data_regrid.itemsize))
+    
+    def apply(t0):
+        data_regrid[t0:t0+batch] = weights.dot(data_flat[t0:t0+batch].T).T
+    
+    starts = range(0, n, batch)
+    if (threads > 1) and (len(starts) > 1):
+        with ThreadPoolExecutor(min(threads, len(starts))) as executor:
+            list(executor.map(apply, starts))
+    else:
+        for t0 in starts:
+            apply(t0)
+    
+    return data_regrid.reshape(data.shape[:-2]+tuple(shape_out))
+
+def apply_regridder(regridder, data, shape_out, dtype=np.float64, threads=None):
+    '''
+    Regrid the numpy array data (..., lat, lon) to shape_out (lat, lon) of the
+    fine grid, computing in dtype (in threads threads, see apply_weights).
+    '''
+    if hasattr(regridder, 'apply'):
+        # tiled regridder (see tiling.py)
+        return regridder.apply(data, shape_out, dtype)
+    return apply_weights(regridder_weights(regridder, dtype), data, shape_out, dtype, threads)
+
+def regrid_block(data, topo_coarse, topo_fine, variable, regridder, grad=None, dtype=np.float32,
+                 grad_fine=None, tracer=None, static=None):
+    '''
+    Downscale one time block of the coarse data:
+    detrend -> regrid -> coast-fill -> re-trend.
+    
+    grad are the monthly gradients of monthly_gradients. If None, the data is
+    regridded without removing the height dependency. For local gradients
+    (shape (12, lat, lon)) grad_fine are the gradients regridded to the fine grid.
+    dtype is the floating point type of all intermediate arrays.
+    tracer: instrument.Tracer timing the stages of the block (optional).
+    static: static_products.StaticProducts of the domain, whose land mask and
+    heights in dtype are used instead of deriving them again for every block.
+    Returns a numpy array (time, lat, lon) of dtype on the fine grid.
+    '''
+    if tracer is None:
+        tracer = instrument.NULL_TRACER
+    
+    with tracer.span('read') as span:
+        values = data[variable].values.astype(dtype, copy=False)
+        span.add(data=values)
+    if static is not None:
+        height_coarse, height_fine = static.heights(dtype)
+        topo_mask = static.topo_mask
+    else:
+        height_coarse = topo_coarse['height'].data.astype(dtype, copy=False)
+        height_fine = topo_fine['height'].data.astype(dtype, copy=False)
+        topo_mask = None
+    
+    if grad is not None:
+        # remove height dependency before regridding and add afterwards,
+        # using the gradient of the month of every timestep
+        with tracer.span('detrend', data=values, grad=grad):
+            months = _months(data)
+            grad = grad.astype(dtype)
+            data_det = np.empty_like(values)
+            for month in np.unique(months):
+                data_det[months == month] = values[months == month]-grad[month-1]*height_coarse
         
-        for month in range(0,12):
-            
-            # get data for month
-            month_data = data[variable][data['month']==month+1,:,:]
-            month_mean = month_data.mean(dim='time', skipna=True)  
-            data_1d = month_mean.data.reshape(np.size(month_mean),1)
-            
-            grad[month], c[month] = linreg(data_1d, topo_1d)
-            
-            data_det[variable][data['month']==month+1,:,:] = month_data - (grad[month]* topo_coarse['height'])  
-            
-        regridder = xe.Regridder(data_det, topo_fine, regrid_method)
-        data_regrid_tmp = regridder(data_det[variable])
+        with tracer.span('regrid', data=data_det) as span:
+            data_regrid_tmp = apply_regridder(regridder, data_det, height_fine.shape, dtype)
+            span.add(data_regrid=data_regrid_tmp)
+        del data_det
         
-        data_masked = correct_coast(data_regrid_tmp.data, topo_fine)
+        with tracer.span('coast fill', data_regrid=data_regrid_tmp):
+            data_regrid = correct_coast(data_regrid_tmp, topo_fine, topo_mask=topo_mask)
+        del data_regrid_tmp
         
-        data_regrid = np.ones_like(data_regrid_tmp)*np.nan
-        for month in range(0,12):
-            data_regrid[data['month']==month+1,:,:] = data_masked[data['month']==month+1,:,:] + (grad[month]* topo_fine['height'].data)  
-            
-    else:    
-        regridder = xe.Regridder(data, topo_fine, regrid_method)
-        data_regrid_tmp = regridder(data[variable])  
+        with tracer.span('re-trend', data_regrid=data_regrid, grad=grad):
+            # one trend field per month, added to all timesteps of the month at once
+            for month in np.unique(months):
+                if grad_fine is None:
+                    trend = grad[month-1]*height_fine
+                else:
+                    trend = grad_fine[month-1].astype(dtype)*height_fine
+                data_regrid[months == month] += trend
+    
+    else:
+        with tracer.span('regrid', data=values) as span:
+            data_regrid_tmp = apply_regridder(regridder, values, height_fine.shape, dtype)
+            span.add(data_regrid=data_regrid_tmp)
         
-        data_regrid = correct_coast(data_regrid_tmp.data, topo_fine)
+        with tracer.span('coast fill', data_regrid=data_regrid_tmp):
+            data_regrid = correct_coast(data_regrid_tmp, topo_fine, topo_mask=topo_mask)
     
     if variable == 'pr':
         # set eventual negative values to 0
         data_regrid[data_regrid<0] = 0
     
-    regridder.clean_weight_file()
+    return data_regrid
+
+def downscale_blocks(data, topo_coarse, topo_fine, variable, regridder, block_size=None,
+                     dtype=np.float32, validate=False, lapse_rate_window=None, tracer=None,
+                     grad=None, static=None):
+    '''
+    Generator over fixed-size time blocks of the downscaled data.
+    
+    The monthly gradients are fitted once over the whole period, afterwards
+    every block of block_size timesteps is passed separately through
+    cut -> detrend -> regrid -> coast-fill -> re-trend, so the peak memory is
+    set by the block size instead of the period length.
+    With lapse_rate_window, a local gradient is fitted for every coarse cell in a
+    window of lapse_rate_window x lapse_rate_window cells instead of one for
+    the whole domain (see monthly_gradients).
+    dtype is the floating point type used for the computation. With validate,
+    every block is computed in float64 as well (see dtype_difference), its
+    difference is recorded in a 'validate' span of the tracer and ValueError
+    is raised if it exceeds VALIDATE_TOLERANCE.
+    tracer: instrument.Tracer timing the stages of every block (optional).
+    grad: gradients fitted before (e.g. cached, see static_products.py), which
+    are used instead of fitting them again.
+    static: static_products.StaticProducts of the domain (see regrid_block).
+    Yields (t0, data_regrid) with t0 the index of the first timestep of the block.
+    '''
+    n_time = data.dims['time']
+    if block_size is None:
+        block_size = n_time
+    if tracer is None:
+        tracer = instrument.NULL_TRACER
+    
+    grad_fine = None
+    if variable in DETREND_VARIABLES:
+        with tracer.span('gradients', data=data[variable]) as span:
+            if grad is None:
+                grad = monthly_gradients(data, topo_coarse, variable, block_size, lapse_rate_window)
+            if lapse_rate_window is not None:
+                grad_fine = apply_regridder(regridder, grad, topo_fine['height'].shape)
+            span.add(grad=grad)
+    
+    for t0 in range(0, n_time, block_size):
+        block = data.isel(time=slice(t0, t0+block_size))
+        data_regrid = regrid_block(block, topo_coarse, topo_fine, variable, regridder, grad, dtype, grad_fine, tracer,
+                                   static)
+        
+        if validate:
+            with tracer.span('validate', t0=t0) as span:
+                max_diff = dtype_difference(data_regrid, block, topo_coarse, topo_fine, variable, regridder, grad,
+                                            grad_fine, static)
+                span.add(max_diff=max_diff)
+            if max_diff > VALIDATE_TOLERANCE:
+                raise ValueError('The {} results differ from the float64 ones by up to {} (more than {}), '
+                                 'please compute in float64.'.format(np.dtype(dtype).name, max_diff, VALIDATE_TOLERANCE))
+        
+        yield t0, data_regrid
+
+def dtype_difference(data_regrid, block, topo_coarse, topo_fine, variable, regridder, grad=None, grad_fine=None,
+                     static=None):
+    '''
+    Maximum absolute difference of data_regrid, the time block block downscaled
+    by regrid_block in a lower precision, to the block downscaled in float64
+    (0 for blocks without valid values).
+    '''
+    reference = regrid_block(block, topo_coarse, topo_fine, variable, regridder, grad, np.float64, grad_fine,
+                             static=static)
+    diff = np.abs(data_regrid-reference)
+    # np.nanmax fails on blocks without valid values
+    if np.isnan(diff).all():
+        return 0.
+    return float(np.nanmax(diff))
+
+def get_regridder(data, topo_fine, regrid_method, weight_cache=True, tiles=None, processes=None):
+    '''
+    Build the xESMF regridder from the grid of data to the grid of topo_fine.
+    
+    With weight_cache the weight file is kept in the on-disk weight cache,
+    keyed on the source grid, the target grid and the method, so later runs on
+    the same domain (other variables, years or models) skip the weight
+    generation. Without it the caller has to remove the weight file with
+    regridder.clean_weight_file().
+    
+    With tiles, the target grid is split into about tiles tiles, which are
+    regridded in parallel in processes worker processes (see tiling.py).
+    The returned regridder has to be closed with close_regridder.
+    '''
+    if tiles is not None:
+        import tiling
+        return tiling.TiledRegridder(data, topo_fine, regrid_method, tiles, processes)
+    
+    if not weight_cache:
+        return xe.Regridder(data, topo_fine, regrid_method)
+    
+    directory = cache_utils.cache_dir('weights')
+    key = cache_utils.make_key(cache_utils.hash_grid(data), cache_utils.hash_grid(topo_fine), regrid_method)
+    filename = os.path.join(directory, regrid_method+'_'+key+'.nc')
+    
+    if os.path.exists(filename):
+        regridder = xe.Regridder(data, topo_fine, regrid_method, filename=filename, reuse_weights=True)
+    else:
+        with cache_utils.atomic_write(filename) as tmp_filename:
+            regridder = xe.Regridder(data, topo_fine, regrid_method, filename=tmp_filename)
+        regridder.filename = filename
+    
+    cache_utils.touch(filename)
+    cache_utils.evict(directory, keep=(filename,))
+    
+    return regridder
+
+def close_regridder(regridder, weight_cache=True):
+    '''
+    Stop the workers of a tiled regridder and remove the weight file of a
+    regridder built without weight_cache.
+    '''
+    if regridder is None:
+        return
+    if hasattr(regridder, 'close'):
+        regridder.close()
+    if not weight_cache:
+        regridder.clean_weight_file()
+
+def regrid_data(data, topo_coarse, topo_fine, variable, regrid_method = 'patch', weight_cache=True, dtype=np.float32,
+                tiles=None, processes=None):
+    
+    regridder = get_regridder(data, topo_fine, regrid_method, weight_cache, tiles, processes)
+    
+    try:
+        grad = None
+        if variable in DETREND_VARIABLES:
+            grad = monthly_gradients(data, topo_coarse, variable)
+        
+        data_regrid = regrid_block(data, topo_coarse, topo_fine, variable, regridder, grad, dtype)
+    finally:
+        close_regridder(regridder, weight_cache)
     
     return data_regrid
     
-def correct_coast(data_regrid, topo_fine):
-    # data_regrid: numpy array
+def nearest_valid_index(invalid):
+    '''
+    For every cell of the 2D mask invalid, the flat index of the nearest valid
+    cell (valid cells point to themselves).
+    '''
+    ind = nd.distance_transform_edt(invalid, return_distances=False, return_indices=True)
+    index_map = np.ravel_multi_index(tuple(ind), invalid.shape)
+    if invalid.size < 2**31:
+        index_map = index_map.astype(np.int32)
+    return index_map
+
+# index maps of the current process, by cache key
+_index_maps = {}
+
+def get_index_map(invalid, index_cache=True):
+    '''
+    Nearest-valid-cell index map (see nearest_valid_index) of the 2D mask invalid.
+    
+    The mask of cells without data after regridding only depends on the source
+    grid, the target grid and the land mask of the source data, so the map is
+    computed once per mask and kept in memory and, with index_cache, in the
+    on-disk cache for later runs.
+    '''
+    key = cache_utils.make_key(invalid)
+    if key in _index_maps:
+        return _index_maps[key]
+    
+    if index_cache:
+        directory = cache_utils.cache_dir('index_maps')
+        filename = os.path.join(directory, key+'.npy')
+        if os.path.exists(filename):
+            index_map = np.load(filename)
+            cache_utils.touch(filename)
+        else:
+            index_map = nearest_valid_index(invalid)
+            with cache_utils.atomic_write(filename) as tmp_filename, open(tmp_filename, 'wb') as f:
+                np.save(f, index_map)
+            cache_utils.evict(directory, keep=(filename,))
+    else:
+        index_map = nearest_valid_index(invalid)
+    
+    # only keep the maps of a few domains in memory
+    if len(_index_maps) >= 8:
+        _index_maps.pop(next(iter(_index_maps)))
+    _index_maps[key] = index_map
+    
+    return index_map
+
+def correct_coast(data_regrid, topo_fine, index_cache=True, topo_mask=None):
+    # data_regrid: numpy array (time, lat, lon), filled in place
     # topo_fine: data_set
+    # topo_mask: land mask of topo_fine, if it is already known
     
     # correct coastal grid points, that are not resolved after regridding from coarse to fine resolution
-    topo_mask = ~np.isnan(topo_fine['height'].data)
-    #mask = (np.isnan(data_regrid[0,:,:]) & ~np.isnan(topo_fine['height']))
+    if topo_mask is None:
+        topo_mask = ~np.isnan(topo_fine['height'].data)
     
-    data_masked = fill(data_regrid, topo_mask)
-        
-    return data_masked
+    # the cells without data after regridding are mostly the same in all
+    # timesteps, so one 2D index map of the nearest valid cells fills the
+    # cells, which are missing in every timestep, of the whole block
+    data_regrid = np.ascontiguousarray(data_regrid)
+    data_flat = data_regrid.reshape(data_regrid.shape[0], -1)
+    land = topo_mask.ravel()
+    
+    invalid = np.isnan(data_flat[0])
+    for t in range(1, data_flat.shape[0]):
+        invalid &= np.isnan(data_flat[t])
+    
+    # timesteps with other gaps are filled separately from their own gaps
+    other = np.array([(np.isnan(data_flat[t]) != invalid).any() for t in range(data_flat.shape[0])], dtype=bool)
+    
+    if invalid.any() and not invalid.all():
+        index_map = get_index_map(invalid.reshape(topo_mask.shape), index_cache).ravel()
+        cells = np.flatnonzero(invalid & land)
+        if not other.any():
+            data_flat[:, cells] = data_flat[:, index_map[cells]]
+        else:
+            rows = np.flatnonzero(~other)
+            data_flat[np.ix_(rows, cells)] = data_flat[np.ix_(rows, index_map[cells])]
+    
+    for t in np.flatnonzero(other):
+        data_regrid[t] = fill(data_regrid[t:t+1], topo_mask)[0]
+    
+    data_flat[:, ~land] = -9999
+    
+    return data_regrid
 
 # functions for writing netcdf
-def get_ncattrs(fn_nc):
+def get_ncattrs(fn_nc, variable=None, start_year=0, end_year=0):
+    # the files of a directory or glob pattern used for the variable and years
+    # all have the same model and calendar (see catalog.select)
+    fn_nc = catalog.data_files(fn_nc, variable, start_year, end_year)[0]
     nc_fid = Dataset(fn_nc, 'r')
     model_cal = str(nc_fid.variables['time'].calendar)
     model_name = str(nc_fid.getncattr('modelname'))
+    nc_fid.close()
     return model_cal, model_name
 
-def write_netcdf(array3d, param_name, lat1d, lon1d, start_year, end_year, savedir, filename, model_name, cal='gregorian'):#, freq ='daily'):
+def output_filename(variable, data_type, path_to_data, start_year=0, end_year=0):
+    '''
+    Name (without directory, period and extension) of the downscaled file of
+    variable from the model/observational data in path_to_data (of the years
+    start_year to end_year for directories and glob patterns).
+    '''
+    if data_type == 'model':
+        model_cal, model_name = get_ncattrs(path_to_data, variable, start_year, end_year)
+        return variable+'_downscaled_'+model_name
+    elif data_type == 'obs':
+        return variable+'_observations'
+
+def output_path(variable, data_type, path_to_data, path_save, start_year, end_year, output_format='netcdf'):
+    '''
+    Full path of the downscaled file (or Zarr store) start_tool writes for these inputs.
+    '''
+    filename = output_filename(variable, data_type, path_to_data, start_year, end_year)
+    extension = '.zarr' if output_format == 'zarr' else '.nc'
+    return os.path.join(path_save, filename+'_'+str(start_year)+'-'+str(end_year)+extension)
+
+def same_grid(lat, lon, lat1d, lon1d):
+    '''
+    Check if the lat/lon axes of an output file are the ones of lat1d/lon1d
+    (stored as float32).
+    '''
+    return (np.array_equal(np.asarray(lat), np.asarray(lat1d, dtype=np.float32)) and
+            np.array_equal(np.asarray(lon), np.asarray(lon1d, dtype=np.float32)))
+
+def is_complete(fn_nc, n_time=None, key=None, lat1d=None, lon1d=None):
+    '''
+    Check if fn_nc is a complete downscaled file or Zarr store (with n_time
+    timesteps), written by the run key (see run_key) on the grid lat1d/lon1d.
+    '''
+    if not os.path.exists(fn_nc):
+        return False
+    if os.path.isdir(fn_nc):
+        import zarr_store
+        return zarr_store.is_complete(fn_nc, n_time, key, lat1d, lon1d)
+    try:
+        nc_fid = Dataset(fn_nc, 'r')
+    except(IOError, OSError):
+        return False
+    try:
+        if (n_time is not None) and (len(nc_fid.dimensions['time']) != n_time):
+            return False
+        if (key is not None) and (getattr(nc_fid, RUN_KEY_ATTR, None) != key):
+            return False
+        return (lat1d is None) or same_grid(nc_fid.variables['lat'][:], nc_fid.variables['lon'][:], lat1d, lon1d)
+    except(KeyError):
+        return False
+    finally:
+        nc_fid.close()
+
+def climatology_path(fn_nc):
+    '''
+    Climatology file (see write_climatology) of the downscaled file fn_nc.
+    '''
+    return os.path.splitext(fn_nc)[0]+CLIMATOLOGY_SUFFIX
+
+def write_climatology(fn_clim, variable, sums, counts, lat, lon, sums_coarse, counts_coarse, lat_coarse, lon_coarse):
+    '''
+    Write the monthly and seasonal means of the downscaled data (from the
+    monthly sums and counts of accumulate_months) and of the coarse data to the
+    small climatology file fn_clim, so that viewing the results never needs
+    the whole output file.
+    
+    The means of the fine grid are variable (month, lat, lon) and
+    variable_season (season, lat, lon), the ones of the coarse grid
+    variable_coarse and variable_coarse_season on the dimensions of the
+    coarse data with the suffix _coarse.
+    '''
+    monthly, seasonal = climatology(sums, counts)
+    monthly_coarse, seasonal_coarse = climatology(sums_coarse, counts_coarse)
+    
+    dims_coarse = tuple(d+'_coarse' for d in lat_coarse.dims) if lat_coarse.ndim == 2 else ('lat_coarse', 'lon_coarse')
+    attrs = {k: v for k, v in PARAMETERS.get(variable, {}).items() if k in ('units', 'long_name', 'standard_name')}
+    
+    ds = xr.Dataset({variable: (('month', 'lat', 'lon'), monthly.astype(np.float32), attrs),
+                     variable+'_season': (('season', 'lat', 'lon'), seasonal.astype(np.float32), attrs),
+                     variable+'_coarse': (('month',)+dims_coarse, monthly_coarse.astype(np.float32), attrs),
+                     variable+'_coarse_season': (('season',)+dims_coarse, seasonal_coarse.astype(np.float32), attrs)},
+                    coords={'month': np.arange(1, 13),
+                            'season': [season for season, months in SEASONS],
+                            'lat': ('lat', np.asarray(lat)),
+                            'lon': ('lon', np.asarray(lon)),
+                            'lat_coarse': (dims_coarse if lat_coarse.ndim == 2 else 'lat_coarse', np.asarray(lat_coarse)),
+                            'lon_coarse': (dims_coarse if lon_coarse.ndim == 2 else 'lon_coarse', np.asarray(lon_coarse))},
+                    attrs={'title': 'monthly and seasonal means of '+os.path.basename(fn_clim).replace(CLIMATOLOGY_SUFFIX, '.nc'),
+                           'creation_date': datetime.today().strftime('%Y-%m-%d')})
+    
+    ds.to_netcdf(fn_clim+PART_SUFFIX)
+    os.replace(fn_clim+PART_SUFFIX, fn_clim)
+
+def open_climatology(fn_clim, variable, grid='fine'):
+    '''
+    Seasonal means (season, lat, lon) of the fine or the coarse grid from a
+    climatology file.
+    '''
+    ds = xr.open_dataset(fn_clim).load()
+    ds.close()
+    if grid == 'fine':
+        return ds[variable+'_season']
+    seasonal = ds[variable+'_coarse_season']
+    return seasonal.rename({name: name[:-len('_coarse')] for name in set(seasonal.dims) | set(seasonal.coords)
+                            if name.endswith('_coarse')})
+
+def write_netcdf(array3d, param_name, lat1d, lon1d, start_year, end_year, savedir, filename, model_name, cal='gregorian', **output_options):#, freq ='daily'):
+    # output_options: compression, chunking and packing, see create_data_variable
+    dataset = create_netcdf(param_name, lat1d, lon1d, array3d.shape[0], start_year, end_year, savedir, filename, model_name, cal, **output_options)
+    write_block(dataset, param_name, array3d, 0)
+    close_netcdf(dataset)
+    
+    return
+
+def close_netcdf(dataset, complete=True):
+    '''
+    Close a file of create_netcdf or create_netcdf_obs. Complete files are moved
+    to their final name, so an existing output file is always complete;
+    incomplete ones are removed.
+    '''
+    partname = dataset.filepath()
+    dataset.close()
+    if complete:
+        os.replace(partname, partname[:-len(PART_SUFFIX)])
+    elif os.path.exists(partname):
+        os.remove(partname)
+    
+    return
+
+def write_block(dataset, param_name, array3d, t0):
+    '''
+    Write a time block of downscaled data into an open netCDF file created with
+    create_netcdf or create_netcdf_obs, starting at timestep t0.
+    '''
+    var = dataset.variables[param_name]
+    
+    if 'scale_factor' in var.ncattrs():
+        # packed variable: missing values are masked, all others are clipped
+        # to the range of the packed values
+        scale, offset = var.scale_factor, var.add_offset
+        missing = np.isnan(array3d) | (array3d == -9999)
+        array3d = np.clip(array3d, offset+scale*(PACKED_FILL_VALUE+1), offset+scale*np.iinfo(np.int16).max)
+        array3d[missing] = offset
+        var[t0:t0+array3d.shape[0]] = np.ma.masked_array(array3d, missing)
+    else:
+        array3d[np.isnan(array3d)] = -9999
+        var[t0:t0+array3d.shape[0]] = array3d
+    
+    return
+
+def write_gradients(dataset, grad):
+    '''
+    Store the monthly gradients of monthly_gradients (shape (12,) or, for
+    local gradients, (12, lat, lon) of the coarse grid) in the variable
+    lapse_rate of an open output file, so that appended years are downscaled
+    with the same gradients (see open_append).
+    '''
+    dataset.createDimension('month', 12)
+    dims = ('month',)
+    if grad.ndim == 3:
+        dataset.createDimension('lat_coarse', grad.shape[1])
+        dataset.createDimension('lon_coarse', grad.shape[2])
+        dims += ('lat_coarse', 'lon_coarse')
+    var = dataset.createVariable('lapse_rate', 'f8', dims)
+    var.long_name = 'monthly gradient of the height dependency removed before regridding'
+    var.units = 'per metre'
+    var[:] = grad
+    
+    return
+
+def find_appendable(fn_nc):
+    '''
+    Complete output file with the same name and start year as fn_nc, but an
+    earlier end year, which fn_nc extends (the latest one), or None.
+    '''
+    prefix = os.path.splitext(fn_nc)[0].rsplit('-', 1)[0]+'-'
+    end_year = int(os.path.splitext(fn_nc)[0].rsplit('-', 1)[1])
+    
+    candidates = []
+    for fn in glob.glob(glob.escape(prefix)+'*.nc'):
+        year = fn[len(prefix):-len('.nc')]
+        if year.isdigit() and (int(year) < end_year) and is_complete(fn):
+            candidates.append((int(year), fn))
+    if len(candidates) == 0:
+        return None
+    return max(candidates)[1]
+
+def open_append(fn_old, fn_nc, param_name, lat1d, lon1d, times, cal, detrend=False, lapse_rate_window=None):
+    '''
+    Continue the complete output file fn_old as fn_nc with the time axis times
+    (in the calendar cal). fn_old has to hold param_name on the grid lat1d/lon1d
+    and its time axis has to be the start of times, otherwise ValueError is raised.
+    With detrend (variables with a height dependency) it also has to hold the
+    gradients of lapse_rate_window (see write_gradients).
+    
+    fn_old is moved to the temporary name of fn_nc (see close_netcdf) and
+    extended in place, so only the new years are written. Its entry in the
+    result cache (a hard link to the same file) is dropped before, other hard
+    links are kept by extending a copy instead. If the run fails, the
+    incomplete file is removed together with the years of fn_old.
+    Returns the open netCDF4 dataset, the number of timesteps of fn_old and
+    its gradients (None if there are none, see write_gradients).
+    '''
+    nc_fid = Dataset(fn_old, 'r')
+    try:
+        if param_name not in nc_fid.variables:
+            raise ValueError('{} does not contain {}.'.format(fn_old, param_name))
+        if not same_grid(nc_fid.variables['lat'][:], nc_fid.variables['lon'][:], lat1d, lon1d):
+            raise ValueError('{} is on a different grid.'.format(fn_old))
+        time = nc_fid.variables['time']
+        n_old = len(time)
+        if ((str(getattr(time, 'calendar', 'gregorian')) != str(cal)) or (n_old >= len(times)) or
+                not np.array_equal(np.asarray(time[:]), times[:n_old])):
+            raise ValueError('The time axis of {} is not the start of the period.'.format(fn_old))
+        grad = None
+        if 'lapse_rate' in nc_fid.variables:
+            grad = np.ma.filled(nc_fid.variables['lapse_rate'][:], np.nan)
+        key = getattr(nc_fid, RUN_KEY_ATTR, None)
+    finally:
+        nc_fid.close()
+    if detrend and (grad is None):
+        raise ValueError('{} has no gradients, the period has to be downscaled again.'.format(fn_old))
+    if (grad is not None) and ((grad.ndim == 3) != (lapse_rate_window is not None)):
+        raise ValueError('The gradients of {} are not the ones of lapse_rate_window.'.format(fn_old))
+    
+    if key is not None:
+        # the cached result of the shorter period is superseded by the extended one
+        cached = result_files(os.path.join(cache_utils.cache_dir('results'), key+'.nc'))
+        if os.path.exists(cached[0]) and os.path.samefile(cached[0], fn_old):
+            for fn in cached:
+                if os.path.exists(fn):
+                    os.remove(fn)
+    
+    partname = fn_nc+PART_SUFFIX
+    if os.stat(fn_old).st_nlink > 1:
+        shutil.copyfile(fn_old, partname)
+    else:
+        os.replace(fn_old, partname)
+    dataset = Dataset(partname, 'a')
+    dataset.variables['time'][n_old:] = times[n_old:]
+    
+    return dataset, n_old, grad
+
+def read_block(dataset, param_name, t0, n):
+    '''
+    Read n timesteps from timestep t0 of an open output file as float64 array
+    with nan for the missing values.
+    '''
+    values = dataset.variables[param_name][t0:t0+n]
+    return np.ma.filled(np.ma.masked_array(values, dtype=np.float64), np.nan)
+
+def create_data_variable(dataset, param_name, zlib=True, complevel=4, shuffle=True, chunking='map', pack=False):
+    '''
+    Create the (time, lat, lon) variable of the downscaled data.
+    
+    zlib, complevel, shuffle: compression of the variable.
+    chunking: 'map', 'timeseries' (see CHUNK_SHAPES), an explicit chunk shape
+    (time, lat, lon) or None for the netCDF default.
+    pack: store the data as int16 with the scale_factor and add_offset of the
+    parameter in PARAMETERS (or an explicit (scale_factor, add_offset)).
+    '''
+    chunksizes = None
+    if chunking is not None:
+        shape = CHUNK_SHAPES[chunking] if chunking in CHUNK_SHAPES else chunking
+        sizes = (None, len(dataset.dimensions['lat']), len(dataset.dimensions['lon']))
+        chunksizes = tuple(size if c is None else min(c, size) if size else c
+                           for c, size in zip(shape, sizes))
+    
+    if pack is True:
+        pack = PARAMETERS.get(OBS_PARAMETERS.get(param_name, param_name), {}).get('pack')
+    
+    if pack:
+        var = dataset.createVariable(param_name, "i2", ("time","lat","lon",), fill_value = PACKED_FILL_VALUE,
+                                     zlib=zlib, complevel=complevel, shuffle=shuffle, chunksizes=chunksizes)
+        var.scale_factor, var.add_offset = pack
+    else:
+        var = dataset.createVariable(param_name, "f4", ("time","lat","lon",), fill_value = -9999,
+                                     zlib=zlib, complevel=complevel, shuffle=shuffle, chunksizes=chunksizes)
+    
+    return var
+
+def set_parameter_attributes(dataset, var, param):
+    '''
+    Set the attributes of the parameter param (key of PARAMETERS) on the
+    variable and the title of the dataset.
+    '''
+    attrs = PARAMETERS[param]
+    var.units = attrs['units']
+    var.long_name = attrs['long_name']
+    var.standard_name = attrs['standard_name']
+    dataset.title = attrs['title']
+    if attrs['message'] is not None:
+        print(attrs['message'])
+    
+    return
+
+def time_values(n_time, start_year, end_year, cal='gregorian'):
+    '''
+    Values (in TIME_UNITS) of the n_time daily timesteps of the output from
+    start_year to end_year in the calendar cal.
+    '''
+    if str(cal) == '365_day':
+        d = np.arange((start_year-1950)*365, (end_year-1950+1)*365)
+        dates = num2date(d, TIME_UNITS, calendar=cal)                            
+    elif str(cal) == '360_day':
+        d = np.arange((start_year-1950)*360, (end_year-1950+1)*360)
+        dates = num2date(d, TIME_UNITS, calendar=cal)              
+    else:
+        dates = [datetime(start_year,1,1)+k*timedelta(days=1) for k in range(n_time)]
+    
+    return date2num(dates, units=TIME_UNITS, calendar=cal)
+
+def create_netcdf(param_name, lat1d, lon1d, n_time, start_year, end_year, savedir, filename, model_name, cal='gregorian', **output_options):
+    '''
+    Create the cf-conform netCDF file for n_time timesteps of downscaled model
+    data and write everything but the data itself (see write_block).
+    Returns the open netCDF4 dataset.
+    '''
     # create netCDF file
     savename = savedir+filename+'_'+str(start_year)+'-'+str(end_year)+'.nc'
-    # check if file already exists - if yes, delete it before writing new file
-    if os.path.exists(savename):
-        os.remove(savename)
-    
-    # open new netCDF file in write mode:   
+    # open new netCDF file in write mode, it keeps a temporary name until close_netcdf,
+    # which replaces an existing file only then:
+    partname = savename+PART_SUFFIX
     try:
-        dataset = Dataset(savename,'w',format='NETCDF4_CLASSIC')
+        dataset = Dataset(partname,'w',format='NETCDF4_CLASSIC')
     except(IOError):
-        os.remove(savename)
-        dataset = Dataset(savename,'w',format='NETCDF4_CLASSIC')
+        os.remove(partname)
+        dataset = Dataset(partname,'w',format='NETCDF4_CLASSIC')
     # create dimensions
        
     dataset.createDimension("time",None)
@@ -188,12 +1013,12 @@ def write_netcdf(array3d, param_name, lat1d, lon1d, start_year, end_year, savedi
     times = dataset.createVariable("time","f8",("time",))
     lats = dataset.createVariable("lat","f4",("lat",))
     lons = dataset.createVariable("lon","f4",("lon",))
-    var = dataset.createVariable(param_name, "f4", ("time","lat","lon",), fill_value = -9999)
+    var = create_data_variable(dataset, param_name, **output_options)
     crs = dataset.createVariable('crs', 'i', ())
     #prec = dataset.createVariable('pr', "f4", ("time","y","x",))
     
     # add attributes
-    times.units = 'days since 1950-01-01T00:00:00Z'
+    times.units = TIME_UNITS
     times.calendar = cal
     times.long_name = 'time'
     times.axis = 'T'
@@ -207,46 +1032,8 @@ def write_netcdf(array3d, param_name, lat1d, lon1d, start_year, end_year, savedi
     lons.long_name = 'longitude'
     lons.standard_name = 'longitude'
 
-    if (param_name == 'pr'):
-        var.units = 'mm'
-        var.long_name = 'total daily precipitation'
-        var.standard_name = 'precipitation_amount'
-        dataset.title = 'daily precipitation amount'
-        print('...writing pr')
-        
-    elif (param_name == 'tasmax'):
-        var.units = 'degree_Celsius'
-        var.long_name = 'daily maximum near-surface air temperature'
-        var.standard_name = 'air_temperature'
-        dataset.title = 'daily maximum temperature'
-        print('...writing tmax')
-        
-    elif (param_name == 'tasmin'):
-        var.units = 'degres_Celsius'
-        var.long_name = 'daily minimum near-surface air temperature'
-        var.standard_name = 'air_temperature'
-        dataset.title = 'daily minimum temperature'
-        #dataset.comment = 'Merged gridded observations of daily precipitation amount using DANUBECLIM as primary source and E-OBS (Version 16.0) data (regridded with ESMF_RegridWeightGen) as secondary source.'
-        print('...writing tmin')
-        
-    elif (param_name == 'rsds'):
-        var.units = 'W m-2'
-        var.long_name = 'surface downwelling shortwave flux'
-        var.standard_name = 'surface_downwelling_shortwave_flux_in_air'
-        dataset.title = 'daily mean global radiation'
-        print('...writing rsds') 
-        
-    elif (param_name == 'sfcWind'):
-        var.units = 'm s-1'
-        var.long_name = 'daily mean 10-m wind speed'
-        var.standard_name = 'wind_speed'       
-        dataset.title='daily mean 10-m wind speed'
-
-    elif (param_name == 'hurs'):
-        var.units = 'percent'
-        var.long_name = 'daily mean relative humidity'
-        var.standard_name = 'relative_humidity'       
-        dataset.title='daily mean relative humidity'       
+    if param_name in PARAMETERS:
+        set_parameter_attributes(dataset, var, param_name)
     
     var.grid_mapping = 'latitude_longitude'
     
@@ -257,52 +1044,52 @@ def write_netcdf(array3d, param_name, lat1d, lon1d, start_year, end_year, savedi
     crs.comment = 'Latitude and longitude on the WGS 1984 datum'
         
     
-    # write data to netCDF variable
-    array3d[np.isnan(array3d)] = -9999
-    var[:] = array3d
+    # write coordinates to netCDF variables
     lats[:] = lat1d
     lons[:] = lon1d
 
-    if str(cal) == '365_day':
-        d = np.arange((start_year-1950)*365, (end_year-1950+1)*365)
-        dates = num2date(d, 'days since 1950-01-01T00:00:00Z', calendar=cal)                            
-    elif str(cal) == '360_day':
-        d = np.arange((start_year-1950)*360, (end_year-1950+1)*360)
-        dates = num2date(d, 'days since 1950-01-01T00:00:00Z', calendar=cal)              
-    else:
-        dates = [datetime(start_year,1,1)+k*timedelta(days=1) for k in range(array3d.shape[0])]
-
-    times[:] = date2num(dates, units=times.units, calendar=times.calendar)
+    times[:] = time_values(n_time, start_year, end_year, cal)
     
     # global attributes
     dataset.modelname = model_name
     
-    dataset.project="Climaproof, funded by the Austrian Development Agency (ADA) and co-funded by the United Nations Environmental Programme (UNEP)"
-    dataset.source = "Climaproof_Downscaling Tool (Institute of Meteorology, University of Natural Resources and Life Sciences, Vienna, Austria)"
-    dataset.comment = "Data downscaled from 0.1° to 0.01° resolution with xESMF Python package (based on the regridding method by Earth System Modelling Framework (ESMF))"
+    dataset.project = PROJECT
+    dataset.source = SOURCE
+    dataset.comment = COMMENT
     dataset.conventions = "CF-1.6"
     
-    dataset.close()
-    
-    return
+    return dataset
 
-def write_netcdf_obs(array3d, param_name, lat1d, lon1d, start_year, end_year, savedir, filename, cal='gregorian'):
+def write_netcdf_obs(array3d, param_name, lat1d, lon1d, start_year, end_year, savedir, filename, cal='gregorian', **output_options):
     
 #    fillval = -9999
 #    array3d[np.isnan(array3d)] = fillval
     
+    # output_options: compression, chunking and packing, see create_data_variable
+    dataset = create_netcdf_obs(param_name, lat1d, lon1d, array3d.shape[0], start_year, end_year, savedir, filename, cal, **output_options)
+    if dataset is None:
+        return
+    write_block(dataset, param_name, array3d, 0)
+    close_netcdf(dataset)
+    
+    return
+
+def create_netcdf_obs(param_name, lat1d, lon1d, n_time, start_year, end_year, savedir, filename, cal='gregorian', **output_options):
+    '''
+    Create the netCDF file for n_time timesteps of downscaled observations and
+    write everything but the data itself (see write_block).
+    Returns the open netCDF4 dataset or None for an unknown parameter.
+    '''
     # create netCDF file
     savename = savedir+filename+'_'+str(start_year)+'-'+str(end_year)+'.nc'
-    # check if file already exists - if yes, delete it before writing new file
-    if os.path.exists(savename):
-        os.remove(savename)
-    
-    # open new netCDF file in write mode:   
+    # open new netCDF file in write mode, it keeps a temporary name until close_netcdf,
+    # which replaces an existing file only then:
+    partname = savename+PART_SUFFIX
     try:
-        dataset = Dataset(savename,'w',format='NETCDF4_CLASSIC')
+        dataset = Dataset(partname,'w',format='NETCDF4_CLASSIC')
     except(IOError):
-        os.remove(savename)
-        dataset = Dataset(savename,'w',format='NETCDF4_CLASSIC')
+        os.remove(partname)
+        dataset = Dataset(partname,'w',format='NETCDF4_CLASSIC')
     # create dimensions
        
     dataset.createDimension("time",None)
@@ -313,7 +1100,7 @@ def write_netcdf_obs(array3d, param_name, lat1d, lon1d, start_year, end_year, sa
     times = dataset.createVariable("time","f8",("time",))
     lats = dataset.createVariable("lat","f4",("lat",))
     lons = dataset.createVariable("lon","f4",("lon",))
-    var = dataset.createVariable(param_name, "f4", ("time","lat","lon",), fill_value = -9999)
+    var = create_data_variable(dataset, param_name, **output_options)
     crs = dataset.createVariable('crs', 'i', ())
     #prec = dataset.createVariable('pr', "f4", ("time","y","x",))
     
@@ -332,53 +1119,15 @@ def write_netcdf_obs(array3d, param_name, lat1d, lon1d, start_year, end_year, sa
     lons.long_name = 'longitude'
     lons.standard_name = 'longitude'
 
-    if (param_name == 'pr') | (param_name == 'rr'):
-        var.units = 'mm'
-        var.long_name = 'total daily precipitation'
-        var.standard_name = 'precipitation_amount'
-        dataset.title = 'daily precipitation amount'
-        print('...writing pr')
-        
-    elif (param_name == 'tasmax') | (param_name == 'tmax'):
-        var.units = 'degree_Celsius'
-        var.long_name = 'daily maximum near-surface air temperature'
-        var.standard_name = 'air_temperature'
-        dataset.title = 'daily maximum temperature'
-        print('...writing tmax')
-        
-    elif (param_name == 'tasmin') | (param_name == 'tmin'):
-        var.units = 'degres_Celsius'
-        var.long_name = 'daily minimum near-surface air temperature'
-        var.standard_name = 'air_temperature'
-        dataset.title = 'daily minimum temperature'
-        #dataset.comment = 'Merged gridded observations of daily precipitation amount using DANUBECLIM as primary source and E-OBS (Version 16.0) data (regridded with ESMF_RegridWeightGen) as secondary source.'
-        print('...writing tmin')
-        
-    elif (param_name == 'rsds'):
-        var.units = 'W m-2'
-        var.long_name = 'surface downwelling shortwave flux'
-        var.standard_name = 'surface_downwelling_shortwave_flux_in_air'
-        dataset.title = 'daily mean global radiation'
-        print('...writing rsds') 
-        
-    elif (param_name == 'sfcWind'):
-        var.units = 'm s-1'
-        var.long_name = 'daily mean 10-m wind speed'
-        var.standard_name = 'wind_speed'       
-        dataset.title='daily mean 10-m wind speed'
-
-    elif (param_name == 'hurs'):
-        var.units = 'percent'
-        var.long_name = 'daily mean relative humidity'
-        var.standard_name = 'relative_humidity'       
-        dataset.title='daily mean relative humidity'   
-        
+    if OBS_PARAMETERS.get(param_name, param_name) in PARAMETERS:
+        set_parameter_attributes(dataset, var, OBS_PARAMETERS.get(param_name, param_name))
+    
     else:
         print ('unknown parameter - edit information in function!')
         print ('aborting... no netCDF file saved!')
         dataset.close()
-        os.remove(savename)
-        return
+        os.remove(partname)
+        return None
     
     var.grid_mapping = 'latitude_longitude'
     
@@ -389,40 +1138,102 @@ def write_netcdf_obs(array3d, param_name, lat1d, lon1d, start_year, end_year, sa
     crs.comment = 'Latitude and longitude on the WGS 1984 datum'
         
     
-    # write data to netCDF variable
-    array3d[np.isnan(array3d)] = -9999
-    var[:] = array3d
+    # write coordinates to netCDF variables
     lats[:] = lat1d
     lons[:] = lon1d
 
-    dates = [datetime(start_year,1,1)+k*timedelta(days=1) for k in range(array3d.shape[0])]
+    dates = [datetime(start_year,1,1)+k*timedelta(days=1) for k in range(n_time)]
     times[:] = date2num(dates, units=times.units, calendar=times.calendar)
     
     # global attributes
-    dataset.project="Climaproof, funded by the Austrian Development Agency (ADA) and co-funded by the United Nations Environmental Programme (UNEP)"
-    dataset.source = "Climaproof Downscaling Tool (Institute of Meteorology, University of Natural Resources and Life Sciences, Vienna, Austria)"
-    dataset.comment = "Data downscaled from 0.1° to 0.01° resolution with xESMF Python package (based on the regridding method by Earth System Modelling Framework (ESMF))"
+    dataset.project = PROJECT
+    dataset.source = SOURCE
+    dataset.comment = COMMENT
 
-    dataset.close()
-    
-    return
+    return dataset
 
-def start_tool(variable, data_type, 
-               path_to_data, path_to_topo_fine, path_to_topo_coarse, path_save,
-               lat_min, lat_max, lon_min, lon_max,
-               start_year, end_year,
-               regrid_method = 'patch'):
-    
-    # load data to dataset
-    print('...loading data')
+def input_identity(path_or_ds):
+    '''
+    Identity of an input for the result cache: path, size and modification
+    time of a file (of all files of a directory or glob pattern), or a hash of
+    the grid and the variables of an opened dataset.
+    '''
+    if isinstance(path_or_ds, xr.Dataset):
+        return cache_utils.make_key(cache_utils.hash_grid(path_or_ds),
+                                    *[np.asarray(path_or_ds[v].data) for v in sorted(path_or_ds.data_vars)])
+    if not os.path.isfile(path_or_ds):
+        return catalog.identity(path_or_ds)
+    stat = os.stat(path_or_ds)
+    return (os.path.abspath(path_or_ds), stat.st_size, stat.st_mtime)
+
+def run_key(data_identity, topo_identity, variable, data_type, lat_min, lat_max, lon_min, lon_max,
+            start_year, end_year, regrid_method='patch', output_options=None, dtype='float32',
+            lapse_rate_window=None):
+    '''
+    Key of the result of a run: the identity of the data and of both
+    topography inputs (see input_identity) and all parameters, which change
+    the result. Results are cached under it and it is stored in the outputs
+    (global attribute RUN_KEY_ATTR), so complete outputs of other settings are
+    not taken for the ones of the run (see is_complete).
+    '''
+    return cache_utils.make_key(data_identity, topo_identity[0], topo_identity[1], variable, data_type,
+                                lat_min, lat_max, lon_min, lon_max, start_year, end_year, regrid_method,
+                                sorted((output_options or {}).items()), np.dtype(dtype).str, lapse_rate_window)
 
-    ds = xr.open_dataset(path_to_data)
-    topo_fine = xr.open_dataset(path_to_topo_fine)
-    topo_coarse = xr.open_dataset(path_to_topo_coarse)
+def result_files(fn_nc):
+    '''
+    All files of one result: the downscaled file, its climatology and its pyramid.
+    '''
+    return [fn_nc, climatology_path(fn_nc), pyramid.pyramid_path(fn_nc)]
 
-    # create a subset of the data (cut out lat/lon bos and time slice)
-    print('...subsetting data')
+def get_cached_result(key, data_regrid_fn):
+    '''
+    Link the result files of key from the result cache to data_regrid_fn.
+    Returns False if the result is not (or not completely) in the cache.
+    '''
+    directory = cache_utils.cache_dir('results')
+    cached = result_files(os.path.join(directory, key+'.nc'))
+    # results cached without their run key would never count as complete outputs
+    if not (all(os.path.exists(fn) for fn in cached) and is_complete(cached[0], key=key)):
+        return False
+    for fn_cached, fn in zip(cached, result_files(data_regrid_fn)):
+        cache_utils.touch(fn_cached)
+        cache_utils.link_or_copy(fn_cached, fn)
+    return True
+
+def cache_result(key, data_regrid_fn):
+    '''
+    Put the result files of data_regrid_fn into the result cache under key.
+    '''
+    directory = cache_utils.cache_dir('results')
+    cached = result_files(os.path.join(directory, key+'.nc'))
+    for fn, fn_cached in zip(result_files(data_regrid_fn), cached):
+        cache_utils.link_or_copy(fn, fn_cached)
+    cache_utils.evict(directory, keep=cached)
+
+def open_input(path_or_ds):
+    '''
+    Open a netCDF file as dataset, already opened datasets are passed through.
+    '''
+    if isinstance(path_or_ds, xr.Dataset):
+        return path_or_ds
+    return xr.open_dataset(path_or_ds)
+
+def subset_inputs(ds, topo_fine, topo_coarse, lat_min, lat_max, lon_min, lon_max, start_year=0, end_year=0):
+    '''
+    Cut the lat/lon box and time slice out of the data and the matching
+    subsets out of the coarse and fine topography.
+    Returns ds_subset, topo_coarse_subset, topo_fine_subset.
+    '''
     ds_subset = cut_domain(ds, lat_min, lat_max, lon_min, lon_max, start_year, end_year)
+    return (ds_subset,)+subset_topography(ds_subset, topo_fine, topo_coarse, lat_min, lat_max, lon_min, lon_max)
+
+def subset_topography(ds_subset, topo_fine, topo_coarse, lat_min, lat_max, lon_min, lon_max):
+    '''
+    Cut the lat/lon box out of the coarse topography and the extent of the
+    data subset ds_subset out of the fine topography and load both.
+    Returns topo_coarse_subset, topo_fine_subset.
+    '''
     topo_coarse_subset = cut_domain(topo_coarse, lat_min, lat_max, lon_min, lon_max)
 
     lat_min_fine = ds_subset['lat'].min().data
@@ -431,25 +1242,266 @@ def start_tool(variable, data_type,
     lon_max_fine = ds_subset['lon'].max().data   
 
     topo_fine_subset = cut_domain(topo_fine, lat_min_fine, lat_max_fine, lon_min_fine, lon_max_fine)
+    
+    # the topography is needed as a whole for every block, the data is read block by block
+    topo_coarse_subset.load()
+    topo_fine_subset.load()
+    
+    return topo_coarse_subset, topo_fine_subset
 
-    # regrid data
-    print('...regridding data - this takes some time')
-    data_regrid = regrid_data(ds_subset, topo_coarse_subset, topo_fine_subset, variable, regrid_method)
+def start_tool(variable, data_type, 
+               path_to_data, path_to_topo_fine, path_to_topo_coarse, path_save,
+               lat_min, lat_max, lon_min, lon_max,
+               start_year, end_year,
+               regrid_method = 'patch', block_size = None, weight_cache = True,
+               progress = None, output_options = None,
+               dtype = 'float32', validate_dtype = False, lapse_rate_window = None,
+               tiles = None, processes = None, result_cache = True, force = False,
+               output_format = 'netcdf', tracer = None, engine = 'numpy', engine_options = None,
+               memory_budget = None, static_cache = True, append = False, topo_identity = None):
+    '''
+    Downscale variable of the model/observational data in path_to_data and save
+    it as a cf-conform netCDF file in path_save. path_to_data can also be a
+    directory or glob pattern of files split in time, of which only the ones
+    overlapping start_year to end_year are opened (see catalog.py). The monthly and seasonal means
+    of the downscaled and the coarse data are written to a small climatology
+    file next to it (see write_climatology), and a pyramid of their seasonal
+    means at lower resolutions for viewing them (see pyramid.py).
+    
+    path_to_topo_fine/path_to_topo_coarse: paths of the topography files or
+    already opened (and e.g. subset) topography datasets.
+    block_size: number of timesteps downscaled and written at once. If None, the
+    whole period is processed in one block; otherwise the data is streamed in
+    time blocks and the peak memory only depends on block_size.
+    weight_cache: reuse the regridding weights of earlier runs on the same
+    domain (see get_regridder).
+    progress: optional callback progress(stage, fraction) called at every stage
+    and block; exceptions raised by it (e.g. to cancel the run) stop the run.
+    output_options: dict of compression, chunking and packing options of the
+    output file (see create_data_variable).
+    dtype: floating point type of the computation (the output is float32 anyway).
+    validate_dtype: compute every block in float64 as well and stop the run
+    with ValueError, if the dtype results differ from it by more than
+    VALIDATE_TOLERANCE (numpy engine only, see downscale_blocks).
+    lapse_rate_window: fit the height dependency locally in a moving window of
+    lapse_rate_window x lapse_rate_window coarse cells instead of over the
+    whole domain.
+    tiles: regrid the domain in about tiles tiles in parallel in processes
+    worker processes (default: number of cores), see tiling.py.
+    result_cache: keep the results in the on-disk result cache, keyed on the
+    identity (path, size and modification time) of the input files and all
+    parameters, which change the result. A run with the same key returns the
+    cached result at once.
+    force: recompute the result even if it is in the result cache.
+    output_format: 'netcdf' or 'zarr' to write a Zarr store (see zarr_store.py)
+    instead of a netCDF file. Zarr stores are not kept in the result cache.
+    tracer: instrument.Tracer recording the wall time, CPU time, memory and
+    array shapes of every stage (see instrument.py); its spans are in
+    tracer.spans after the run.
+    engine: 'numpy' or 'dask' to open the data lazily in time chunks of
+    block_size (default 365) and downscale them in parallel on a local dask
+    cluster while the finished chunks are written (see dask_engine.py).
+    engine_options: dict of workers, threads_per_worker, memory_limit and
+    processes of the dask cluster (see dask_engine.start_client).
+    memory_budget: memory in bytes the run may use. Before any work is done,
+    the peak memory is estimated from the lat/lon box and the years (see
+    estimate.py): the block size is reduced to stay within the budget, a run
+    which does not fit even with small blocks raises MemoryError.
+    static_cache: keep the subset topography, land mask, coarse climatology
+    and gradients of the domain in memory and on disk for later runs on the
+    same domain and data (see static_products.py).
+    append: extend the complete output of the same data with the same start
+    year and the latest earlier end year (see find_appendable) by the missing
+    years instead of downscaling the whole period. The new years are
+    downscaled with the gradients stored in that file (see write_gradients)
+    and the extended file replaces it. Only for netCDF outputs.
+    topo_identity: input_identity of both topography files, if they are given
+    as loaded subsets (e.g. by batch.py), so the run key is the one of the files.
+    '''
+    import static_products
+    
+    if progress is None:
+        progress = lambda stage, fraction=0.: None
+    if output_options is None:
+        output_options = {}
+    if tracer is None:
+        tracer = instrument.NULL_TRACER
+    if engine == 'dask':
+        import dask_engine
+        if tiles is not None:
+            raise ValueError('The dask engine does not regrid in tiles, its chunks already run in parallel.')
+    
+    if memory_budget is not None:
+        blocks = 1 if engine != 'dask' else dask_engine.blocks_in_memory(**(engine_options or {}))
+        plan = estimate.plan_run(lat_min, lat_max, lon_min, lon_max, start_year, end_year, regrid_method, dtype,
+                                 block_size, lapse_rate_window, memory_budget, blocks)
+        block_size = plan['block_size']
+        print('...'+estimate.describe(plan))
+    
+    if (engine == 'dask') and (block_size is None):
+        block_size = 365
+    
+    # load data to dataset
+    print('...loading data')
+    progress('loading data')
+
+    with tracer.span('load'):
+        if engine == 'dask':
+            ds = dask_engine.open_chunked(path_to_data, block_size, variable, start_year, end_year)
+        else:
+            ds = catalog.open_data(path_to_data, variable, start_year, end_year)
+        data_identity = input_identity(path_to_data)
+        if topo_identity is None:
+            topo_identity = (input_identity(path_to_topo_fine), input_identity(path_to_topo_coarse))
+
+    # create a subset of the data (cut out lat/lon bos and time slice),
+    # the topography of the domain is only subset if it is not in the cache yet
+    print('...subsetting data')
+    progress('subsetting data')
+    with tracer.span('subset', data=ds[variable]) as span:
+        ds_subset = cut_domain(ds, lat_min, lat_max, lon_min, lon_max, start_year, end_year)
+        static = static_products.domain(ds_subset, path_to_topo_fine, path_to_topo_coarse,
+                                        lat_min, lat_max, lon_min, lon_max, topo_identity, static_cache)
+        topo_coarse_subset, topo_fine_subset = static.topo_coarse, static.topo_fine
+        span.add(data_subset=ds_subset[variable], topo_fine=topo_fine_subset['height'])
 
-    # save regridded data as cf-conform netcdf file
-    print('...saving data as a CF-conform netCDF file')
+    # create the cf-conform netcdf file the downscaled blocks are written to
     path_save = path_save+'/'
-    if data_type == 'model':
+    n_time = ds_subset.dims['time']
+    #define the name of the new dataset
+    filename = output_filename(variable, data_type, path_to_data, start_year, end_year)
+    data_regrid_fn = output_path(variable, data_type, path_to_data, path_save, start_year, end_year, output_format)
+    
+    if output_format == 'zarr':
+        import zarr_store
+        create_zarr, write, close = zarr_store.create_zarr, zarr_store.write_block, zarr_store.close_zarr
+        result_cache = False
+    else:
+        write, close = write_block, close_netcdf
+    
+    fn_append = None
+    if append:
+        if output_format == 'zarr':
+            raise ValueError('Only netCDF outputs can be appended to.')
+        fn_append = find_appendable(data_regrid_fn)
+        if fn_append is not None:
+            # the result depends on the earlier run, so it is not the one of the cache key
+            result_cache = False
+    
+    key = run_key(data_identity, topo_identity, variable, data_type, lat_min, lat_max, lon_min, lon_max,
+                  start_year, end_year, regrid_method, output_options, dtype, lapse_rate_window)
+    if result_cache:
+        if not force and get_cached_result(key, data_regrid_fn):
+            print('...using the cached result')
+            progress('loading cached result', 1.)
+            return data_regrid_fn, ds_subset
+    
+    t_start = 0
+    if fn_append is not None:
+        print('...appending to '+fn_append)
+        cal = get_ncattrs(path_to_data, variable, start_year, end_year)[0] if data_type == 'model' else 'gregorian'
+        dataset, t_start, grad_stored = open_append(fn_append, data_regrid_fn, variable,
+                                                    topo_fine_subset['lat'], topo_fine_subset['lon'],
+                                                    time_values(n_time, start_year, end_year, cal), cal,
+                                                    variable in DETREND_VARIABLES, lapse_rate_window)
+    elif (data_type == 'model') and (output_format == 'zarr'):
+        model_cal, model_name = get_ncattrs(path_to_data, variable, start_year, end_year)
+        dataset = create_zarr(variable, topo_fine_subset['lat'], topo_fine_subset['lon'], n_time, start_year, end_year, path_save, filename, model_name, model_cal, **output_options)
+    elif (data_type == 'obs') and (output_format == 'zarr'):
+        dataset = create_zarr(variable, topo_fine_subset['lat'], topo_fine_subset['lon'], n_time, start_year, end_year, path_save, filename, **output_options)
+    elif data_type == 'model':
         # get name and calendar of the model from the original file
-        model_cal, model_name = get_ncattrs(path_to_data)    
-        #define the name of the new dataset
-        filename = variable+'_downscaled_'+model_name
-        write_netcdf(data_regrid, variable, topo_fine_subset['lat'], topo_fine_subset['lon'], start_year, end_year, path_save, filename, model_name, model_cal)
+        model_cal, model_name = get_ncattrs(path_to_data, variable, start_year, end_year)
+        dataset = create_netcdf(variable, topo_fine_subset['lat'], topo_fine_subset['lon'], n_time, start_year, end_year, path_save, filename, model_name, model_cal, **output_options)
     elif data_type == 'obs':       
-        filename = variable+'_observations'        
-        write_netcdf_obs(data_regrid, variable, topo_fine_subset['lat'], topo_fine_subset['lon'], start_year, end_year, path_save, filename)
+        dataset = create_netcdf_obs(variable, topo_fine_subset['lat'], topo_fine_subset['lon'], n_time, start_year, end_year, path_save, filename, **output_options)
+
+    if dataset is None:
+        return data_regrid_fn, ds_subset
+    if output_format == 'zarr':
+        dataset.attrs[RUN_KEY_ATTR] = key
+    else:
+        dataset.setncattr(RUN_KEY_ATTR, key)
+
+    # regrid data block by block and save it to the netcdf file
+    print('...regridding data - this takes some time')
+    regridder = None
+    client = None
+    complete = False
+    try:
+        progress('building regridding weights')
+        with tracer.span('weights', data=ds_subset[variable], topo_fine=topo_fine_subset['height'], method=regrid_method):
+            regridder = get_regridder(ds_subset, topo_fine_subset, regrid_method, weight_cache, tiles, processes)
+        
+        # monthly sums of the downscaled data for the climatology file
+        months = _months(ds_subset)
+        sums = np.zeros((12,)+topo_fine_subset['height'].shape)
+        counts = np.zeros((12,)+topo_fine_subset['height'].shape)
+        
+        if t_start > 0:
+            # the years, which are already downscaled, are only read back for the climatology
+            progress('reading downscaled years')
+            step = block_size if block_size is not None else t_start
+            for t0 in range(0, t_start, step):
+                with tracer.span('climatology', t0=t0):
+                    values = read_block(dataset, variable, t0, min(step, t_start-t0))
+                    accumulate_months(sums, counts, values, months[t0:t0+values.shape[0]])
+        
+        # the coarse monthly sums give the gradients and the coarse climatology in one pass
+        progress('fitting gradients')
+        with tracer.span('gradients', data=ds_subset[variable]):
+            sums_coarse, counts_coarse, grad = static_products.coarse_climatology(
+                static, ds_subset, variable, data_identity, start_year, end_year,
+                block_size, lapse_rate_window, static_cache)
+        if fn_append is not None:
+            # the new years are downscaled consistently with the earlier ones
+            grad = grad_stored
+        elif (grad is not None) and (output_format == 'netcdf'):
+            write_gradients(dataset, grad)
+        
+        data = ds_subset.isel(time=slice(t_start, None)) if t_start > 0 else ds_subset
+        if engine == 'dask':
+            client = dask_engine.start_client(**(engine_options or {}))
+            blocks = dask_engine.downscale_blocks(data, topo_coarse_subset, topo_fine_subset, variable, regridder, client,
+                                                  block_size, np.dtype(dtype), lapse_rate_window, tracer, grad, static)
+        else:
+            blocks = downscale_blocks(data, topo_coarse_subset, topo_fine_subset, variable, regridder, block_size,
+                                      np.dtype(dtype), validate_dtype, lapse_rate_window, tracer, grad, static)
+        # the blocks of the dask engine come in the order they are finished
+        done = 0
+        for t0, data_regrid in blocks:
+            progress('regridding data', float(done)/(n_time-t_start))
+            t0 += t_start
+            done += data_regrid.shape[0]
+            with tracer.span('write', data_regrid=data_regrid, t0=t0):
+                write(dataset, variable, data_regrid, t0)
+            with tracer.span('climatology', data_regrid=data_regrid, t0=t0):
+                accumulate_months(sums, counts, data_regrid, months[t0:t0+data_regrid.shape[0]], missing_value=-9999)
+        progress('regridding data', 1.)
+        
+        progress('writing climatology')
+        with tracer.span('climatology'):
+            write_climatology(climatology_path(data_regrid_fn), variable, sums, counts,
+                              topo_fine_subset['lat'], topo_fine_subset['lon'],
+                              sums_coarse, counts_coarse, ds_subset['lat'], ds_subset['lon'])
+        # downsampled levels of the seasonal means for the results view
+        with tracer.span('pyramid'):
+            pyramid.write_pyramid(pyramid.pyramid_path(data_regrid_fn),
+                                  pyramid.build_pyramid(open_climatology(climatology_path(data_regrid_fn), variable)))
+        complete = True
+    finally:
+        close(dataset, complete)
+        close_regridder(regridder, weight_cache)
+        if client is not None:
+            dask_engine.close_client(client)
 
-    data_regrid_fn = path_save+filename+'_'+str(start_year)+'-'+str(end_year)+'.nc'
+    if result_cache:
+        cache_result(key, data_regrid_fn)
+    if fn_append is not None:
+        # the extended file replaces the shorter one
+        for fn in result_files(fn_append):
+            if os.path.exists(fn):
+                os.remove(fn)
 
     return data_regrid_fn, ds_subset
 
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+Memory and runtime estimates of the climaproof downscaling tool
+--> check a run against the memory budget before it starts
+
+The peak memory of start_tool is the memory of the process itself, the
+memory needed for the whole run (topography, land mask, index map, weights,
+monthly sums of the climatology file) and the memory of the blocks held at
+once, which grows with the block size. All of it scales with the number of
+cells of the fine grid, so the block size for a memory budget follows
+directly from the domain size (see choose_block_size).
+
+The figures are rough upper bounds of measurements with
+benchmarks/run_benchmarks.py, the runtimes are the ones of one core.
+"""
+
+import math
+import os
+
+import numpy as np
+
+# resolution of the coarse and the fine grid in degrees
+RES_COARSE = 0.1
+RES_FINE = 0.01
+
+# memory of the process with all libraries loaded in bytes
+PROCESS_BYTES = 250*1024**2
+
+# memory per fine grid cell needed for the whole run in bytes: height
+# (float64), land mask, index map (int32, see nearest_valid_index) and the
+# monthly sums and counts of the climatology file (2 x 12 float64) with their means
+STATIC_BYTES_PER_CELL = 8+1+4+2*12*8+16*8
+
+# regridding weights per fine grid cell of the methods
+WEIGHTS_PER_CELL = {'bilinear': 4, 'patch': 25, 'conservative': 4, 'nearest_s2d': 1, 'nearest_d2s': 1}
+
+# memory per weight: xESMF weights (float64, two int32 indices) and their
+# CSR copy in the dtype of the computation (without its itemsize)
+BYTES_PER_WEIGHT = 16+4
+
+# arrays of the dtype of the computation per fine grid cell and timestep of a
+# block (regridded block, coast fill, re-trend temporary) and further bytes
+# (float64 climatology temporary, masks, writer buffer)
+BLOCK_ARRAYS = 3
+BLOCK_EXTRA_BYTES = 18
+
+# the same per coarse grid cell and timestep (data read as float64, its
+# dtype copy, detrended data and monthly gradients)
+COARSE_ARRAYS = 3
+COARSE_EXTRA_BYTES = 8
+
+# seconds per fine grid cell and timestep (regridding, coast fill, writing)
+SECONDS_PER_CELL = {'bilinear': 6e-7, 'patch': 1e-6, 'conservative': 6e-7, 'nearest_s2d': 5e-7, 'nearest_d2s': 5e-7}
+
+# seconds per fine grid cell to build the weights (not needed with cached weights)
+WEIGHT_SECONDS_PER_CELL = {'bilinear': 2e-6, 'patch': 2e-5, 'conservative': 1e-5, 'nearest_s2d': 1e-6, 'nearest_d2s': 1e-6}
+
+# share of the physical memory used as budget if none is configured
+DEFAULT_BUDGET_FRACTION = 0.8
+
+SIZE_UNITS = {'B': 1, 'KB': 1024, 'MB': 1024**2, 'GB': 1024**3, 'TB': 1024**4}
+
+def parse_size(size):
+    '''
+    Parse a memory size like 2000000000, '64GB' or '512 MB' to bytes.
+    '''
+    if size is None:
+        return None
+    if isinstance(size, (int, float)):
+        return int(size)
+    size = str(size).strip().upper()
+    for unit in sorted(SIZE_UNITS, key=len, reverse=True):
+        if size.endswith(unit):
+            return int(float(size[:-len(unit)])*SIZE_UNITS[unit])
+    return int(float(size))
+
+def format_size(n_bytes):
+    '''
+    Memory size in human readable units, e.g. '3.2 GB'.
+    '''
+    for unit in ('TB', 'GB', 'MB', 'KB'):
+        if n_bytes >= SIZE_UNITS[unit]:
+            return '{:.1f} {}'.format(float(n_bytes)/SIZE_UNITS[unit], unit)
+    return '{} B'.format(int(n_bytes))
+
+def default_budget():
+    '''
+    Memory budget of the environment variable DST_MEMORY_BUDGET (e.g. 32GB)
+    or DEFAULT_BUDGET_FRACTION of the physical memory (None if unknown).
+    '''
+    if os.environ.get('DST_MEMORY_BUDGET'):
+        return parse_size(os.environ['DST_MEMORY_BUDGET'])
+    try:
+        return int(DEFAULT_BUDGET_FRACTION*os.sysconf('SC_PHYS_PAGES')*os.sysconf('SC_PAGE_SIZE'))
+    except (AttributeError, ValueError, OSError):
+        # not available on windows
+        return None
+
+def grid_cells(lat_min, lat_max, lon_min, lon_max, res):
+    '''
+    Number of cells of a grid of resolution res (degrees) in the lat/lon box.
+    '''
+    n_lat = int(math.floor(abs(lat_max-lat_min)/res+1e-6))+1
+    n_lon = int(math.floor(abs(lon_max-lon_min)/res+1e-6))+1
+    return n_lat*n_lon
+
+def n_timesteps(start_year, end_year):
+    '''
+    Upper bound of the number of daily timesteps of the years.
+    '''
+    return 366*(end_year-start_year+1)
+
+def static_memory(n_fine, dtype='float32', regrid_method='patch', lapse_rate_window=None):
+    '''
+    Memory in bytes needed for the whole run, independent of the block size.
+    '''
+    itemsize = np.dtype(dtype).itemsize
+    per_cell = STATIC_BYTES_PER_CELL + WEIGHTS_PER_CELL.get(regrid_method, 25)*(BYTES_PER_WEIGHT+itemsize)
+    if lapse_rate_window is not None:
+        # local gradients regridded to the fine grid
+        per_cell += 12*8
+    return PROCESS_BYTES + per_cell*n_fine
+
+def block_memory(n_fine, n_coarse=None, dtype='float32'):
+    '''
+    Memory in bytes of one timestep of a block.
+    '''
+    if n_coarse is None:
+        n_coarse = int(n_fine*(RES_FINE/RES_COARSE)**2)
+    itemsize = np.dtype(dtype).itemsize
+    return ((BLOCK_ARRAYS*itemsize+BLOCK_EXTRA_BYTES)*n_fine +
+            (COARSE_ARRAYS*itemsize+COARSE_EXTRA_BYTES)*n_coarse)
+
+def peak_memory(n_fine, n_time, block_size=None, n_coarse=None, dtype='float32', regrid_method='patch',
+                lapse_rate_window=None, blocks=1):
+    '''
+    Peak memory in bytes of a run on n_fine fine grid cells with n_time
+    timesteps, downscaled in blocks of block_size timesteps (the whole period
+    if None) with blocks blocks in memory at once.
+    '''
+    if block_size is None:
+        block_size = n_time
+    block_size = min(block_size, n_time)
+    return (static_memory(n_fine, dtype, regrid_method, lapse_rate_window) +
+            blocks*block_size*block_memory(n_fine, n_coarse, dtype))
+
+def runtime(n_fine, n_time, regrid_method='patch', weights_cached=False):
+    '''
+    Runtime in seconds of a run on one core.
+    '''
+    seconds = SECONDS_PER_CELL.get(regrid_method, 1e-6)*n_fine*n_time
+    if not weights_cached:
+        seconds += WEIGHT_SECONDS_PER_CELL.get(regrid_method, 2e-5)*n_fine
+    return seconds
+
+def choose_block_size(memory_budget, n_fine, n_time, n_coarse=None, dtype='float32', regrid_method='patch',
+                      lapse_rate_window=None, blocks=1, min_block_size=1):
+    '''
+    Largest block size (at most n_time) with which a run stays within
+    memory_budget bytes. None (one block) if the whole period fits.
+    Raises MemoryError if not even blocks of min_block_size timesteps fit.
+    '''
+    budget = memory_budget - static_memory(n_fine, dtype, regrid_method, lapse_rate_window)
+    block_size = int(budget // (blocks*block_memory(n_fine, n_coarse, dtype))) if budget > 0 else 0
+    if block_size < min_block_size:
+        needed = peak_memory(n_fine, n_time, min_block_size, n_coarse, dtype, regrid_method, lapse_rate_window, blocks)
+        raise MemoryError('The domain of {} cells needs at least {}, but the memory budget is {}. '
+                          'Please choose a smaller domain.'.format(n_fine, format_size(needed), format_size(memory_budget)))
+    if block_size >= n_time:
+        return None
+    return block_size
+
+def plan_run(lat_min, lat_max, lon_min, lon_max, start_year, end_year,
+             regrid_method='patch', dtype='float32', block_size=None, lapse_rate_window=None,
+             memory_budget=None, blocks=1):
+    '''
+    Pre-flight estimate of a start_tool run from its lat/lon box and years.
+    With a memory budget and without block_size, the largest block size
+    within the budget is chosen; runs, which do not fit, raise MemoryError.
+    Returns a dict with n_fine, n_time, block_size, peak_memory and runtime.
+    '''
+    n_fine = grid_cells(lat_min, lat_max, lon_min, lon_max, RES_FINE)
+    n_coarse = grid_cells(lat_min, lat_max, lon_min, lon_max, RES_COARSE)
+    n_time = n_timesteps(start_year, end_year)
+
+    if memory_budget is not None:
+        if block_size is None:
+            block_size = choose_block_size(memory_budget, n_fine, n_time, n_coarse, dtype, regrid_method,
+                                           lapse_rate_window, blocks)
+        elif peak_memory(n_fine, n_time, block_size, n_coarse, dtype, regrid_method,
+                         lapse_rate_window, blocks) > memory_budget:
+            # the given block size is too large, but a smaller one may fit
+            block_size = min(block_size, choose_block_size(memory_budget, n_fine, n_time, n_coarse, dtype,
+                                                           regrid_method, lapse_rate_window, blocks) or n_time)
+
+    return {'n_fine': n_fine,
+            'n_time': n_time,
+            'block_size': block_size,
+            'peak_memory': peak_memory(n_fine, n_time, block_size, n_coarse, dtype, regrid_method,
+                                       lapse_rate_window, blocks),
+            'runtime': runtime(n_fine, n_time, regrid_method)}
+
+def describe(plan):
+    '''
+    Short human readable text of a plan of plan_run.
+    '''
+    text = 'Estimated peak memory {}, runtime {:.0f} min'.format(format_size(plan['peak_memory']),
+                                                                  math.ceil(plan['runtime']/60.))
+    if plan['block_size'] is not None:
+        text += ' (blocks of {} days)'.format(plan['block_size'])
+    return text
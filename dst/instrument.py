@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+Stage-level instrumentation of the climaproof downscaling tool
+--> wall time, CPU time, memory and array shapes of every stage of a run
+
+A Tracer collects one span per stage (and block) of start_tool: load,
+subset, weights, gradients, read, detrend, regrid, coast fill, re-trend,
+write, climatology and pyramid. Every span is a dict with
+
+    name      stage name
+    start     start of the span in seconds since the tracer was created
+    wall      wall time (seconds)
+    cpu       CPU time of the process (seconds, all threads)
+    rss       change of the resident memory of the process (bytes)
+    max_rss   peak resident memory of the process so far (bytes)
+    heap      change of the traced Python/numpy heap (bytes), only if
+              tracemalloc is tracing
+    info      array shapes and other values of the stage, e.g. the block start
+
+The spans are kept in tracer.spans and, with a path, appended to that file as
+JSON lines. Without a tracer the stages use NULL_TRACER, whose spans do
+nothing, so the instrumentation costs nothing when it is disabled.
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    # not available on windows
+    resource = None
+
+def rss():
+    '''
+    Current resident memory of the process in bytes (None if unknown).
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+def max_rss():
+    '''
+    Peak resident memory of the process in bytes (None if unknown).
+    '''
+    if resource is None:
+        return None
+    # kilobytes on linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak*1024
+
+def _info(values):
+    # shapes of arrays, everything else as it is
+    return {k: list(v.shape) if hasattr(v, 'shape') else v for k, v in values.items()}
+
+
+class Span(object):
+    """
+    A running stage of a Tracer, used as context manager.
+    """
+
+    def __init__(self, tracer, name, info):
+        self.tracer = tracer
+        self.name = name
+        self.info = _info(info)
+
+    def add(self, **info):
+        '''
+        Add array shapes or other values to the span, e.g. of the results of the stage.
+        '''
+        self.info.update(_info(info))
+
+    def __enter__(self):
+        self._rss = rss()
+        self._heap = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None
+        self._cpu = time.process_time()
+        self._wall = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter()
+        record = {'name': self.name,
+                  'start': self._wall-self.tracer.t0,
+                  'wall': wall-self._wall,
+                  'cpu': time.process_time()-self._cpu,
+                  'max_rss': max_rss(),
+                  'info': self.info}
+        current = rss()
+        record['rss'] = None if (current is None) or (self._rss is None) else current-self._rss
+        if (self._heap is not None) and tracemalloc.is_tracing():
+            record['heap'] = tracemalloc.get_traced_memory()[0]-self._heap
+        if exc[0] is not None:
+            record['error'] = exc[0].__name__
+        self.tracer.record(record)
+        return False
+
+
+class Tracer(object):
+    """
+    Collects the spans of a run (see the module docstring).
+
+    path: file the spans are appended to as JSON lines (optional).
+    labels: dict added to every span, e.g. to tell the jobs of a batch apart.
+    """
+
+    def __init__(self, path=None, labels=None):
+        self.path = path
+        self.labels = labels if labels is not None else {}
+        self.spans = []
+        self.t0 = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def span(self, name, **info):
+        '''
+        Context manager timing the stage name; info are array shapes or other
+        values of the stage.
+        '''
+        return Span(self, name, info)
+
+    def record(self, record):
+        record.update(self.labels)
+        with self._lock:
+            self.spans.append(record)
+            if self.path is not None:
+                with open(self.path, 'a') as f:
+                    f.write(json.dumps(record, sort_keys=True)+'\n')
+
+    def summary(self):
+        '''
+        Total wall and CPU time and largest memory change of every stage, in
+        the order the stages first ran.
+        Returns a list of dicts with the keys name, count, wall, cpu and rss.
+        '''
+        stages = {}
+        order = []
+        for span in self.spans:
+            if span['name'] not in stages:
+                order.append(span['name'])
+                stages[span['name']] = {'name': span['name'], 'count': 0, 'wall': 0., 'cpu': 0., 'rss': None}
+            stage = stages[span['name']]
+            stage['count'] += 1
+            stage['wall'] += span['wall']
+            stage['cpu'] += span['cpu']
+            if span['rss'] is not None:
+                stage['rss'] = max(stage['rss'] or 0, span['rss'])
+        return [stages[name] for name in order]
+
+
+class _NullSpan(object):
+
+    def add(self, **info):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class _NullTracer(object):
+    """
+    Tracer of uninstrumented runs, its spans do nothing.
+    """
+    spans = []
+
+    def span(self, name, **info):
+        return _NULL_SPAN
+
+    def summary(self):
+        return []
+
+
+_NULL_SPAN = _NullSpan()
+NULL_TRACER = _NullTracer()
+
+def read_trace(path):
+    '''
+    Spans of a JSON lines file written by a Tracer.
+    '''
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+Background job queue of the climaproof downscaling tool
+--> runs downscaling jobs outside of the bokeh event loop
+
+One queue is shared by all sessions of the bokeh server process, at most
+DST_MAX_JOBS (environment variable, default 1) jobs run at the same time, all
+others wait in submission order. Jobs with a memory estimate only start
+while the estimates of all running jobs fit into the memory budget of the
+queue (DST_MEMORY_BUDGET, see estimate.default_budget), jobs which do not
+fit at all are refused. Jobs report their progress through the
+progress argument of the job function and are cancelled at the next report.
+"""
+
+import itertools
+import os
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import estimate
+
+
+class JobCancelled(Exception):
+    """
+    Raised inside a job function when its job has been cancelled.
+    """
+    pass
+
+
+class Job(object):
+    """
+    A downscaling job in the queue with its status, stage and progress
+    """
+
+    def __init__(self, job_id, fn, args, kwargs, memory=0):
+        self.id = job_id
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        # estimated peak memory in bytes
+        self.memory = memory
+
+        # queued, running, done, failed or cancelled
+        self.status = 'queued'
+        self.stage = ''
+        self.progress = 0.
+        self.result = None
+        self.error = None
+
+        self._cancel = threading.Event()
+        self.future = None
+
+    def report(self, stage, progress=0.):
+        """
+        Progress callback of the job function: stage name and fraction (0-1)
+        of the stage done. Raises JobCancelled if the job has been cancelled.
+        """
+        if self._cancel.is_set():
+            raise JobCancelled()
+        self.stage = stage
+        self.progress = progress
+
+    def cancel(self):
+        """
+        Cancel the job: queued jobs never start, running jobs stop at their
+        next progress report.
+        """
+        self._cancel.set()
+        if (self.future is not None) and self.future.cancel():
+            self.status = 'cancelled'
+
+    def finished(self):
+        return self.status in ('done', 'failed', 'cancelled')
+
+    def run(self):
+        if self._cancel.is_set():
+            self.status = 'cancelled'
+            return
+        self.status = 'running'
+        try:
+            self.result = self.fn(*self.args, progress=self.report, **self.kwargs)
+            self.status = 'done'
+        except JobCancelled:
+            self.status = 'cancelled'
+        except Exception as e:
+            self.error = e
+            self.status = 'failed'
+            print("------------- ERROR -------------")
+            traceback.print_exc()
+
+
+class JobQueue(object):
+    """
+    Queue of jobs running in a bounded pool of background threads
+    """
+
+    def __init__(self, max_workers=1, memory_budget=None):
+        self.max_workers = max_workers
+        self.memory_budget = memory_budget
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._ids = itertools.count(1)
+        self._jobs = []
+        self._lock = threading.Lock()
+        # memory estimates of the running jobs
+        self._memory_used = 0
+        self._memory_freed = threading.Condition(self._lock)
+
+    def submit(self, fn, *args, memory=0, **kwargs):
+        """
+        Queue fn(*args, progress=..., **kwargs) and return its Job.
+        memory is the estimated peak memory of the job in bytes; jobs which
+        need more than the memory budget raise MemoryError.
+        """
+        if (self.memory_budget is not None) and (memory > self.memory_budget):
+            raise MemoryError('The job needs about {}, but the memory budget is {}.'.format(
+                estimate.format_size(memory), estimate.format_size(self.memory_budget)))
+        with self._lock:
+            job = Job(next(self._ids), fn, args, kwargs, memory)
+            self._jobs.append(job)
+            job.future = self._executor.submit(self._run, job)
+        # also called for jobs cancelled before they started
+        job.future.add_done_callback(lambda future: self._remove(job))
+        return job
+
+    def _run(self, job):
+        # wait until the job fits into the memory left by the running jobs
+        with self._memory_freed:
+            while ((self.memory_budget is not None) and (self._memory_used > 0) and
+                   (self._memory_used+job.memory > self.memory_budget) and not job._cancel.is_set()):
+                job.stage = 'waiting for memory'
+                self._memory_freed.wait(1.)
+            self._memory_used += job.memory
+        try:
+            job.run()
+        finally:
+            with self._memory_freed:
+                self._memory_used -= job.memory
+                self._memory_freed.notify_all()
+
+    def _remove(self, job):
+        with self._lock:
+            if job in self._jobs:
+                self._jobs.remove(job)
+
+    def position(self, job):
+        """
+        Position of a queued job in the queue (1 is the next one to start),
+        0 if it is not waiting.
+        """
+        with self._lock:
+            queued = [j for j in self._jobs if j.status == 'queued']
+        return queued.index(job)+1 if job in queued else 0
+
+    def status_text(self, job):
+        """
+        Short human readable status of a job.
+        """
+        if (job.status == 'queued') and (job.stage == 'waiting for memory'):
+            return 'Queued (waiting for memory)'
+        elif job.status == 'queued':
+            return 'Queued (position {})'.format(self.position(job))
+        elif job.status == 'running':
+            return 'Running: {} ({:.0f}%)'.format(job.stage, 100*job.progress)
+        elif job.status == 'failed':
+            return 'Failed: {}'.format(job.error)
+        return job.status.capitalize()
+
+
+# queue shared by all sessions of the server process
+queue = JobQueue(int(os.environ.get('DST_MAX_JOBS', 1)), estimate.default_budget())
@@ -28,7 +28,24 @@ DOCKER_CONTAINER = os.environ.get('AM_I_IN_A_DOCKER_CONTAINER', False)
 if not DOCKER_CONTAINER == "True":
     from PyQt5.QtWidgets import QFileDialog, QApplication
 
-from downscaling_functions import start_tool
+# number of tiles regridded in parallel (environment variable DST_TILES, default untiled)
+TILES = int(os.environ['DST_TILES']) if os.environ.get('DST_TILES') else None
+
+# engine of the downscaling (environment variable DST_ENGINE, 'numpy' or 'dask')
+ENGINE = os.environ.get('DST_ENGINE', 'numpy')
+
+# file the stage timings of all runs are appended to (environment variable DST_TRACE, optional)
+TRACE = os.environ.get('DST_TRACE')
+
+# longest time block of a run, so its progress is updated and a cancel is seen at least once a year
+MAX_BLOCK_SIZE = 365
+
+from downscaling_functions import start_tool, climatology_path, open_climatology
+import data_catalog
+import estimate
+import instrument
+import jobs
+import pyramid
 
 from bokeh.tile_providers import STAMEN_TONER
 from bokeh.models import WMTSTileSource
@@ -188,60 +205,194 @@ def gui_dirname(div_mod, directory='data'):
 
 # ----------------------------------------------------------------
 
-def run_tool(event):
-    try:
-        if DOCKER_CONTAINER == "True":
-            if not os.path.exists(os.path.join('/data', 'outp')):
-                os.makedirs(os.path.join('/data', 'outp'))
-
-            data_regrid_fn, data_coarse = start_tool(inp_var.value, inp_data_type.value,
-                                                     os.path.join('/data', div_src_data.value.rsplit('\\',1)[-1]),
-                                                     os.path.join('/data', div_dst_topo.value.rsplit('\\',1)[-1]),
-                                                     os.path.join('/data', div_src_topo.value.rsplit('\\',1)[-1]),
-                                                     os.path.join('/data', 'outp'),
-                                                     json.loads(inp_lat.value)[0], json.loads(inp_lat.value)[1],
-                                                     json.loads(inp_lon.value)[0], json.loads(inp_lon.value)[1],
-                                                     int(inp_start_year.value), int(inp_end_year.value),
-                                                     regrid_method = inp_reg_method.value)
-        else:
-            data_regrid_fn, data_coarse = start_tool(inp_var.value, inp_data_type.value,
+def start_args():
+    """Arguments of start_tool from the current inputs"""
+    if DOCKER_CONTAINER == "True":
+        if not os.path.exists(os.path.join('/data', 'outp')):
+            os.makedirs(os.path.join('/data', 'outp'))
+
+        args = (inp_var.value, inp_data_type.value,
+                os.path.join('/data', div_src_data.value.rsplit('\\',1)[-1]),
+                os.path.join('/data', div_dst_topo.value.rsplit('\\',1)[-1]),
+                os.path.join('/data', div_src_topo.value.rsplit('\\',1)[-1]),
+                os.path.join('/data', 'outp'),
+                json.loads(inp_lat.value)[0], json.loads(inp_lat.value)[1],
+                json.loads(inp_lon.value)[0], json.loads(inp_lon.value)[1],
+                int(inp_start_year.value), int(inp_end_year.value))
+    else:
+        args = (inp_var.value, inp_data_type.value,
                 div_src_data.text,
                 div_dst_topo.text, div_src_topo.text,
                 div_dir_dest.text,
                 json.loads(inp_lat.value)[0], json.loads(inp_lat.value)[1],
                 json.loads(inp_lon.value)[0], json.loads(inp_lon.value)[1],
-                int(inp_start_year.value), int(inp_end_year.value),
-                regrid_method = inp_reg_method.value)
-
-        data_regrid = xr.open_dataset(data_regrid_fn)
-
-        # Plot
-        renderer = gv.renderer('bokeh')
-        dataset_coarse = gv.Dataset(data_coarse[inp_var.value].groupby('time.season').mean('time'),
-                                    kdims=['season', 'lon', 'lat'],
-                                    crs=crs.PlateCarree())
-        dataset_regrid = gv.Dataset(data_regrid[inp_var.value].groupby('time.season').mean('time'),
-                                    kdims=['season', 'lon', 'lat'],
-                                    crs=crs.PlateCarree())
-
-        gv_plot = renderer.get_plot(
-            (dataset_coarse.to(gv.Image, ['lon','lat']).options(width=350, colorbar=True, alpha=0.6, title="Coarse data") * gv.WMTS(tiles['Wikipedia'])) + \
-            (dataset_regrid.to(gv.Image, ['lon','lat']).options(width=350, colorbar=True, alpha=0.6, title="Downscaled data") * gv.WMTS(tiles['Wikipedia']))
-        )
-
-        inp_sel_season = bmo.widgets.Select(title="Season:",
-                                value="DJF",
-                                options=["DJF","JJA","MAM","SON"])
-        inp_sel_season.on_change('value', lambda attrname, old, new: gv_plot.update((new,)))
-        l.children[-1] = bo.layouts.layout(bo.layouts.row([inp_sel_season]),
-                                            bo.layouts.row([gv_plot.state]))
-
-        div_spinner.text = done_text
+                int(inp_start_year.value), int(inp_end_year.value))
+
+    return args, dict(regrid_method = inp_reg_method.value, tiles = TILES,
+                      tracer = instrument.Tracer(TRACE), engine = ENGINE)
+
+def missing_files():
+    """Names of the input files, which are not chosen yet"""
+    if DOCKER_CONTAINER == "True":
+        chosen = (div_src_data.value, div_dst_topo.value, div_src_topo.value)
+    else:
+        chosen = (div_src_data.text, div_dst_topo.text, div_src_topo.text)
+    names = ("source data", "high res. topography", "source topography")
+    return [name for name, fn in zip(names, chosen) if not fn]
+
+def run_tool(event):
+    """Submit a downscaling job to the background queue and poll its status"""
+    global job, poll_callback
+    try:
+        if (job is not None) and not job.finished():
+            hide_spinner()
+            div_status.text = "A job is already running. " + jobs.queue.status_text(job)
+            return
+
+        missing = missing_files()
+        if missing:
+            hide_spinner()
+            div_status.text = "Please choose the {} first.".format(", ".join(missing))
+            if DOCKER_CONTAINER == "True":
+                div_status.text += " The files in /data are offered as soon as they are indexed."
+            return
+
+        args, kwargs = start_args()
+
+        # check the memory needed before starting and choose the block size for the budget
+        blocks = 1
+        if ENGINE == 'dask':
+            import dask_engine
+            blocks = dask_engine.blocks_in_memory()
+        try:
+            plan = estimate.plan_run(*args[6:12], regrid_method = kwargs['regrid_method'],
+                                     block_size = MAX_BLOCK_SIZE,
+                                     memory_budget = jobs.queue.memory_budget, blocks = blocks)
+        except MemoryError as e:
+            hide_spinner()
+            div_status.text = str(e)
+            return
+        kwargs['block_size'] = plan['block_size']
+
+        job = jobs.queue.submit(start_tool, *args, memory = plan['peak_memory'], **kwargs)
+        div_timing.text = estimate.describe(plan)
+        div_status.text = jobs.queue.status_text(job)
+
+        if poll_callback is None:
+            poll_callback = bpl.curdoc().add_periodic_callback(poll_job, 1000)
     except Exception as e:
         div_spinner.text = error_text
         print("------------- ERROR -------------")
         print(e.args)
 
+def cancel_job():
+    if job is not None:
+        job.cancel()
+        div_status.text = jobs.queue.status_text(job)
+
+def poll_job():
+    """Periodic callback: show the progress of the job and the results once it is finished"""
+    global poll_callback
+    div_status.text = jobs.queue.status_text(job)
+    if not job.finished():
+        return
+
+    bpl.curdoc().remove_periodic_callback(poll_callback)
+    poll_callback = None
+
+    div_timing.text = timing_table(job.kwargs['tracer'])
+    if job.status == 'done':
+        try:
+            show_results(*job.result)
+            div_spinner.text = done_text
+        except Exception as e:
+            div_spinner.text = error_text
+            print("------------- ERROR -------------")
+            print(e.args)
+    elif job.status == 'failed':
+        div_spinner.text = error_text
+    else:
+        hide_spinner()
+
+def timing_table(tracer):
+    """HTML table of the time and memory spent in every stage of a run"""
+    rows = ["<tr><th>Stage</th><th>Runs</th><th>Wall [s]</th><th>CPU [s]</th><th>Memory [MB]</th></tr>"]
+    for stage in tracer.summary():
+        memory = '' if stage['rss'] is None else '{:.0f}'.format(stage['rss']/1024.**2)
+        rows.append("<tr><td>{}</td><td>{}</td><td>{:.2f}</td><td>{:.2f}</td><td>{}</td></tr>".format(
+            stage['name'], stage['count'], stage['wall'], stage['cpu'], memory))
+    if len(rows) == 1:
+        return ""
+    return "<table>" + "".join(rows) + "</table>"
+
+def show_results(data_regrid_fn, data_coarse):
+    """Plot the seasonal means of the coarse and the downscaled data"""
+    # the seasonal means are read from the small climatology file of the output
+    # and the downscaled ones from the pyramid of their lower resolution levels
+    fn_clim = climatology_path(data_regrid_fn)
+    fn_pyramid = pyramid.pyramid_path(data_regrid_fn)
+    if os.path.exists(fn_clim):
+        season_coarse = open_climatology(fn_clim, inp_var.value, 'coarse')
+    else:
+        season_coarse = data_coarse[inp_var.value].groupby('time.season').mean('time')
+
+    if os.path.exists(fn_pyramid):
+        levels = pyramid.open_pyramid(fn_pyramid)
+    else:
+        if os.path.exists(fn_clim):
+            season_regrid = open_climatology(fn_clim, inp_var.value, 'fine')
+        else:
+            data_regrid = xr.open_dataset(data_regrid_fn)
+            season_regrid = data_regrid[inp_var.value].groupby('time.season').mean('time')
+        levels = pyramid.build_pyramid(season_regrid)
+        pyramid.write_pyramid(fn_pyramid, levels)
+
+    def image_regrid(season, x_range=None, y_range=None):
+        """Downscaled data of the pyramid level matching the zoom of the plot"""
+        lon_range, lat_range = None, None
+        if (x_range is not None) and (y_range is not None):
+            lon_range, lat_range = pyramid.mercator_to_lonlat(x_range, y_range)
+        field = pyramid.select_level(levels, lon_range, lat_range).sel(season=season)
+        return gv.Image(field, kdims=['lon','lat'], crs=crs.PlateCarree()).options(width=350, colorbar=True, alpha=0.6, title="Downscaled data")
+
+    # Plot
+    renderer = gv.renderer('bokeh')
+    dataset_coarse = gv.Dataset(season_coarse,
+                                kdims=['season', 'lon', 'lat'],
+                                crs=crs.PlateCarree())
+    dmap_regrid = hv.DynamicMap(image_regrid, kdims=['season'],
+                                streams=[hv.streams.RangeXY()]).redim.values(season=["DJF","JJA","MAM","SON"])
+
+    gv_plot = renderer.get_plot(
+        (dataset_coarse.to(gv.Image, ['lon','lat']).options(width=350, colorbar=True, alpha=0.6, title="Coarse data") * gv.WMTS(tiles['Wikipedia'])) + \
+        (dmap_regrid * gv.WMTS(tiles['Wikipedia']))
+    )
+
+    inp_sel_season = bmo.widgets.Select(title="Season:",
+                            value="DJF",
+                            options=["DJF","JJA","MAM","SON"])
+    inp_sel_season.on_change('value', lambda attrname, old, new: gv_plot.update((new,)))
+    l.children[-1] = bo.layouts.layout(bo.layouts.row([inp_sel_season]),
+                                        bo.layouts.row([gv_plot.state]))
+
+
+def upd_file_options(attrname=None, old=None, new=None):
+    """Offer only the files of the data directory, which fit the current inputs (docker mode)"""
+    try:
+        lat = json.loads(inp_lat.value)
+        lon = json.loads(inp_lon.value)
+        start_year, end_year = int(inp_start_year.value), int(inp_end_year.value)
+    except (ValueError, TypeError):
+        return
+
+    options = ((div_src_data, data_catalog.find_data('/data', inp_var.value, lat, lon, start_year, end_year,
+                                                     estimate.RES_COARSE)),
+               (div_dst_topo, data_catalog.find_topo('/data', estimate.RES_FINE, lat, lon)),
+               (div_src_topo, data_catalog.find_topo('/data', estimate.RES_COARSE, lat, lon)))
+    for select, files in options:
+        select.options = [""] + files
+        if select.value not in select.options:
+            select.value = files[0] if files else ""
 
 def upd_lat_lon(attrname, old, new):
     inp_lat.value = str(bbox_countries[new]['lat'])
@@ -280,6 +431,12 @@ div_hr = bmo.Div(text="<hr>", width=800)
 # Create empty div for spinner
 div_spinner = bmo.widgets.Div(text="",width=120,height=120)
 
+# Job of this session and the periodic callback polling it
+job = None
+poll_callback = None
+div_status = bmo.widgets.Div(text="", width=300)
+div_timing = bmo.widgets.Div(text="", width=400)
+
 # Create Input controls
 inp_country = bmo.widgets.Select(title="Country",
                                  value = "Whole Domain",
@@ -305,6 +462,9 @@ inp_reg_method = bmo.widgets.Select(title="Regridding method:",
 
 inp_run_tool = bmo.widgets.Button(label="Run Tool",
                                 button_type="success")
+inp_cancel = bmo.widgets.Button(label="Cancel",
+                                button_type="danger")
+inp_cancel.on_click(cancel_job)
 
 
 inp_country.on_change('value', upd_lat_lon)
@@ -322,21 +482,29 @@ if DOCKER_CONTAINER == "True":
     inp_src_data = bmo.Div(text="Source data:", width=100)
     # div_src_data = FileInput()
     # div_src_data = bmo.Div(text="""<input id="src_data" type="file">""")
-    div_src_data = bmo.widgets.TextInput(value="/tmp")
+    # the files of /data, which fit the inputs, from the data catalog
+    div_src_data = bmo.widgets.Select(value="", options=[""])
     # div_src_data.on_change('value', file_inputs)
 
     inp_src_topo = bmo.Div(text="Source topo", width=100)
     # div_src_topo = FileInput()
     #div_src_topo = bmo.Div(text="""<input id="src_topo" type="file">""")
-    div_src_topo = bmo.widgets.TextInput(value="/tmp")
+    div_src_topo = bmo.widgets.Select(value="", options=[""])
 
     inp_dst_topo = bmo.Div(text="High res. Topo", width=100)
     # div_dst_topo = FileInput()
     #div_dst_topo = bmo.Div(text="""<input id="dst_topo" type="file">""")
-    div_dst_topo = bmo.widgets.TextInput(value="/tmp")
+    div_dst_topo = bmo.widgets.Select(value="", options=[""])
 
     inp_dir_dest = bmo.Div(text="", width=100)
     div_dir_dest = bmo.Div(text="", width=600)
+
+    data_catalog.start_scanner('/data')
+    for inp in (inp_var, inp_lat, inp_lon, inp_start_year, inp_end_year):
+        inp.on_change('value', upd_file_options)
+    upd_file_options()
+    # files found by the scanner show up without changing the inputs
+    bpl.curdoc().add_periodic_callback(upd_file_options, 10000)
 else:
     inp_src_data= bmo.widgets.Button(label="Source data")
     inp_src_data.on_click(lambda: gui_fname(div_src_data))
@@ -366,10 +534,12 @@ inputs = bo.layouts.row([
         bo.layouts.row([inp_start_year, inp_end_year]),
         bo.layouts.row([inp_reg_method]),
         bo.layouts.row([inp_dir_dest, div_dir_dest]),
-        bo.layouts.row([inp_run_tool]),
+        bo.layouts.row([inp_run_tool, inp_cancel]),
         ]),
     bo.layouts.column([
         bo.layouts.row([div_spinner]),
+        bo.layouts.row([div_status]),
+        bo.layouts.row([div_timing]),
     ]),
 ])
 
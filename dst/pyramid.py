@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+Multi-resolution pyramid of the downscaled fields for the climaproof downscaling tool
+--> the results view only sends as many cells to the browser as fit its size
+
+Every level averages factor x factor cells of the 0.01° field (0.01°, 0.02°,
+0.05° and 0.1° for the default factors). The levels are built once per output
+file and saved next to it, the view picks the finest level, whose cells in
+the current viewport do not exceed MAX_CELLS, and cuts it to the viewport.
+"""
+
+import os
+import warnings
+
+import numpy as np
+import xarray as xr
+
+from cache_utils import PART_SUFFIX
+
+# averaging factors of the levels (1 is the field itself)
+LEVELS = (1, 2, 5, 10)
+
+# maximum number of cells sent to the browser for one image
+MAX_CELLS = 250000
+
+# suffix of the pyramid file written next to every output file
+PYRAMID_SUFFIX = '_pyramid.nc'
+
+# radius of the spherical web mercator projection in metres
+EARTH_RADIUS = 6378137.
+
+def _block_mean(values, factor, axes):
+    '''
+    nan-mean over blocks of factor cells along the axes of values; the last
+    block is padded with nan values if the axis length is not a multiple.
+    '''
+    for axis in axes:
+        n = values.shape[axis]
+        pad = [(0, 0)]*values.ndim
+        pad[axis] = (0, -n % factor)
+        values = np.pad(values.astype(np.float64), pad, mode='constant', constant_values=np.nan)
+        shape = values.shape[:axis]+(values.shape[axis]//factor, factor)+values.shape[axis+1:]
+        with np.errstate(invalid='ignore'):
+            values = np.nanmean(values.reshape(shape), axis=axis+1)
+    return values
+
+def coarsen(field, factor):
+    '''
+    Average factor x factor cells of the DataArray field (..., lat, lon).
+    '''
+    if factor == 1:
+        return field
+    lat = _block_mean(field['lat'].data, factor, (0,))
+    lon = _block_mean(field['lon'].data, factor, (0,))
+    values = _block_mean(field.data, factor, (field.ndim-2, field.ndim-1))
+    coords = {d: field[d] for d in field.dims[:-2] if d in field.coords}
+    coords['lat'] = lat
+    coords['lon'] = lon
+    return xr.DataArray(values.astype(field.dtype), dims=field.dims, coords=coords,
+                        attrs=field.attrs, name=field.name)
+
+def build_pyramid(field, levels=LEVELS):
+    '''
+    Dict of factor -> field averaged over factor x factor cells.
+    '''
+    with warnings.catch_warnings():
+        # blocks of sea cells only are nan
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return {factor: coarsen(field, factor) for factor in levels}
+
+def pyramid_path(fn_nc):
+    '''
+    Pyramid file of the downscaled file fn_nc.
+    '''
+    return os.path.splitext(fn_nc)[0]+PYRAMID_SUFFIX
+
+def write_pyramid(fn_pyramid, pyramid):
+    '''
+    Save the levels of a pyramid as the groups level_<factor> of one netCDF file.
+    '''
+    fn_part = fn_pyramid+PART_SUFFIX
+    mode = 'w'
+    for factor in sorted(pyramid):
+        pyramid[factor].to_dataset().to_netcdf(fn_part, mode=mode, group='level_'+str(factor))
+        mode = 'a'
+    os.replace(fn_part, fn_pyramid)
+
+def open_pyramid(fn_pyramid, levels=LEVELS):
+    '''
+    Read the levels of a pyramid file to a dict of factor -> field.
+    '''
+    pyramid = {}
+    for factor in levels:
+        ds = xr.open_dataset(fn_pyramid, group='level_'+str(factor)).load()
+        ds.close()
+        pyramid[factor] = ds[list(ds.data_vars)[0]]
+    return pyramid
+
+def mercator_to_lonlat(x, y):
+    '''
+    Longitude and latitude of web mercator coordinates in metres.
+    '''
+    lon = np.degrees(np.asarray(x, dtype=np.float64)/EARTH_RADIUS)
+    lat = np.degrees(2*np.arctan(np.exp(np.asarray(y, dtype=np.float64)/EARTH_RADIUS)) - np.pi/2)
+    return lon, lat
+
+def select_level(pyramid, lon_range=None, lat_range=None, max_cells=MAX_CELLS):
+    '''
+    Finest level of the pyramid, whose part inside the lon/lat ranges of the
+    viewport has at most max_cells cells (the coarsest level otherwise),
+    cut to the viewport (with one cell margin).
+    Without ranges the whole domain is shown.
+    '''
+    for factor in sorted(pyramid):
+        field = pyramid[factor]
+        lat = field['lat'].data
+        lon = field['lon'].data
+        lat_sel = np.ones(len(lat), dtype=bool)
+        lon_sel = np.ones(len(lon), dtype=bool)
+        if lat_range is not None:
+            step = np.abs(np.diff(lat[:2])).max() if len(lat) > 1 else 0
+            lat_sel = (lat >= min(lat_range)-step) & (lat <= max(lat_range)+step)
+        if lon_range is not None:
+            step = np.abs(np.diff(lon[:2])).max() if len(lon) > 1 else 0
+            lon_sel = (lon >= min(lon_range)-step) & (lon <= max(lon_range)+step)
+        if lat_sel.sum()*lon_sel.sum() <= max_cells:
+            break
+
+    return field.isel(lat=np.flatnonzero(lat_sel), lon=np.flatnonzero(lon_sel))
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Linear regression of the climaproof downscaling tool
+--> height dependency (lapse rate) of the coarse data
+
+All fits are solved in closed form for whole stacks of samples at once
+(e.g. all months and variables), cells with nan values are left out of the
+fit they belong to. The local fits use box filters over the lat/lon window
+of every cell instead of loops over the cells.
+"""
+
+import numpy as np
+from scipy import ndimage as nd
+
+# minimum number of valid cells of a local window, windows with less cells
+# get the slope of the fit over the whole domain
+MIN_LOCAL_CELLS = 4
+
+def _valid(x, y):
+    x, y = np.broadcast_arrays(np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64))
+    valid = ~np.isnan(x) & ~np.isnan(y)
+    return np.where(valid, x, 0), np.where(valid, y, 0), valid.astype(np.float64)
+
+def fit(x, y, axis=-1):
+    '''
+    Least-squares fit y = slope*x + intercept along axis, for all other
+    dimensions of the (broadcast) arrays x and y at once.
+    Returns slope and intercept (nan where less than two valid values).
+    '''
+    x, y, valid = _valid(x, y)
+    n = valid.sum(axis=axis, keepdims=True)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x_mean = x.sum(axis=axis, keepdims=True)/n
+        y_mean = y.sum(axis=axis, keepdims=True)/n
+
+        x_anom = (x - x_mean)*valid
+        y_anom = (y - y_mean)*valid
+
+        slope = (x_anom*y_anom).sum(axis=axis, keepdims=True)/(x_anom**2).sum(axis=axis, keepdims=True)
+        intercept = y_mean - slope*x_mean
+
+    return np.squeeze(slope, axis=axis), np.squeeze(intercept, axis=axis)
+
+def local_fit(x, y, size=5):
+    '''
+    Least-squares slope of y against x in a moving size x size window around
+    every cell of the last two (lat/lon) dimensions, for all leading
+    dimensions at once. Windows with less than MIN_LOCAL_CELLS valid cells or
+    without height differences get the slope of the fit over the whole domain.
+    Returns the slopes in the (broadcast) shape of x and y.
+    '''
+    x, y, valid = _valid(x, y)
+    window = (1,)*(x.ndim-2)+(size, size)
+
+    def mean(a):
+        return nd.uniform_filter(a, size=window, mode='constant')
+
+    m_v = mean(valid)
+    m_x = mean(x)
+    m_y = mean(y)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        var = mean(x*x)*m_v - m_x**2
+        slope = (mean(x*y)*m_v - m_x*m_y)/var
+
+    # box filter sums of exactly equal heights are not exactly 0
+    flat = var <= 1e-10*mean(x*x)*m_v
+    too_few = np.round(m_v*size**2) < MIN_LOCAL_CELLS
+
+    # x and y of invalid cells are 0 here, so they are set to nan again
+    y_nan = np.where(valid > 0, y, np.nan)
+    slope_domain = fit(x.reshape(x.shape[:-2]+(-1,)), y_nan.reshape(y.shape[:-2]+(-1,)))[0]
+    slope_domain = slope_domain[...,np.newaxis,np.newaxis]
+
+    return np.where(flat | too_few | np.isnan(slope), slope_domain, slope)
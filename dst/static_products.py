@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Static products of a domain of the climaproof downscaling tool
+--> runs on a domain seen before skip subsetting the topography and fitting
+the gradients
+
+Apart from the data itself, everything a run needs only depends on the domain
+and (for the gradients) on the data file(s), variable and years:
+
+    domain        subset fine and coarse topography, land mask of the fine
+                  grid and the heights in the dtype of the computation
+                  (see StaticProducts)
+    climatology   monthly sums and counts of the coarse data (for the
+                  climatology file) and the monthly gradients fitted to them
+
+Both are kept in memory, where the MEMORY_ENTRIES most recently used ones are
+shared by all runs of a process (e.g. the bokeh server), and in the on-disk
+cache, so they survive restarts. Their keys contain the identity of the input
+files (path, size and modification time, see input_identity) like the result
+cache, so changed inputs are never served from the cache.
+"""
+
+import os
+import threading
+
+import numpy as np
+import xarray as xr
+
+import cache_utils
+import downscaling_functions as df
+
+# products kept in memory per kind
+MEMORY_ENTRIES = 8
+
+_domains = {}
+_climatologies = {}
+_lock = threading.Lock()
+
+
+class StaticProducts(object):
+    """
+    Subset topography of a domain with its land mask and heights.
+
+    topo_fine/topo_coarse: loaded topography subsets of the domain.
+    key: cache key of the domain (None for domains outside the cache).
+    """
+
+    def __init__(self, topo_fine, topo_coarse, key=None):
+        self.key = key
+        self.topo_fine = topo_fine
+        self.topo_coarse = topo_coarse
+        self.topo_mask = ~np.isnan(topo_fine['height'].data)
+        self._heights = {}
+
+    def heights(self, dtype):
+        '''
+        Coarse and fine heights as arrays of dtype, converted once per dtype.
+        '''
+        key = np.dtype(dtype).str
+        if key not in self._heights:
+            self._heights[key] = (self.topo_coarse['height'].data.astype(dtype, copy=False),
+                                  self.topo_fine['height'].data.astype(dtype, copy=False))
+        return self._heights[key]
+
+
+def _remember(store, key, value):
+    # keep only the most recently used products in memory
+    with _lock:
+        store.pop(key, None)
+        store[key] = value
+        while len(store) > MEMORY_ENTRIES:
+            store.pop(next(iter(store)))
+
+def _recall(store, key):
+    with _lock:
+        value = store.pop(key, None)
+        if value is not None:
+            store[key] = value
+        return value
+
+def _paths(key):
+    directory = cache_utils.cache_dir('static')
+    return directory, [os.path.join(directory, key+suffix) for suffix in ('_topo_fine.nc', '_topo_coarse.nc')]
+
+def _load_netcdf(fn):
+    ds = xr.open_dataset(fn)
+    ds.load()
+    ds.close()
+    return ds
+
+def domain(ds_subset, path_to_topo_fine, path_to_topo_coarse, lat_min, lat_max, lon_min, lon_max,
+           topo_identity=None, static_cache=True):
+    '''
+    StaticProducts of the domain of the data subset ds_subset and the lat/lon
+    box, from memory, the on-disk cache or by subsetting the topography
+    (paths or opened datasets, see subset_topography).
+    topo_identity: input_identity of both topography inputs, if already known.
+    static_cache: keep the products in memory and on disk.
+    '''
+    if topo_identity is None:
+        topo_identity = (df.input_identity(path_to_topo_fine), df.input_identity(path_to_topo_coarse))
+    key = cache_utils.make_key(topo_identity[0], topo_identity[1], cache_utils.hash_grid(ds_subset),
+                               lat_min, lat_max, lon_min, lon_max)
+    if not static_cache:
+        topo_coarse, topo_fine = df.subset_topography(ds_subset, df.open_input(path_to_topo_fine),
+                                                      df.open_input(path_to_topo_coarse),
+                                                      lat_min, lat_max, lon_min, lon_max)
+        return StaticProducts(topo_fine, topo_coarse, key)
+
+    static = _recall(_domains, key)
+    if static is not None:
+        return static
+
+    directory, filenames = _paths(key)
+    if all(os.path.exists(fn) for fn in filenames):
+        topo_fine, topo_coarse = [_load_netcdf(fn) for fn in filenames]
+        for fn in filenames:
+            cache_utils.touch(fn)
+    else:
+        topo_coarse, topo_fine = df.subset_topography(ds_subset, df.open_input(path_to_topo_fine),
+                                                      df.open_input(path_to_topo_coarse),
+                                                      lat_min, lat_max, lon_min, lon_max)
+        for topo, fn in zip((topo_fine, topo_coarse), filenames):
+            with cache_utils.atomic_write(fn) as tmp_filename:
+                topo.to_netcdf(tmp_filename)
+        cache_utils.evict(directory, keep=filenames)
+
+    static = StaticProducts(topo_fine, topo_coarse, key)
+    _remember(_domains, key, static)
+    return static
+
+def coarse_climatology(static, ds_subset, variable, data_identity, start_year, end_year,
+                       block_size=None, window=None, static_cache=True):
+    '''
+    Monthly sums and counts of the coarse data ds_subset[variable] (see
+    monthly_sums) and, for the variables with a height dependency, the monthly
+    gradients fitted to them (see monthly_gradients, None for the others).
+    data_identity: input_identity of the data file(s).
+    static_cache: keep them in memory and on disk.
+    Returns sums, counts, grad.
+    '''
+    key = cache_utils.make_key(static.key, data_identity, variable, start_year, end_year, window)
+    if static_cache:
+        products = _recall(_climatologies, key)
+        if products is not None:
+            return products
+
+        directory = cache_utils.cache_dir('static')
+        filename = os.path.join(directory, key+'_clim.npz')
+        if os.path.exists(filename):
+            with np.load(filename) as f:
+                products = (f['sums'], f['counts'], f['grad'] if 'grad' in f.files else None)
+            cache_utils.touch(filename)
+            _remember(_climatologies, key, products)
+            return products
+
+    sums, counts = df.monthly_sums(ds_subset, variable, block_size)
+    grad = None
+    if variable in df.DETREND_VARIABLES:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            grad = df.fit_gradients(sums/counts, static.topo_coarse['height'].data, window)
+    products = (sums, counts, grad)
+
+    if static_cache:
+        arrays = {'sums': sums, 'counts': counts}
+        if grad is not None:
+            arrays['grad'] = grad
+        with cache_utils.atomic_write(filename) as tmp_filename, open(tmp_filename, 'wb') as f:
+            np.savez(f, **arrays)
+        cache_utils.evict(directory, keep=(filename,))
+        _remember(_climatologies, key, products)
+    return products
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Spatially tiled regridding for the climaproof downscaling tool
+--> large domains are regridded tile by tile in parallel worker processes
+
+The fine target grid is split into tiles, every tile gets the part of the
+source grid it covers plus a halo of TILE_HALO coarse cells, which is more
+than the stencils of the bilinear and patch methods need. So the weights of
+every tile are the rows of the weights of the whole domain and the stitched
+result is the same as the untiled one. The coast is filled afterwards on the
+stitched field (see correct_coast), so the fill needs no halo.
+
+Every worker builds (or reads from the weight cache) only the weights of its
+tiles and gets only the source cells of one tile at a time.
+"""
+
+import multiprocessing
+
+import numpy as np
+import xarray as xr
+
+import batch
+import downscaling_functions as df
+
+# halo of every tile in source grid cells
+TILE_HALO = 3
+
+# grids (source, target) of the tiles and their regridders in the worker processes,
+# set by _init_worker
+_grids = None
+_method = None
+_regridders = {}
+
+def split_tiles(n_lat, n_lon, tiles):
+    '''
+    Split a grid of n_lat x n_lon cells into about tiles tiles.
+    Returns the list of (lat slice, lon slice) of the tiles.
+    '''
+    n_rows = max(int(np.sqrt(tiles*float(n_lat)/n_lon)), 1)
+    n_rows = min(n_rows, n_lat, tiles)
+    n_cols = min(max(int(np.ceil(float(tiles)/n_rows)), 1), n_lon)
+
+    rows = np.array_split(np.arange(n_lat), n_rows)
+    cols = np.array_split(np.arange(n_lon), n_cols)
+    return [(slice(r[0], r[-1]+1), slice(c[0], c[-1]+1)) for r in rows for c in cols]
+
+def source_window(lat, lon, lat_fine, lon_fine, halo=TILE_HALO):
+    '''
+    Index slices of the 1D source coordinates lat/lon covering the fine
+    coordinates lat_fine/lon_fine with a halo of halo source cells.
+    '''
+    step_lat = np.abs(np.diff(lat)).max() if len(lat) > 1 else 0
+    step_lon = np.abs(np.diff(lon)).max() if len(lon) > 1 else 0
+    return (df.index_range(lat, np.min(lat_fine)-halo*step_lat, np.max(lat_fine)+halo*step_lat),
+            df.index_range(lon, np.min(lon_fine)-halo*step_lon, np.max(lon_fine)+halo*step_lon))
+
+def _init_worker(grids, method):
+    global _grids, _method
+    _grids = grids
+    _method = method
+
+def _tile_regridder(i):
+    if i not in _regridders:
+        source, target = _grids[i]
+        _regridders[i] = df.get_regridder(source, target, _method)
+    return _regridders[i]
+
+def _build_tile(i):
+    _tile_regridder(i)
+    return i
+
+def _regrid_tile(args):
+    i, values, dtype = args
+    source, target = _grids[i]
+    # the tiles already run in parallel in one process per core
+    return df.apply_regridder(_tile_regridder(i), values, (target.dims['lat'], target.dims['lon']), dtype, threads=1)
+
+
+class TiledRegridder(object):
+    """
+    Regridder from the grid of data to the grid of topo_fine, which regrids
+    tiles of the target grid in a pool of worker processes. It is used like
+    the xESMF regridders by apply_regridder; the tile weights are always kept
+    in the weight cache. close() stops the workers.
+    """
+
+    def __init__(self, data, topo_fine, regrid_method, tiles, processes=None, halo=TILE_HALO):
+        if (data['lat'].dims != ('lat',)) | (data['lon'].dims != ('lon',)):
+            raise ValueError('Tiled regridding needs 1D lat/lon coordinates.')
+
+        lat, lon = data['lat'].data, data['lon'].data
+        lat_fine, lon_fine = topo_fine['lat'].data, topo_fine['lon'].data
+        self.shape_out = (len(lat_fine), len(lon_fine))
+
+        self.tiles = []
+        grids = []
+        for tile_lat, tile_lon in split_tiles(len(lat_fine), len(lon_fine), tiles):
+            source_lat, source_lon = source_window(lat, lon, lat_fine[tile_lat], lon_fine[tile_lon], halo)
+            self.tiles.append((tile_lat, tile_lon, source_lat, source_lon))
+            grids.append((xr.Dataset(coords={'lat': lat[source_lat], 'lon': lon[source_lon]}),
+                           xr.Dataset(coords={'lat': lat_fine[tile_lat], 'lon': lon_fine[tile_lon]})))
+
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        processes = max(min(processes, len(self.tiles)), 1)
+
+        self.pool = batch.worker_pool(processes, _init_worker, (grids, regrid_method))
+
+        # build the weights of all tiles in parallel
+        self.pool.map(_build_tile, range(len(self.tiles)), chunksize=1)
+
+    def apply(self, data, shape_out, dtype=np.float64):
+        '''
+        Regrid the numpy array data (..., lat, lon) tile by tile and stitch the
+        tiles to one array (..., shape_out).
+        '''
+        data_regrid = np.empty(data.shape[:-2]+tuple(shape_out), dtype=dtype)
+        args = [(i, np.ascontiguousarray(data[..., source_lat, source_lon]), dtype)
+                for i, (tile_lat, tile_lon, source_lat, source_lon) in enumerate(self.tiles)]
+        for (tile_lat, tile_lon, source_lat, source_lon), tile in zip(self.tiles, self.pool.imap(_regrid_tile, args)):
+            data_regrid[..., tile_lat, tile_lon] = tile
+        return data_regrid
+
+    def clean_weight_file(self):
+        # the tile weights stay in the weight cache
+        pass
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
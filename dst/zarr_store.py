@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""
+Zarr output of the climaproof downscaling tool
+--> the downscaled data as a Zarr store instead of a netCDF file
+
+The store has the same variables and CF attributes as the netCDF files of
+create_netcdf/create_netcdf_obs (the dimensions of every array are in its
+_ARRAY_DIMENSIONS attribute, so xarray.open_zarr reads it like the netCDF
+files). Every chunk is a file of its own, so independent workers can open
+the store with open_store and write disjoint, chunk-aligned time blocks or
+spatial tiles at the same time (see write_block). Stores can be extended
+in time with append_block and exported to netCDF with zarr_to_netcdf.
+"""
+
+import os
+import shutil
+
+import numpy as np
+import zarr
+from numcodecs import Blosc
+from netCDF4 import Dataset
+
+import downscaling_functions as df
+
+# extension of the output stores
+ZARR_SUFFIX = '.zarr'
+
+def _array(group, name, data, dims, attrs, **kwargs):
+    array = group.array(name, data, **kwargs)
+    array.attrs.update(attrs)
+    array.attrs['_ARRAY_DIMENSIONS'] = list(dims)
+    return array
+
+def create_zarr(param_name, lat1d, lon1d, n_time, start_year, end_year, savedir, filename,
+                model_name=None, cal='gregorian',
+                zlib=True, complevel=4, shuffle=True, chunking='map', pack=False):
+    '''
+    Create the Zarr store for n_time timesteps of downscaled model data
+    (observations without model_name) and write everything but the data itself.
+    The options are the ones of downscaling_functions.create_data_variable.
+    The store keeps a temporary name until close_zarr.
+    Returns the open zarr group or None for an unknown parameter.
+    '''
+    param = df.OBS_PARAMETERS.get(param_name, param_name)
+    if (model_name is None) and (param not in df.PARAMETERS):
+        print ('unknown parameter - edit information in function!')
+        print ('aborting... no zarr store saved!')
+        return None
+
+    savename = savedir+filename+'_'+str(start_year)+'-'+str(end_year)+ZARR_SUFFIX
+    partname = savename+df.PART_SUFFIX
+    if os.path.exists(partname):
+        shutil.rmtree(partname)
+    group = zarr.open_group(partname, mode='w')
+
+    n_lat, n_lon = len(lat1d), len(lon1d)
+    shape = df.CHUNK_SHAPES[chunking] if chunking in df.CHUNK_SHAPES else chunking
+    if shape is None:
+        shape = (365, None, None)
+    chunks = tuple(size if c is None else min(c, size) for c, size in zip(shape, (n_time, n_lat, n_lon)))
+    compressor = None
+    if zlib:
+        compressor = Blosc(cname='zstd', clevel=complevel, shuffle=Blosc.SHUFFLE if shuffle else Blosc.NOSHUFFLE)
+
+    _array(group, 'time', df.time_values(n_time, start_year, end_year, cal), ('time',),
+           {'units': df.TIME_UNITS, 'calendar': cal, 'long_name': 'time', 'axis': 'T', 'standard_name': 'time'},
+           chunks=(max(n_time, 1),))
+    _array(group, 'lat', np.asarray(lat1d, dtype=np.float32), ('lat',),
+           {'units': 'degrees_north', 'long_name': 'latitude', 'standard_name': 'latitude'})
+    _array(group, 'lon', np.asarray(lon1d, dtype=np.float32), ('lon',),
+           {'units': 'degrees_east', 'long_name': 'longitude', 'standard_name': 'longitude'})
+    _array(group, 'crs', np.array(0, dtype=np.int32), (),
+           {'grid_mapping_name': 'latitude_longitude', 'longitude_of_prime_meridian': 0.0,
+            'semi_major_axis': 6378137.0, 'inverse_flattening': 298.257223563,
+            'comment': 'Latitude and longitude on the WGS 1984 datum'})
+
+    attrs = {'grid_mapping': 'latitude_longitude'}
+    if param in df.PARAMETERS:
+        attrs.update({k: df.PARAMETERS[param][k] for k in ('units', 'long_name', 'standard_name')})
+        group.attrs['title'] = df.PARAMETERS[param]['title']
+        if df.PARAMETERS[param]['message'] is not None:
+            print(df.PARAMETERS[param]['message'])
+
+    if pack is True:
+        pack = df.PARAMETERS.get(param, {}).get('pack')
+    if pack:
+        attrs.update({'scale_factor': pack[0], 'add_offset': pack[1]})
+        var = group.create_dataset(param_name, shape=(n_time, n_lat, n_lon), chunks=chunks,
+                                   dtype='i2', compressor=compressor, fill_value=df.PACKED_FILL_VALUE)
+    else:
+        var = group.create_dataset(param_name, shape=(n_time, n_lat, n_lon), chunks=chunks,
+                                   dtype='f4', compressor=compressor, fill_value=-9999)
+    var.attrs.update(attrs)
+    var.attrs['_ARRAY_DIMENSIONS'] = ['time', 'lat', 'lon']
+
+    if model_name is not None:
+        group.attrs['modelname'] = model_name
+    group.attrs['project'] = df.PROJECT
+    group.attrs['source'] = df.SOURCE
+    group.attrs['comment'] = df.COMMENT
+    group.attrs['conventions'] = "CF-1.6"
+    group.attrs['variable'] = param_name
+
+    return group
+
+def open_store(path_zarr):
+    '''
+    Open a store of create_zarr for writing, e.g. in a worker process.
+    '''
+    return zarr.open_group(path_zarr, mode='r+')
+
+def encode(array3d, scale_factor=None, add_offset=None):
+    '''
+    Downscaled data as stored: float32 with -9999 for missing values or, with
+    scale_factor and add_offset, packed int16 (see write_block of netCDF files).
+    '''
+    missing = np.isnan(array3d) | (array3d == -9999)
+    if scale_factor is None:
+        return np.where(missing, -9999, array3d).astype(np.float32)
+    packed = np.round((np.asarray(array3d, dtype=np.float64)-add_offset)/scale_factor)
+    packed = np.clip(packed, df.PACKED_FILL_VALUE+1, np.iinfo(np.int16).max)
+    packed[missing] = df.PACKED_FILL_VALUE
+    return packed.astype(np.int16)
+
+def decode(values, scale_factor=None, add_offset=None):
+    '''
+    Stored values to float32 with -9999 for missing values.
+    '''
+    if scale_factor is None:
+        return values.astype(np.float32)
+    missing = values == df.PACKED_FILL_VALUE
+    data = (values*scale_factor+add_offset).astype(np.float32)
+    data[missing] = -9999
+    return data
+
+def write_block(group, param_name, array3d, t0, lat0=0, lon0=0):
+    '''
+    Write a block of downscaled data (time, lat, lon) into a store of
+    create_zarr, starting at timestep t0 and grid cell (lat0, lon0).
+    Parallel writers have to write disjoint blocks aligned to the chunks.
+    '''
+    var = group[param_name]
+    values = encode(array3d, var.attrs.get('scale_factor'), var.attrs.get('add_offset'))
+    var[t0:t0+values.shape[0], lat0:lat0+values.shape[1], lon0:lon0+values.shape[2]] = values
+
+    return
+
+def append_block(group, param_name, array3d, times):
+    '''
+    Append a block of downscaled data (time, lat, lon) with the time values
+    times (in TIME_UNITS) at the end of a store.
+    '''
+    var = group[param_name]
+    n_time = var.shape[0]
+    group['time'].append(np.asarray(times, dtype=group['time'].dtype))
+    var.resize((n_time+array3d.shape[0],)+var.shape[1:])
+    write_block(group, param_name, array3d, n_time)
+    zarr.consolidate_metadata(group.store)
+
+    return
+
+def close_zarr(group, complete=True):
+    '''
+    Consolidate the metadata of a complete store of create_zarr and move it to
+    its final name, or remove an incomplete one.
+    '''
+    partname = group.store.path
+    if complete:
+        # one metadata file for fast opening (e.g. by xarray.open_zarr)
+        zarr.consolidate_metadata(group.store)
+        savename = partname[:-len(df.PART_SUFFIX)]
+        if os.path.exists(savename):
+            shutil.rmtree(savename)
+        os.replace(partname, savename)
+    elif os.path.exists(partname):
+        shutil.rmtree(partname)
+
+    return
+
+def is_complete(path_zarr, n_time=None, key=None, lat1d=None, lon1d=None):
+    '''
+    Check if path_zarr is a complete store (with n_time timesteps), written by
+    the run key on the grid lat1d/lon1d (see downscaling_functions.is_complete).
+    '''
+    if not os.path.isdir(path_zarr):
+        return False
+    try:
+        group = zarr.open_group(path_zarr, mode='r')
+        if (n_time is not None) and (group['time'].shape[0] != n_time):
+            return False
+        if (key is not None) and (group.attrs.get(df.RUN_KEY_ATTR) != key):
+            return False
+        return (lat1d is None) or df.same_grid(group['lat'][:], group['lon'][:], lat1d, lon1d)
+    except(KeyError, ValueError):
+        return False
+
+def zarr_to_netcdf(path_zarr, fn_nc, block_size=365, **output_options):
+    '''
+    Export a store to the netCDF file fn_nc, block_size timesteps at a time.
+    output_options are the ones of downscaling_functions.create_data_variable.
+    '''
+    group = zarr.open_group(path_zarr, mode='r')
+    param_name = group.attrs['variable']
+    var_zarr = group[param_name]
+    n_time = var_zarr.shape[0]
+
+    dataset = Dataset(fn_nc+df.PART_SUFFIX, 'w', format='NETCDF4_CLASSIC')
+    complete = False
+    try:
+        dataset.createDimension("time", None)
+        dataset.createDimension("lat", group['lat'].shape[0])
+        dataset.createDimension("lon", group['lon'].shape[0])
+
+        for name, dtype in (('time', 'f8'), ('lat', 'f4'), ('lon', 'f4'), ('crs', 'i')):
+            var = dataset.createVariable(name, dtype, tuple(group[name].attrs['_ARRAY_DIMENSIONS']))
+            var.setncatts({k: v for k, v in group[name].attrs.items() if k != '_ARRAY_DIMENSIONS'})
+            var[...] = group[name][...]
+
+        var = df.create_data_variable(dataset, param_name, **output_options)
+        var.setncatts({k: v for k, v in var_zarr.attrs.items()
+                       if k not in ('_ARRAY_DIMENSIONS', 'scale_factor', 'add_offset')})
+        dataset.setncatts({k: v for k, v in group.attrs.items() if k != 'variable'})
+
+        for t0 in range(0, n_time, block_size):
+            values = decode(var_zarr[t0:t0+block_size], var_zarr.attrs.get('scale_factor'), var_zarr.attrs.get('add_offset'))
+            df.write_block(dataset, param_name, values, t0)
+        complete = True
+    finally:
+        df.close_netcdf(dataset, complete)
+
+    return fn_nc
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+correct_coast has to fill every timestep like fill does on its own, also if
+the gaps of the first timestep differ from the ones of the others.
+"""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+pytest.importorskip('xesmf')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dst'))
+
+import downscaling_functions as df
+
+
+def coast_block(n_time=5, shape=(30, 40)):
+    rng = np.random.RandomState(0)
+    topo_mask = np.ones(shape, dtype=bool)
+    topo_mask[:, -8:] = False
+    data = rng.rand(n_time, shape[0], shape[1]).astype(np.float32)
+    # cells without data after regridding along the coast
+    data[:, :, -12:] = np.nan
+    return data, topo_mask
+
+def reference(data, topo_mask):
+    return np.stack([df.fill(data[t:t+1].copy(), topo_mask)[0] for t in range(data.shape[0])])
+
+def check(data, topo_mask):
+    expected = reference(data, topo_mask)
+    result = df.correct_coast(data.copy(), None, index_cache=False, topo_mask=topo_mask)
+    np.testing.assert_array_equal(np.isnan(result), np.isnan(expected))
+    np.testing.assert_allclose(result, expected)
+
+def test_same_gaps():
+    data, topo_mask = coast_block()
+    check(data, topo_mask)
+
+def test_partial_gap_on_day_0():
+    data, topo_mask = coast_block()
+    data[0, 5:15, 10:20] = np.nan
+    check(data, topo_mask)
+
+def test_empty_day_0():
+    data, topo_mask = coast_block()
+    data[0] = np.nan
+    result = df.correct_coast(data.copy(), None, index_cache=False, topo_mask=topo_mask)
+    # the other days are filled completely
+    assert not np.isnan(result[1:][:, topo_mask]).any()
+    np.testing.assert_allclose(result[1:], reference(data[1:], topo_mask))
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""
+is_complete only accepts outputs of the same run key and grid, so outputs of
+other domains or settings are not skipped.
+"""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+pytest.importorskip('xesmf')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dst'))
+
+import downscaling_functions as df
+
+
+LAT = np.arange(40., 40.1, 0.01)
+LON = np.arange(15., 15.2, 0.01)
+
+def write_output(tmpdir, key):
+    dataset = df.create_netcdf_obs('tasmax', LAT, LON, 3, 2000, 2000, str(tmpdir)+'/', 'tasmax')
+    dataset.setncattr(df.RUN_KEY_ATTR, key)
+    df.write_block(dataset, 'tasmax', np.zeros((3, len(LAT), len(LON)), dtype=np.float32), 0)
+    df.close_netcdf(dataset)
+    return str(tmpdir.join('tasmax_2000-2000.nc'))
+
+def test_same_run(tmpdir):
+    fn = write_output(tmpdir, 'a')
+    assert df.is_complete(fn, 3, 'a', LAT, LON)
+
+def test_other_run(tmpdir):
+    fn = write_output(tmpdir, 'a')
+    assert not df.is_complete(fn, 3, 'b', LAT, LON)
+    assert not df.is_complete(fn, 4, 'a', LAT, LON)
+
+def test_other_grid(tmpdir):
+    fn = write_output(tmpdir, 'a')
+    assert not df.is_complete(fn, 3, 'a', LAT[1:], LON)
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""
+The validation of float32 runs reports the difference to float64 and stops
+runs, which differ by more than the tolerance.
+"""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+pytest.importorskip('xesmf')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dst'))
+
+import pandas as pd
+import xarray as xr
+
+import downscaling_functions as df
+
+
+@pytest.fixture
+def inputs(tmpdir):
+    rng = np.random.RandomState(0)
+    lat, lon = np.arange(40., 41.01, 0.1), np.arange(15., 16.01, 0.1)
+    lat_fine, lon_fine = np.arange(40.1, 40.91, 0.02), np.arange(15.1, 15.91, 0.02)
+    time = pd.date_range('2000-01-01', periods=40)
+    data = xr.Dataset({'tasmax': (('time', 'lat', 'lon'), 280+10*rng.rand(len(time), len(lat), len(lon)))},
+                      coords={'time': time, 'lat': lat, 'lon': lon})
+    topo_coarse = xr.Dataset({'height': (('lat', 'lon'), 1000*rng.rand(len(lat), len(lon)))},
+                             coords={'lat': lat, 'lon': lon})
+    topo_fine = xr.Dataset({'height': (('lat', 'lon'), 1000*rng.rand(len(lat_fine), len(lon_fine)))},
+                           coords={'lat': lat_fine, 'lon': lon_fine})
+    regridder = df.get_regridder(data, topo_fine, 'bilinear', weight_cache=False)
+    yield data, topo_coarse, topo_fine, regridder
+    regridder.clean_weight_file()
+
+def test_difference(inputs):
+    data, topo_coarse, topo_fine, regridder = inputs
+    grad = -0.0065*np.ones(12)
+    data_regrid = df.regrid_block(data, topo_coarse, topo_fine, 'tasmax', regridder, grad, np.float32)
+    max_diff = df.dtype_difference(data_regrid, data, topo_coarse, topo_fine, 'tasmax', regridder, grad)
+    assert 0 < max_diff < df.VALIDATE_TOLERANCE
+
+def test_tolerance(inputs, monkeypatch):
+    data, topo_coarse, topo_fine, regridder = inputs
+    monkeypatch.setattr(df, 'VALIDATE_TOLERANCE', 0.)
+    with pytest.raises(ValueError):
+        list(df.downscale_blocks(data, topo_coarse, topo_fine, 'tasmax', regridder, 20, validate=True))